@@ -0,0 +1,438 @@
+"""
+Micro-benchmarks for CPU-bound hot paths of the device and simulation code.
+
+Run from the backend directory:
+    python benchmarks.py            # all benchmarks
+    python benchmarks.py adc rpm    # selected benchmarks
+"""
+import copy
+import gzip
+import re
+import sys
+import time
+import timeit
+
+import numpy as np
+
+
+def _report(name, seconds, number, reference_seconds=None):
+    per_call_us = seconds / number * 1e6
+    line = "%-40s %10.2f us/call" % (name, per_call_us)
+    if reference_seconds is not None:
+        line += "   (%.1fx faster)" % (reference_seconds / seconds)
+    print(line)
+
+
+def _legacy_adc_counts(data, bitrate):
+    data_bits = "".join([bin(x)[2:].rjust(8, "0") for x in data])[-bitrate:]
+    sign_bit = data_bits[0]
+    digital_signal = sum(
+        [2**i for i in range(len(data_bits)) if data_bits[::-1][i] == "1"]
+    )
+    if sign_bit == "1":
+        digital_signal = digital_signal - 2**bitrate
+    return digital_signal
+
+
+def _legacy_tachometer_periods(res):
+    binstr = "".join([bin(r)[2:].rjust(8, "0") for r in res])
+    binstr = binstr.replace("1110111", "1111111").replace("11100111", "11111111")
+    periods = [len(match.group()) for match in re.finditer(r'(0+|1+)', binstr)]
+    return np.array(periods[1:-1])
+
+
+def _synthetic_tachometer_capture(rpm=1200, freq=1e5, nbytes=None, glitch_rate=0.002, seed=0):
+    """square wave with 4 half periods per rotation and random single-bit dips, as read from the fan SPI port"""
+    rng = np.random.default_rng(seed)
+    half_period_bits = int(60 * freq / rpm / 4)
+    if nbytes is None:
+        nbytes = int(60 * freq / rpm / 8 * 0.8) + 16
+    n_bits = nbytes * 8
+    phase = rng.integers(half_period_bits)
+    bits = ((np.arange(n_bits) + phase) // half_period_bits) % 2
+    glitches = rng.random(n_bits) < glitch_rate
+    bits = np.where(glitches & (bits == 1), 0, bits).astype(np.uint8)
+    return bytes(np.packbits(bits))
+
+
+def benchmark_adc(number=20000):
+    from minimal_device.adc import decode_adc_counts
+
+    samples = [(bytes([0x12, 0x34]), 16), (bytes([0xF2, 0x34]), 16), (bytes([0x01, 0xF2, 0x34]), 18),
+               (bytes([0x0F, 0xFF]), 12), (bytes([0x20, 0x00]), 14)]
+    for data, bitrate in samples:
+        assert decode_adc_counts(data, bitrate) == _legacy_adc_counts(data, bitrate)
+
+    def legacy():
+        for data, bitrate in samples:
+            _legacy_adc_counts(data, bitrate)
+
+    def fast():
+        for data, bitrate in samples:
+            decode_adc_counts(data, bitrate)
+
+    t_legacy = timeit.timeit(legacy, number=number // 10) * 10
+    t_fast = timeit.timeit(fast, number=number)
+    _report("adc decode (5 readings) legacy", t_legacy, number)
+    _report("adc decode (5 readings) int.from_bytes", t_fast, number, t_legacy)
+
+
+def benchmark_rpm(number=200):
+    from minimal_device.stirrers import tachometer_periods
+
+    captures = [_synthetic_tachometer_capture(rpm=rpm, seed=i) for i, rpm in enumerate([400, 800, 1200, 1600, 2000, 2400, 2800])]
+    clean = _synthetic_tachometer_capture(rpm=1000, glitch_rate=0)
+    assert np.array_equal(tachometer_periods(clean), _legacy_tachometer_periods(clean))
+    for capture in captures:
+        # glitch filling may differ from the chained str.replace only when two dips share a run of ones
+        assert abs(np.median(tachometer_periods(capture)) - np.median(_legacy_tachometer_periods(capture))) <= 1
+
+    def legacy():
+        for capture in captures:
+            _legacy_tachometer_periods(capture)
+
+    def fast():
+        for capture in captures:
+            tachometer_periods(capture)
+
+    t_legacy = timeit.timeit(legacy, number=number)
+    t_fast = timeit.timeit(fast, number=number)
+    n_bytes = sum(len(c) for c in captures)
+    _report("rpm decode (7 vials, %d bytes) legacy" % n_bytes, t_legacy, number)
+    _report("rpm decode (7 vials, %d bytes) numpy" % n_bytes, t_fast, number, t_legacy)
+    spi_seconds = n_bytes * 8 / 1e5
+    print("%-40s %10.2f us" % ("SPI transfer time of the captures", spi_seconds * 1e6))
+
+
+class _SimulatedEepromPort:
+    """
+    In-memory 24xx EEPROM with sequential reads. Accumulates the modelled bus time:
+    a USB round trip per transaction plus 9 bit times per byte at the I2C clock.
+    """
+    transaction_seconds = 0.001
+    i2c_frequency = 5e4
+
+    def __init__(self, memory):
+        self.memory = bytearray(memory)
+        self.address = 0
+        self.bus_seconds = 0.0
+
+    def _transaction(self, n_bytes):
+        self.bus_seconds += self.transaction_seconds + 9 * (n_bytes + 1) / self.i2c_frequency
+
+    def write(self, out, relax=True, start=True):
+        self._transaction(len(out))
+        self.address = out[0] << 8 | out[1]
+        if len(out) > 2:
+            self.memory[self.address:self.address + len(out) - 2] = bytes(out[2:])
+
+    def read(self, readlen=0, relax=True, start=True):
+        self._transaction(readlen)
+        data = self.memory[self.address:self.address + readlen]
+        self.address += readlen
+        return data
+
+
+class _BenchmarkDevice:
+    def __init__(self):
+        from minimal_device.bus_arbiter import BusArbiter
+        from minimal_device.device_data import default_device_data
+        self.lock_ftdi = BusArbiter()
+        self.device_data = copy.deepcopy(default_device_data)
+
+
+def _legacy_read_eeprom(port):
+    import yaml
+    pages_read = []
+    tail = bytearray([0xFF] * 63)
+    for page in range(512):
+        port.write([page >> 2, (page & 0b11) << 6], relax=False)
+        bytes_read = port.read(64)
+        pages_read += bytes_read
+        if len(bytes_read.partition(tail)[-1]) > 0:
+            break
+    compressed_data = bytearray(pages_read).partition(tail)[0]
+    return yaml.load(gzip.decompress(compressed_data).decode("utf-8"), Loader=yaml.Loader)
+
+
+def benchmark_eeprom_read(number=20):
+    import yaml
+    from minimal_device.eeprom import EEPROM
+
+    device = _BenchmarkDevice()
+    legacy_image = gzip.compress(yaml.dump(device.device_data).encode("utf-8")) + bytes([0xFF] * 64)
+    legacy_memory = legacy_image + bytes([0xFF] * (32768 - len(legacy_image)))
+
+    eeprom = EEPROM.__new__(EEPROM)  # no writer thread and no file, only the read and write paths
+    eeprom.device = device
+    eeprom.last_image = None
+    eeprom.page_write_counts = np.zeros(EEPROM.N_PAGES, dtype=int)
+    eeprom.bytes_written = 0
+    eeprom.image_writes = 0
+    eeprom.pages_skipped = 0
+    eeprom._write_to_file = lambda data: None
+    eeprom.port = _SimulatedEepromPort(bytes([0xFF] * 32768))
+    eeprom._write_binary_image(device.device_data)
+    binary_memory = eeprom.port.memory
+
+    results = {}
+    for name, memory, read in [
+        ("legacy page by page", legacy_memory, _legacy_read_eeprom),
+        ("sequential, legacy image", legacy_memory, lambda port: eeprom._read_legacy_eeprom()),
+        ("sequential, binary image", binary_memory, lambda port: eeprom._read_binary_image()),
+    ]:
+        t0 = time.perf_counter()
+        bus_seconds = 0.0
+        for _ in range(number):
+            eeprom.port = _SimulatedEepromPort(memory)
+            assert read(eeprom.port) == device.device_data
+            bus_seconds += eeprom.port.bus_seconds
+        cpu_seconds = time.perf_counter() - t0
+        results[name] = (cpu_seconds + bus_seconds) / number
+        print("%-40s %10.2f ms cpu %8.2f ms modelled bus" % ("eeprom read " + name,
+                                                              cpu_seconds / number * 1e3, bus_seconds / number * 1e3))
+    print("%-40s %10.1fx faster" % ("eeprom read legacy image, sequential", results["legacy page by page"]
+                                     / results["sequential, legacy image"]))
+
+    # device data file, read on connect when the file writer is used
+    text = yaml.dump(device.device_data)
+    t_python = timeit.timeit(lambda: yaml.load(text, Loader=yaml.Loader), number=number)
+    t_c = timeit.timeit(lambda: yaml.load(text, Loader=getattr(yaml, "CLoader", yaml.Loader)), number=number)
+    _report("device_data.yaml parse yaml.Loader", t_python, number)
+    _report("device_data.yaml parse CLoader", t_c, number, t_python)
+
+
+def _legacy_mv_to_od(device_data, vial, mv):
+    from minimal_device.od_sensor import BeerLambertScaled
+    blank_signal, scaling = device_data['ods']['calibration_coefs'][vial]
+    calibration_keys = list(device_data['ods']['calibration'][vial].keys())
+    lowest_od_in_calibration = min(calibration_keys)
+    if float(lowest_od_in_calibration) == 0.0:
+        blank_signal = device_data['ods']['calibration'][vial][lowest_od_in_calibration]
+    return BeerLambertScaled(mv, blank_signal, scaling)
+
+
+def benchmark_od_transform(n_signals=20000, number=5):
+    from minimal_device.od_sensor import OdSensor
+
+    device = _BenchmarkDevice()
+    device.is_connected = lambda: False
+    device.device_data['ods']['calibration'][1] = {0.0: 41.2, 0.5: 23.1, 1.0: 11.9, 2.0: 3.4}
+    device.device_data['ods']['calibration_coefs'][1] = [41.2, 1.83]
+    sensor = OdSensor(device, 1)
+    history = np.random.default_rng(0).uniform(1, 45, n_signals)
+    assert np.allclose(sensor.mv_to_od(history[:100]),
+                       [_legacy_mv_to_od(device.device_data, 1, mv) for mv in history[:100]], rtol=0, atol=1e-12)
+
+    t_legacy = timeit.timeit(lambda: [_legacy_mv_to_od(device.device_data, 1, mv) for mv in history], number=1) * number
+    t_scalar = timeit.timeit(lambda: [sensor.mv_to_od(mv) for mv in history], number=1) * number
+    t_array = timeit.timeit(lambda: sensor.mv_to_od(history), number=number)
+    _report("mv_to_od %d signals legacy loop" % n_signals, t_legacy, number)
+    _report("mv_to_od %d signals cached, loop" % n_signals, t_scalar, number, t_legacy)
+    _report("mv_to_od %d signals cached, array" % n_signals, t_array, number, t_legacy)
+
+
+def _legacy_effective_dose(model, time_current):
+    """CultureGrowthModel.calculate_effective_dose before the incremental version, sums over all past doses"""
+    from experiment.ModelBasedCulture.model_equations import dose_effective
+
+    if not model.effective_doses:
+        model.effective_doses.append(model.updater.pump1_stock_drug_concentration, model.minute)
+    effective_dose = model.effective_doses[0][0]
+    added_doses = np.diff([0] + [dose[0] for dose in model.doses])
+    dilution_times = [dose[1] for dose in model.doses]
+    for added_dose, dilution_time in zip(added_doses, dilution_times):
+        if added_dose == 0:
+            continue
+        time_since_addition_hrs = (time_current - dilution_time).total_seconds() / 3600.0
+        effective_dose += dose_effective(added_dose, model.time_lag_drug_effect_mins / 60,
+                                         time_since_addition_hrs, model.dose_effective_slope_width_mins / 60)
+    return effective_dose
+
+
+def _simulate(simulation_hours, legacy=False):
+    from experiment.ModelBasedCulture.culture_growth_model import CultureGrowthModel
+    from experiment.ModelBasedCulture.morbidostat_updater import MorbidostatUpdater
+
+    model = CultureGrowthModel()
+    model.updater = MorbidostatUpdater()
+    if legacy:
+        model.calculate_effective_dose = lambda time_current: _legacy_effective_dose(model, time_current)
+    t0 = time.perf_counter()
+    model.simulate_experiment(simulation_hours=simulation_hours)
+    return model, time.perf_counter() - t0
+
+
+def benchmark_simulation(simulation_hours=240):
+    legacy, t_legacy = _simulate(simulation_hours, legacy=True)
+    model, t_model = _simulate(simulation_hours)
+    assert [d[0] for d in model.effective_doses] == [d[0] for d in legacy.effective_doses]
+    assert [p[0] for p in model.population] == [p[0] for p in legacy.population]
+    _report("simulate %d h, full effective dose sum" % simulation_hours, t_legacy, 1)
+    _report("simulate %d h, incremental" % simulation_hours, t_model, 1, t_legacy)
+
+
+def benchmark_sweep(simulation_hours=48, n_serial=20):
+    from experiment.ModelBasedCulture.batch_simulation import BatchCultureSimulator, parameter_grid
+    from experiment.ModelBasedCulture.culture_growth_model import CultureGrowthModel
+    from experiment.ModelBasedCulture.morbidostat_updater import MorbidostatUpdater
+
+    candidates = parameter_grid({"dose_increase_factor": list(np.linspace(1.2, 3, 10)),
+                                 "threshold_growth_rate_increase_stress": list(np.linspace(0.05, 0.4, 10)),
+                                 "od_dilution_threshold": list(np.linspace(0.2, 0.6, 10)),
+                                 "dilution_factor": [1.4, 1.6]})
+    t0 = time.perf_counter()
+    for candidate in candidates[:n_serial]:
+        model = CultureGrowthModel()
+        model.updater = MorbidostatUpdater(**candidate)
+        model.simulate_experiment(simulation_hours=simulation_hours)
+    t_serial = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    BatchCultureSimulator(candidates).simulate(simulation_hours=simulation_hours)
+    t_batch = time.perf_counter() - t0
+    _report("sweep %d h, serial models" % simulation_hours, t_serial, n_serial)
+    _report("sweep %d h, %d candidates batched" % (simulation_hours, len(candidates)), t_batch, len(candidates),
+            t_serial / n_serial * len(candidates))
+
+
+def benchmark_ode(simulation_hours=240):
+    from experiment.ModelBasedCulture.culture_growth_model import CultureGrowthModel, get_simulation_efficiency
+    from experiment.ModelBasedCulture.morbidostat_updater import MorbidostatUpdater
+
+    cases = {"default": ({}, {}),
+             "slow growth": ({"doubling_time_mins": 120}, {}),
+             "time triggered": ({}, {"od_dilution_threshold": -1, "delay_dilution_max_hours": 6})}
+    for name, (growth_parameters, updater_parameters) in cases.items():
+        seconds = {}
+        models = {}
+        for method in ["minute", "ode"]:
+            model = CultureGrowthModel(**growth_parameters)
+            model.updater = MorbidostatUpdater(**updater_parameters)
+            t0 = time.perf_counter()
+            model.simulate_experiment(simulation_hours=simulation_hours, method=method)
+            seconds[method] = time.perf_counter() - t0
+            models[method] = model
+        _report("simulate %d h %s, minute steps" % (simulation_hours, name), seconds["minute"], 1)
+        _report("simulate %d h %s, ode" % (simulation_hours, name), seconds["ode"], 1, seconds["minute"])
+        time_minute = get_simulation_efficiency(models["minute"])[1]
+        time_ode = get_simulation_efficiency(models["ode"])[1]
+        print("    dilutions %d / %d, time per IC50 doubling %.3f / %.3f h" % (
+            len(models["minute"].doses), len(models["ode"].doses), time_minute, time_ode))
+
+
+def benchmark_backtest(simulation_hours=240):
+    """replay of a simulated run through the updater, in simulated minutes per second"""
+    from datetime import timedelta
+    from experiment.ModelBasedCulture.backtest import RecordedVial, run_backtest
+    from experiment.ModelBasedCulture.culture_growth_model import CultureGrowthModel
+    from experiment.ModelBasedCulture.morbidostat_updater import MorbidostatUpdater
+
+    model = CultureGrowthModel()
+    model.updater = MorbidostatUpdater()
+    model.simulate_experiment(simulation_hours=simulation_hours)
+    start = model.population.start_time
+    minutes = model.population.minutes
+    # the simulation stores the diluted OD at the dilution minute, the device measures before diluting
+    ods = np.where(np.isin(minutes, model.doses.minutes), model.population.values * model.updater.dilution_factor,
+                   model.population.values)
+    growth_rates = dict(zip(model.effective_growth_rates.minutes.tolist(),
+                            model.effective_growth_rates.values.tolist()))
+    recorded = RecordedVial(od_timestamps=[start + timedelta(minutes=int(minute)) for minute in minutes], ods=ods,
+                            growth_rates=[growth_rates.get(int(minute), np.nan) for minute in minutes],
+                            dilution_timestamps=[start + timedelta(minutes=int(minute), seconds=30)
+                                                 for minute in model.doses.minutes],
+                            generations=model.generations.values, concentrations=model.doses.values)
+    for od_mode in ["recorded", "rescaled"]:
+        t0 = time.perf_counter()
+        result = run_backtest(recorded, {}, od_mode=od_mode)
+        seconds = time.perf_counter() - t0
+        _report("backtest %d h, %s OD" % (simulation_hours, od_mode), seconds, len(recorded))
+        summary = result["summary"]
+        print("    %.0f minutes per second, dilutions %d replayed / %d recorded, %d matched" % (
+            summary["minutes_per_second"], summary["replayed_dilutions"], summary["recorded_dilutions"],
+            summary["matched_dilutions"]))
+
+
+def _legacy_mu_effective(dose, mu_min, mu_max, ic10_ic50_ratio, ic50, population, carrying_capacity):
+    """model_equations.mu_effective before the precomputed steepness constants"""
+    k_mu = np.log(9) / (ic50 - ic50 * ic10_ic50_ratio)
+    return mu_min + (mu_max / (1 + np.exp(-k_mu * (ic50 - dose)))) * (1 - population / carrying_capacity)
+
+
+def _legacy_dose_effective(dose, lag_time_hrs, time_since_addition_hrs, slope_width_hrs):
+    k = np.log(19) / (0.5 * slope_width_hrs)
+    return dose / (1 + np.exp(-k * (time_since_addition_hrs - lag_time_hrs)))
+
+
+def _legacy_adaptation_rate(dose, adaptation_rate_max, ic50, ic10_ic50_ratio, adaptation_rate_ic10_ic50_ratio):
+    k_adapt = -np.log(adaptation_rate_ic10_ic50_ratio) / ((ic50 * ic10_ic50_ratio - ic50) ** 2)
+    return adaptation_rate_max * np.exp(-k_adapt * ((dose - ic50) ** 2)) * (dose / ic50) ** 2
+
+
+def benchmark_equations(number=20000, n_array=1000):
+    """per call overhead of the growth model equations, as called every simulated minute and on arrays"""
+    from experiment.ModelBasedCulture.culture_growth_model import culture_growth_model_default_parameters
+    from experiment.ModelBasedCulture.model_equations import (GrowthEquations, mu_effective, dose_effective,
+                                                              adaptation_rate)
+
+    p = dict(culture_growth_model_default_parameters, doubling_time_mins=20)
+    mu_max = np.log(2) / (p["doubling_time_mins"] / 60)
+    lag_hrs, slope_width_hrs = p["time_lag_drug_effect_mins"] / 60, p["dose_effective_slope_width_mins"] / 60
+    equations = GrowthEquations.from_parameters(p, mu_max=mu_max)
+    doses = np.linspace(0, 4 * p["ic50_initial"], n_array)
+    hours = np.linspace(0, 6, n_array)
+    ic50s = p["ic50_initial"] * np.exp(np.linspace(0, 1, n_array))
+    populations = np.linspace(0.01, 0.8, n_array)
+
+    cases = {
+        "mu_effective": (
+            lambda d, i, n: _legacy_mu_effective(d, p["mu_min"], mu_max, p["ic10_ic50_ratio"], i, n,
+                                                 p["carrying_capacity"]),
+            lambda d, i, n: mu_effective(d, p["mu_min"], mu_max, p["ic10_ic50_ratio"], i, n, p["carrying_capacity"]),
+            lambda d, i, n: equations.mu_effective(d, i, n),
+            (2.0, 5.0, 0.3), (doses, ic50s, populations)),
+        "dose_effective": (
+            lambda d, t: _legacy_dose_effective(d, lag_hrs, t, slope_width_hrs),
+            lambda d, t: dose_effective(d, lag_hrs, t, slope_width_hrs),
+            lambda d, t: equations.dose_effective(d, t),
+            (2.0, 0.7), (doses, hours)),
+        "adaptation_rate": (
+            lambda d, i: _legacy_adaptation_rate(d, p["adaptation_rate_max"], i, p["ic10_ic50_ratio"],
+                                                 p["adaptation_rate_ic10_ic50_ratio"]),
+            lambda d, i: adaptation_rate(d, p["adaptation_rate_max"], i, p["ic10_ic50_ratio"],
+                                         p["adaptation_rate_ic10_ic50_ratio"]),
+            lambda d, i: equations.adaptation_rate(d, i),
+            (2.0, 5.0), (doses, ic50s)),
+    }
+    for name, (legacy, function, precomputed, scalar_args, array_args) in cases.items():
+        for variant in [function, precomputed]:
+            assert np.allclose(variant(*array_args), legacy(*array_args), rtol=1e-10, atol=0)
+        t_legacy = timeit.timeit(lambda: legacy(*scalar_args), number=number)
+        _report("%s scalar, legacy" % name, t_legacy, number)
+        _report("%s scalar, function" % name, timeit.timeit(lambda: function(*scalar_args), number=number),
+                number, t_legacy)
+        _report("%s scalar, precomputed" % name, timeit.timeit(lambda: precomputed(*scalar_args), number=number),
+                number, t_legacy)
+        t_legacy = timeit.timeit(lambda: legacy(*array_args), number=number // 10)
+        _report("%s %d doses, legacy" % (name, n_array), t_legacy, number // 10)
+        _report("%s %d doses, precomputed" % (name, n_array),
+                timeit.timeit(lambda: precomputed(*array_args), number=number // 10), number // 10, t_legacy)
+
+
+BENCHMARKS = {
+    "adc": benchmark_adc,
+    "rpm": benchmark_rpm,
+    "eeprom_read": benchmark_eeprom_read,
+    "od_transform": benchmark_od_transform,
+    "simulation": benchmark_simulation,
+    "sweep": benchmark_sweep,
+    "ode": benchmark_ode,
+    "backtest": benchmark_backtest,
+    "equations": benchmark_equations,
+}
+
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        BENCHMARKS[name]()
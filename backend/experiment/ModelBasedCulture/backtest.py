@@ -0,0 +1,191 @@
+import time
+
+import numpy as np
+
+from .morbidostat_updater import MorbidostatUpdater
+
+OD_MODES = ["rescaled", "recorded"]
+
+
+class RecordedVial:
+    """
+    Recorded history of a vial: OD measurements with their growth rates (nan where none was stored) and the
+    dilutions with the generation and drug concentration after each, ordered by time.
+    """
+
+    def __init__(self, od_timestamps, ods, growth_rates, dilution_timestamps, generations, concentrations):
+        self.od_timestamps = list(od_timestamps)
+        self.ods = np.asarray(ods, dtype=float)
+        self.growth_rates = np.asarray(growth_rates, dtype=float)
+        self.dilution_timestamps = list(dilution_timestamps)
+        self.generations = np.asarray(generations, dtype=float)
+        self.concentrations = np.asarray(concentrations, dtype=float)
+
+    def __len__(self):
+        return len(self.ods)
+
+    def dilution_factors(self, initial_generation=0):
+        """:return: dilution factor of every recorded dilution, from the generation increase"""
+        previous = np.concatenate([[initial_generation], self.generations[:-1]])
+        return 2 ** (self.generations - previous)
+
+
+class BacktestCulture:
+    """
+    Replacement of RealCultureWrapper for the MorbidostatUpdater backed by in-memory arrays: the recorded OD and
+    growth rate measurements are revealed one at a time, dilutions are only recorded. Series are lists of
+    (value, timestamp) tuples as in the real culture, appended to instead of queried from the database.
+    """
+
+    def __init__(self, vial, updater, first_od_timestamp, initial_concentration):
+        self.vial = vial
+        self.updater = updater
+        self.first_od_timestamp = first_od_timestamp
+        self.initial_concentration = initial_concentration
+        self.population = []
+        self.effective_growth_rates = []
+        self.generations = []
+        self.doses = []
+        self.growth_rate = None
+        self.time_current = None
+        self.dilutions = []  # (timestamp, dose, generation, dilution factor, updater message)
+
+    def print_updater_status(self):
+        pass
+
+    def dilute_culture(self, target_dose, dilution_factor=None):
+        """record the dilution the updater decided on, the dose is limited to what the pump stocks can reach"""
+        if dilution_factor is None:
+            dilution_factor = self.updater.dilution_factor
+        current_dose = self.doses[-1][0] if self.doses else self.initial_concentration
+        added_fraction = (dilution_factor - 1) / dilution_factor
+        only_pump1_resulting_dose = (current_dose * (1 - added_fraction)
+                                     + self.updater.pump1_stock_drug_concentration * added_fraction)
+        only_pump2_resulting_dose = (current_dose * (1 - added_fraction)
+                                     + self.updater.pump2_stock_drug_concentration * added_fraction)
+        min_dose = min(only_pump1_resulting_dose, only_pump2_resulting_dose)
+        max_dose = max(only_pump1_resulting_dose, only_pump2_resulting_dose)
+        dose = min(max_dose, max(min_dose, target_dose))
+        generation = (self.generations[-1][0] if self.generations else 0) + np.log2(dilution_factor)
+        self.doses.append((dose, self.time_current))
+        self.generations.append((generation, self.time_current))
+        self.dilutions.append((self.time_current, dose, generation, dilution_factor,
+                               self.updater.status_dict.get("dilution_message")))
+
+
+def _dose_changes(timestamps, doses, initial_dose):
+    changes = []
+    previous = initial_dose
+    for timestamp, dose in zip(timestamps, doses):
+        if round(dose, 3) != round(previous, 3):
+            changes.append({"time": timestamp.isoformat(), "from": float(previous), "to": float(dose)})
+        previous = dose
+    return changes
+
+
+def _match_dilutions(replayed, recorded, tolerance_minutes):
+    """:return: number of replayed dilutions with a recorded dilution within tolerance_minutes, each used once"""
+    recorded = sorted(recorded)
+    used = set()
+    matched = 0
+    j = 0
+    for timestamp in sorted(replayed):
+        while j < len(recorded) and (timestamp - recorded[j]).total_seconds() / 60 > tolerance_minutes:
+            j += 1
+        for k in range(j, len(recorded)):
+            if (recorded[k] - timestamp).total_seconds() / 60 > tolerance_minutes:
+                break
+            if k not in used:
+                used.add(k)
+                matched += 1
+                break
+    return matched
+
+
+def run_backtest(recorded, updater_parameters, vial=0, od_mode="rescaled", initial_concentration=None,
+                 match_tolerance_minutes=5):
+    """
+    Replay the recorded measurements of a vial through MorbidostatUpdater.update with the given updater
+    parameters, calling the updater after every OD measurement as the experiment loop does.
+
+    In "recorded" mode the updater sees the measured ODs as they were. In "rescaled" mode the measured ODs are
+    multiplied by the recorded dilution factors and divided by the replayed ones since the start, so the OD
+    drops at the replayed dilutions instead of the recorded ones. Growth rates are used as measured in both
+    modes: the effect of a different dose history on growth is not modeled.
+
+    :return: dictionary with the replayed and the recorded dilutions, the dose changes of both and a summary
+    """
+    if od_mode not in OD_MODES:
+        raise ValueError("Unknown OD mode %s, expected one of %s" % (od_mode, ", ".join(OD_MODES)))
+    if len(recorded) == 0:
+        raise ValueError("No recorded OD measurements to replay")
+    t0 = time.perf_counter()
+    updater = MorbidostatUpdater(**updater_parameters)
+    if initial_concentration is None:
+        initial_concentration = updater.pump1_stock_drug_concentration
+    culture = BacktestCulture(vial, updater, recorded.od_timestamps[0], initial_concentration)
+
+    # dilutions before the first replayed measurement are history both runs share
+    recorded_factors = recorded.dilution_factors()
+    i_dilution = 0
+    n_dilutions = len(recorded.dilution_timestamps)
+    while i_dilution < n_dilutions and recorded.dilution_timestamps[i_dilution] < recorded.od_timestamps[0]:
+        timestamp = recorded.dilution_timestamps[i_dilution]
+        culture.doses.append((float(recorded.concentrations[i_dilution]), timestamp))
+        culture.generations.append((float(recorded.generations[i_dilution]), timestamp))
+        i_dilution += 1
+    start_dose = culture.doses[-1][0] if culture.doses else initial_concentration
+    log_scale = 0.0  # log of recorded / replayed dilution factors so far
+    growth_rate = None
+    for timestamp, od, measured_growth_rate in zip(recorded.od_timestamps, recorded.ods, recorded.growth_rates):
+        while i_dilution < n_dilutions and recorded.dilution_timestamps[i_dilution] < timestamp:
+            if od_mode == "rescaled":
+                log_scale += np.log(recorded_factors[i_dilution])
+            i_dilution += 1
+        n_replayed = len(culture.dilutions)
+        if not np.isnan(measured_growth_rate):
+            growth_rate = float(measured_growth_rate)
+            culture.effective_growth_rates.append((growth_rate, timestamp))
+        culture.growth_rate = growth_rate
+        culture.time_current = timestamp
+        culture.population.append((float(od * np.exp(log_scale)), timestamp))
+        updater.update(culture)
+        if od_mode == "rescaled" and len(culture.dilutions) > n_replayed:
+            log_scale -= np.log(culture.dilutions[-1][3])
+    elapsed = time.perf_counter() - t0
+
+    replayed_timestamps = [dilution[0] for dilution in culture.dilutions]
+    replayed_doses = [dilution[1] for dilution in culture.dilutions]
+    minutes_replayed = (recorded.od_timestamps[-1] - recorded.od_timestamps[0]).total_seconds() / 60
+    in_range = [i for i, timestamp in enumerate(recorded.dilution_timestamps)
+                if recorded.od_timestamps[0] <= timestamp <= recorded.od_timestamps[-1]]
+    recorded_timestamps = [recorded.dilution_timestamps[i] for i in in_range]
+    recorded_doses = [float(recorded.concentrations[i]) for i in in_range]
+    return {
+        "od_mode": od_mode,
+        "start": recorded.od_timestamps[0].isoformat(),
+        "end": recorded.od_timestamps[-1].isoformat(),
+        "replayed_dilutions": [{"time": timestamp.isoformat(), "dose": float(dose), "generation": float(generation),
+                                "dilution_factor": float(dilution_factor), "message": message}
+                               for timestamp, dose, generation, dilution_factor, message in culture.dilutions],
+        "recorded_dilutions": [{"time": recorded.dilution_timestamps[i].isoformat(),
+                                "dose": float(recorded.concentrations[i]),
+                                "generation": float(recorded.generations[i])} for i in in_range],
+        "replayed_dose_changes": _dose_changes(replayed_timestamps, replayed_doses, start_dose),
+        "recorded_dose_changes": _dose_changes(recorded_timestamps, recorded_doses, start_dose),
+        "summary": {
+            "od_measurements": len(recorded),
+            "hours_replayed": minutes_replayed / 60,
+            "replayed_dilutions": len(replayed_timestamps),
+            "recorded_dilutions": len(recorded_timestamps),
+            "matched_dilutions": _match_dilutions(replayed_timestamps, recorded_timestamps, match_tolerance_minutes),
+            "match_tolerance_minutes": match_tolerance_minutes,
+            "replayed_final_dose": float(replayed_doses[-1]) if replayed_doses else None,
+            "recorded_final_dose": recorded_doses[-1] if recorded_doses else None,
+            "replayed_max_dose": float(max(replayed_doses)) if replayed_doses else None,
+            "recorded_max_dose": max(recorded_doses) if recorded_doses else None,
+            "replayed_generations": float(culture.generations[-1][0]) if culture.generations else 0.0,
+            "elapsed_seconds": elapsed,
+            "minutes_per_second": minutes_replayed / elapsed if elapsed > 0 else None,
+        },
+    }
@@ -0,0 +1,297 @@
+import itertools
+
+import numpy as np
+
+from .culture_growth_model import culture_growth_model_default_parameters
+from .model_equations import GrowthEquations, dose_effective_steepness
+from .morbidostat_updater import morbidostat_updater_default_parameters
+
+# the dose response kernel is shared by all simulated cultures of a batch
+SHARED_PARAMETERS = ("time_lag_drug_effect_mins", "dose_effective_slope_width_mins")
+
+
+def parameter_grid(grid):
+    """:return: list of parameter dictionaries for every combination of the values in grid {name: [values]}"""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+class BatchCultureSimulator:
+    """
+    Simulates many CultureGrowthModel cultures, each controlled by its own MorbidostatUpdater parameters,
+    in lockstep: every state variable (population, dose, IC50, growth rate, generations, ...) is a NumPy
+    array over the batch, the updater decisions are evaluated as masks and the dilutions are applied
+    to the masked cultures at once.
+
+    Follows CultureGrowthModel.simulate_experiment and MorbidostatUpdater.update minute by minute. The
+    effective dose is computed on the minute grid: each dose addition adds its sigmoid ramp to a ring
+    buffer of future contributions and its full amount to a baseline; ramps are truncated once within
+    kernel_tolerance of the full amount, so results agree with the single culture simulation to about
+    that precision (and a threshold decision may rarely flip because of it).
+
+    A culture whose dilution would exceed the 30 ml vial volume stops diluting and gets an error,
+    where CultureGrowthModel.dilute_culture raises.
+
+    With od_noise or growth_rate_noise (standard deviations, OD units and 1/h), the updater decisions are
+    made on noisy measurements of the population and growth rate, drawn every minute, like the noisy OD
+    readings and growth rate fits of a real culture. The simulated culture itself stays deterministic.
+    """
+    kernel_tolerance = 1e-12
+    max_total_volume = 30  # ml, as in CultureGrowthModel.dilute_culture
+
+    def __init__(self, candidates, growth_parameters=None, updater_parameters=None, od_noise=0,
+                 growth_rate_noise=0, seed=None):
+        """
+        :param candidates: list of dictionaries with growth model and updater parameters of each culture,
+            on top of the common growth_parameters and updater_parameters (other keys of these are ignored)
+        """
+        base = dict(culture_growth_model_default_parameters)
+        base.update(morbidostat_updater_default_parameters)
+        for parameters in [growth_parameters or {}, updater_parameters or {}]:
+            base.update({name: value for name, value in parameters.items() if name in base})
+        self.candidates = [dict(candidate) for candidate in candidates]
+        self.n = len(self.candidates)
+        if self.n == 0:
+            raise ValueError("No candidates to simulate")
+        for candidate in self.candidates:
+            for name in candidate:
+                if name not in base:
+                    raise ValueError("Unknown simulation parameter %s" % name)
+        for name in SHARED_PARAMETERS:
+            if len(set(float(c.get(name, base[name])) for c in self.candidates)) > 1:
+                raise ValueError("%s must be the same for all candidates" % name)
+        self.parameters = {name: np.array([float(c.get(name, base[name])) for c in self.candidates])
+                           for name in base}
+        self.od_noise = od_noise
+        self.growth_rate_noise = growth_rate_noise
+        self.rng = np.random.default_rng(seed)
+        self.simulation_hours = None
+
+    def _dose_kernel(self):
+        """:return: sigmoid fraction of a dose addition that is effective 0, 1, 2, ... minutes after it"""
+        lag_hrs = self.parameters["time_lag_drug_effect_mins"][0] / 60
+        slope_width_hrs = self.parameters["dose_effective_slope_width_mins"][0] / 60
+        k = dose_effective_steepness(slope_width_hrs)
+        n_minutes = int(np.ceil((lag_hrs - np.log(self.kernel_tolerance) / k) * 60)) + 1
+        minutes = np.arange(n_minutes + 1)
+        return 1 / (1 + np.exp(-k * (minutes / 60 - lag_hrs)))
+
+    def simulate(self, simulation_hours=48, record_every_minutes=None):
+        """
+        :param record_every_minutes: record population, dose and IC50 of all cultures at this interval
+            in self.records (arrays of shape (records, cultures)) and self.record_minutes
+        """
+        p = self.parameters
+        n = self.n
+        self.simulation_hours = simulation_hours
+        self.n_minutes = int(simulation_hours * 60)
+        equations = GrowthEquations.from_parameters(p)
+        kernel_offsets = self._dose_kernel()[1:] - 1
+        ring_size = len(kernel_offsets) + 1
+        future_dose = np.zeros((n, ring_size))  # effective dose still missing from ramping additions
+        ramp_slots = np.arange(1, ring_size)
+
+        settled_dose = p["pump1_stock_drug_concentration"].copy()
+        self.effective_dose = settled_dose.copy()
+        self.population = np.full(n, np.nan)
+        self.ic50 = p["ic50_initial"].copy()
+        self.growth_rate = np.zeros(n)
+        self.dose = np.zeros(n)
+        self.generation = np.zeros(n)
+        self.generation_at_dose_change = np.zeros(n)
+        self.n_dilutions = np.zeros(n, dtype=np.int64)
+        self.last_dilution_minute = np.zeros(n, dtype=np.int64)
+        self.pump1_volume = np.zeros(n)
+        self.pump2_volume = np.zeros(n)
+        self.waste_volume = np.zeros(n)
+        self.failed = np.zeros(n, dtype=bool)
+        self.measured_population = self.population
+        self.measured_growth_rate = self.growth_rate
+        self.min_population = np.full(n, np.inf)
+        record_minutes = [] if record_every_minutes is None else list(range(1, self.n_minutes, record_every_minutes))
+        self.record_minutes = np.array(record_minutes, dtype=np.int64)
+        self.records = {name: np.empty((len(record_minutes), n)) for name in ["population", "dose", "ic50"]}
+        i_record = 0
+
+        for minute in range(1, self.n_minutes):
+            slot = minute % ring_size
+            effective_dose = settled_dose + future_dose[:, slot]
+            future_dose[:, slot] = 0
+            self.effective_dose = effective_dose
+
+            if minute > 1:
+                self.growth_rate = equations.mu_effective(effective_dose, self.ic50, self.population)
+            with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+                adapt_rate = equations.adaptation_rate(effective_dose, self.ic50)
+            self.ic50 = np.where(effective_dose > 0, self.ic50 * np.exp(adapt_rate / 60), self.ic50)
+            if minute == 1:
+                self.population = p["initial_population"].copy()
+            else:
+                self.population = self.population * np.exp(self.growth_rate / 60)
+            self.measured_population = self.population
+            self.measured_growth_rate = self.growth_rate
+            if self.od_noise > 0:
+                self.measured_population = self.population + self.rng.normal(0, self.od_noise, n)
+            if self.growth_rate_noise > 0 and minute > 1:
+                self.measured_growth_rate = self.growth_rate + self.rng.normal(0, self.growth_rate_noise, n)
+
+            target_dose, dilute = self._update(minute)
+            if np.any(dilute):
+                diluted, added_dose = self._dilute(minute, dilute, target_dose)
+                rows = np.flatnonzero(diluted)
+                settled_dose[rows] += added_dose
+                columns = (minute + ramp_slots) % ring_size
+                future_dose[rows[:, None], columns[None, :]] += added_dose[:, None] * kernel_offsets[None, :]
+            np.minimum(self.min_population, self.population, out=self.min_population)
+            if i_record < len(record_minutes) and minute == record_minutes[i_record]:
+                self.records["population"][i_record] = self.population
+                self.records["dose"][i_record] = self.dose
+                self.records["ic50"][i_record] = self.ic50
+                i_record += 1
+        return self
+
+    def _update(self, minute):
+        """MorbidostatUpdater.update for all cultures, :return: (target dose, mask of cultures to dilute)"""
+        p = self.parameters
+        n_dilutions = self.n_dilutions
+        diluted_before = n_dilutions > 0
+        must_wait = diluted_before & (minute < self.last_dilution_minute + 4)
+        can_dilute = ~self.failed & ~must_wait
+
+        initialize = can_dilute & (p["dose_initialization"] >= 0) & ~diluted_before
+        hours_since_dilution = (minute - self.last_dilution_minute) * 60 / 3600
+        time_triggered = (can_dilute & ~initialize & (p["delay_dilution_max_hours"] >= 0) & diluted_before
+                          & (hours_since_dilution >= p["delay_dilution_max_hours"]))
+        od_triggered = (can_dilute & ~initialize & ~time_triggered & (p["od_dilution_threshold"] >= 0)
+                        & (self.measured_population >= p["od_dilution_threshold"]))
+        adjust = time_triggered | od_triggered
+
+        # dilute_and_adjust_dose
+        next_dilution_number = n_dilutions + 1
+        before_first_drug = next_dilution_number < p["dilution_number_first_drug_addition"]
+        first_drug = ~before_first_drug & (next_dilution_number == p["dilution_number_first_drug_addition"])
+        generations_since_dose_change = self.generation + np.log2(p["dilution_factor"]) - self.generation_at_dose_change
+        increase = (~before_first_drug & ~first_drug
+                    & (p["threshold_growth_rate_increase_stress"] != -1) & (p["delay_stress_increase_min_generations"] != -1)
+                    & diluted_before
+                    & (self.measured_population > p["threshold_od_min_increase_stress"])
+                    & (generations_since_dose_change > p["delay_stress_increase_min_generations"])
+                    & (self.measured_growth_rate > p["threshold_growth_rate_increase_stress"]))
+        decrease = (~before_first_drug & ~first_drug & ~increase
+                    & (p["threshold_growth_rate_decrease_stress"] != -1) & (p["delay_stress_increase_min_generations"] != -1)
+                    & (p["dose_increase_factor"] != -1)
+                    & ~(self.measured_growth_rate > p["threshold_growth_rate_decrease_stress"]))
+        target_dose = np.select(
+            [before_first_drug & diluted_before,
+             before_first_drug,
+             first_drug,
+             increase,
+             decrease,
+             ~diluted_before],
+            [self.dose,
+             p["pump1_stock_drug_concentration"],
+             p["dose_first_drug_addition"],
+             np.round(self.dose * p["dose_increase_factor"] + p["dose_increase_amount"], 3),
+             p["pump1_stock_drug_concentration"],
+             p["dose_initialization"]],
+            default=self.dose)
+        target_dose = np.where(initialize, p["dose_initialization"], target_dose)
+        return target_dose, initialize | adjust
+
+    def _dilute(self, minute, mask, target_dose):
+        """
+        CultureGrowthModel.dilute_culture for the masked cultures
+        :return: (mask of the diluted cultures, added effective dose of each)
+        """
+        p = {name: values[mask] for name, values in self.parameters.items()}
+        target_dose = target_dose[mask]
+        dilution_factor = p["dilution_factor"]
+        current_volume = p["volume_vial"]
+        added_volume = current_volume * (dilution_factor - 1)
+        total_volume = current_volume + added_volume
+        stock1 = p["pump1_stock_drug_concentration"]
+        stock2 = p["pump2_stock_drug_concentration"]
+        current_dose = np.where(self.n_dilutions[mask] > 0, self.dose[mask], stock1)
+
+        too_large = total_volume > self.max_total_volume
+        if np.any(too_large):
+            failed = np.flatnonzero(mask)[too_large]
+            self.failed[failed] = True
+            mask = mask.copy()
+            mask[failed] = False
+            keep = ~too_large
+            p = {name: values[keep] for name, values in p.items()}
+            target_dose, dilution_factor, current_volume = target_dose[keep], dilution_factor[keep], current_volume[keep]
+            added_volume, total_volume = added_volume[keep], total_volume[keep]
+            stock1, stock2, current_dose = stock1[keep], stock2[keep], current_dose[keep]
+
+        only_pump1_dose = (current_dose * current_volume + stock1 * added_volume) / total_volume
+        only_pump2_dose = (current_dose * current_volume + stock2 * added_volume) / total_volume
+        target_dose = np.minimum(np.maximum(only_pump1_dose, only_pump2_dose),
+                                 np.maximum(np.minimum(only_pump1_dose, only_pump2_dose), target_dose))
+        added_concentration = (target_dose * total_volume - current_dose * current_volume) / added_volume
+        equal_stocks = np.abs(stock1 - stock2) < 1e-10
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pump1_volume = np.where(equal_stocks, added_volume / 2,
+                                    added_volume * (stock2 - added_concentration) / (stock2 - stock1))
+        pump1_volume = np.maximum(0, np.minimum(pump1_volume, added_volume))
+        pump2_volume = added_volume - pump1_volume
+        new_dose = (current_dose * current_volume + stock1 * pump1_volume + stock2 * pump2_volume) / total_volume
+
+        first_dilution = self.n_dilutions[mask] == 0
+        dose_changed = np.round(new_dose, 3) != np.round(self.dose[mask], 3)
+        generation = self.generation[mask] + np.log2(dilution_factor)
+        self.generation_at_dose_change[mask] = np.where(
+            first_dilution, generation,
+            np.where(dose_changed, self.generation[mask], self.generation_at_dose_change[mask]))
+        added_dose = new_dose - np.where(first_dilution, 0, self.dose[mask])
+
+        self.pump1_volume[mask] += pump1_volume
+        self.pump2_volume[mask] += pump2_volume
+        self.waste_volume[mask] += added_volume
+        self.dose[mask] = new_dose
+        self.population[mask] /= dilution_factor
+        self.generation[mask] = generation
+        self.n_dilutions[mask] += 1
+        self.last_dilution_minute[mask] = minute
+        return mask, added_dose
+
+    def get_simulation_efficiency(self):
+        """:return: arrays (volume per IC50 doubling, time per IC50 doubling) as get_simulation_efficiency"""
+        volume_used = self.n_dilutions * 10
+        ic50_fold_change = self.ic50 / self.parameters["ic50_initial"]
+        total_time = (self.n_minutes - 2) / 60
+        with np.errstate(divide="ignore", invalid="ignore"):
+            volume_per_ic50_doubling = volume_used / np.log2(ic50_fold_change)
+            time_per_ic50_doubling = total_time / np.log2(ic50_fold_change)
+        volume_per_ic50_doubling[self.failed] = np.nan
+        time_per_ic50_doubling[self.failed] = np.nan
+        return volume_per_ic50_doubling, time_per_ic50_doubling
+
+    def results(self):
+        """:return: list with the parameters, efficiency metrics and final state of every candidate"""
+        volume_per_ic50_doubling, time_per_ic50_doubling = self.get_simulation_efficiency()
+
+        def number(value):
+            value = float(value)
+            return value if np.isfinite(value) else None
+
+        results = []
+        for i, candidate in enumerate(self.candidates):
+            results.append({
+                "parameters": candidate,
+                "volume_per_ic50_doubling": number(volume_per_ic50_doubling[i]),
+                "time_per_ic50_doubling": number(time_per_ic50_doubling[i]),
+                "ic50_fold_change": number(self.ic50[i] / self.parameters["ic50_initial"][i]),
+                "n_dilutions": int(self.n_dilutions[i]),
+                "final_population": number(self.population[i]),
+                "final_dose": number(self.dose[i]),
+                "final_ic50": number(self.ic50[i]),
+                "final_generation": number(self.generation[i]),
+                "final_effective_growth_rate": number(self.growth_rate[i]),
+                "pump1_volume_used": number(self.pump1_volume[i]),
+                "pump2_volume_used": number(self.pump2_volume[i]),
+                "waste_medium_volume_created": number(self.waste_volume[i]),
+                "error": "Total volume during dilution cannot exceed 30 ml" if self.failed[i] else None,
+            })
+        return results
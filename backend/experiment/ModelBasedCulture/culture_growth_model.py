@@ -1,8 +1,11 @@
+import copy
 from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
 import numpy as np
 
-from .model_equations import dose_effective, mu_effective, adaptation_rate
+from .model_equations import GrowthEquations
+from .simulation_state import SimulationSeries
+from .ode_integration import simulate_experiment_ode
 
 culture_growth_model_default_parameters = {
     'initial_population': 0.05,
@@ -21,8 +24,8 @@ culture_growth_model_default_parameters = {
 def get_simulation_efficiency(model):
     # print("d50: {}, dilution_count: {}, effective_dose: {}".format(model.ic50_initial, len(model.doses), model.effective_dose))
     volume_used = len(model.doses) * 10
-    ic50_fold_change = model.ic50s[-1][0] / model.ic50s[0][0]
-    total_time = (model.population[-1][1] - model.population[0][1]).total_seconds() / 3600
+    ic50_fold_change = model.ic50s.values[-1] / model.ic50s.values[0]
+    total_time = (model.population.minutes[-1] - model.population.minutes[0]) / 60
     # print("Volume Used: {:.1f} ml, IC50 fold change: {:.2f}".format(volume_used, ic50_fold_change))
     volume_per_ic50_doubling = volume_used / np.log2(ic50_fold_change)
     # print("Volume per IC50 doubling: {:.1f} ml".format(volume_per_ic50_doubling))
@@ -33,7 +36,7 @@ def get_simulation_efficiency(model):
 
 class CultureGrowthModel:
     def __init__(self, **kwargs):
-        defaults = culture_growth_model_default_parameters
+        defaults = culture_growth_model_default_parameters.copy()
         # Update defaults with any overrides provided at initialization
         defaults.update(kwargs)
         # Assign all default values to instance variables
@@ -42,26 +45,51 @@ class CultureGrowthModel:
 
         # Calculate maximum growth rate from doubling time
         self.mu_max = np.log(2) / (self.doubling_time_mins / 60)
+        self.equations = GrowthEquations.from_parameters(self, mu_max=self.mu_max)
         self._initialize_model_state()
         self.updater = None
         self.vial = "simulated"
 
     def _initialize_model_state(self):
-        self.time_current = datetime.now()
-        self.population = []
-        self.generations = []
-        self.doses = []
-        self.effective_doses = []
-        self.ic50s = [(self.ic50_initial, self.time_current)]
-        self.effective_growth_rates = []
-        self.adaptation_rates = []
+        # simulation time advances in whole minutes from start_time, series store the minute of every value
+        self.start_time = datetime.now()
+        self.minute = 0
+        self.population = SimulationSeries(self.start_time)
+        self.generations = SimulationSeries(self.start_time, capacity=64)
+        self.doses = SimulationSeries(self.start_time, capacity=64)
+        self.effective_doses = SimulationSeries(self.start_time)
+        self.ic50s = SimulationSeries(self.start_time)
+        self.ic50s.append(self.ic50_initial, self.minute)
+        self.effective_growth_rates = SimulationSeries(self.start_time)
+        self.adaptation_rates = SimulationSeries(self.start_time)
         self.pump1_volumes = []
         self.pump2_volumes = []
         self.waste_medium_created = []
+        self._reset_effective_dose_state()
+
+    def _reset_effective_dose_state(self):
+        # see calculate_effective_dose
+        self._settled_effective_dose = None
+        self._active_added_doses = np.zeros(0)
+        self._active_dilution_times_us = np.zeros(0, dtype=np.int64)
+        self._n_doses_seen = 0
+        self._last_effective_dose_time = None
+
+    def _series(self):
+        return [self.population, self.generations, self.doses, self.effective_doses, self.ic50s,
+                self.effective_growth_rates, self.adaptation_rates]
+
+    @property
+    def time_current(self):
+        return self.start_time + timedelta(minutes=self.minute)
+
+    @time_current.setter
+    def time_current(self, value):
+        self.minute = (value - self.start_time) // timedelta(minutes=1)
 
     @property
     def growth_rate(self):
-        return self.effective_growth_rates[-1][0] if self.effective_growth_rates else 0
+        return self.effective_growth_rates.last_value() if self.effective_growth_rates else 0
 
     @property
     def first_od_timestamp(self):
@@ -73,22 +101,51 @@ class CultureGrowthModel:
         """
         Calculate the effective dose of the drug at the current time, taking into account the doses added,
         the time since each addition and the lag time before the drug reaches half of its effectiveness.
+
+        Computed incrementally: dose additions whose sigmoid transition has finished (dose_effective returns
+        exactly the added dose) are folded into a settled baseline in the order they were added, only the
+        still ramping additions are evaluated, vectorized, and summed in order. The result is identical to
+        summing over all past additions. The state is rebuilt if doses are removed or time goes backwards.
         """
         if not self.effective_doses:
             current_effective_dose = self.updater.pump1_stock_drug_concentration
-            self.effective_doses.append((current_effective_dose, self.time_current))
-        effective_dose = self.effective_doses[0][0]  # Initial effective dose
-        initial_equilibrium_dose = 0
-        added_doses = np.diff([initial_equilibrium_dose]+[dose[0] for dose in self.doses])
-        dilution_times = [dose[1] for dose in self.doses[0:]]
-        # print(added_doses)
-        for added_dose, dilution_time in zip(added_doses, dilution_times):
-            if added_dose == 0:
-                continue
-            time_since_addition_hrs = (time_current - dilution_time).total_seconds() / 3600.0  # Convert to hours
-            effective_dose += dose_effective(added_dose, self.time_lag_drug_effect_mins / 60,
-                                             time_since_addition_hrs, self.dose_effective_slope_width_mins / 60)  # Assuming lag_time is in minutes
-            # print("Effective Dose at time {}: {}".format(time_current, effective_dose))
+            self.effective_doses.append(current_effective_dose, self.minute)
+        if len(self.doses) < self._n_doses_seen or (self._last_effective_dose_time is not None
+                                                    and time_current < self._last_effective_dose_time):
+            self._reset_effective_dose_state()
+        if self._settled_effective_dose is None:
+            self._settled_effective_dose = self.effective_doses[0][0]  # Initial effective dose
+        self._last_effective_dose_time = time_current
+
+        if len(self.doses) > self._n_doses_seen:
+            initial_equilibrium_dose = 0
+            previous_dose = self.doses.values[self._n_doses_seen - 1] if self._n_doses_seen > 0 else initial_equilibrium_dose
+            added_doses = np.diff(np.concatenate([[previous_dose], self.doses.values[self._n_doses_seen:]]))
+            dilution_times_us = self.doses.minutes[self._n_doses_seen:] * (60 * 10 ** 6)
+            nonzero = added_doses != 0
+            self._active_added_doses = np.concatenate([self._active_added_doses, added_doses[nonzero]])
+            self._active_dilution_times_us = np.concatenate([self._active_dilution_times_us,
+                                                             dilution_times_us[nonzero]])
+            self._n_doses_seen = len(self.doses)
+
+        effective_dose = self._settled_effective_dose
+        if len(self._active_added_doses) == 0:
+            return effective_dose
+        time_current_us = (time_current - self.start_time) // timedelta(microseconds=1)
+        time_since_addition_hrs = (time_current_us - self._active_dilution_times_us) / 10 ** 6 / 3600.0
+        effective_added_doses = self.equations.dose_effective(self._active_added_doses, time_since_addition_hrs)
+        n_settled = 0
+        settling = True
+        for added_dose, effective_added_dose in zip(self._active_added_doses, effective_added_doses):
+            effective_dose += effective_added_dose
+            if settling and effective_added_dose == added_dose:
+                n_settled += 1
+                self._settled_effective_dose = effective_dose
+            else:
+                settling = False
+        if n_settled > 0:
+            self._active_added_doses = self._active_added_doses[n_settled:]
+            self._active_dilution_times_us = self._active_dilution_times_us[n_settled:]
         return effective_dose
 
     def simulate_experiment_minute(self):
@@ -103,25 +160,23 @@ class CultureGrowthModel:
         Dilute the culture if needed.
         """
         effective_dose = self.calculate_effective_dose(self.time_current)
-        self.effective_doses.append((effective_dose, self.time_current))
+        self.effective_doses.append(effective_dose, self.minute)
         if self.population:
-            effective_growth_rate = mu_effective(effective_dose, self.mu_min, self.mu_max, self.ic10_ic50_ratio,
-                                                 self.ic50s[-1][0], self.population[-1][0], self.carrying_capacity)
-            self.effective_growth_rates.append((effective_growth_rate, self.time_current))
+            effective_growth_rate = self.equations.mu_effective(effective_dose, self.ic50s.last_value(),
+                                                                self.population.last_value())
+            self.effective_growth_rates.append(effective_growth_rate, self.minute)
 
         if effective_dose > 0:
-            adapt_rate = adaptation_rate(effective_dose, self.adaptation_rate_max, self.ic50s[-1][0],
-                                         self.ic10_ic50_ratio,
-                                         self.adaptation_rate_ic10_ic50_ratio)
-            self.adaptation_rates.append((adapt_rate, self.time_current))
+            adapt_rate = self.equations.adaptation_rate(effective_dose, self.ic50s.last_value())
+            self.adaptation_rates.append(adapt_rate, self.minute)
 
-            ic50 = self.ic50s[-1][0] * np.exp(adapt_rate / 60)
-            self.ic50s.append((ic50, self.time_current))
+            ic50 = self.ic50s.last_value() * np.exp(adapt_rate / 60)
+            self.ic50s.append(ic50, self.minute)
         if not self.population:
             new_population = self.initial_population
         else:
-            new_population = self.population[-1][0] * np.exp(effective_growth_rate / 60)
-        self.population.append((new_population, self.time_current))
+            new_population = self.population.last_value() * np.exp(effective_growth_rate / 60)
+        self.population.append(new_population, self.minute)
         self.updater.update(model=self)
 
     def dilute_culture(self, target_dose=0, dilution_factor=None):
@@ -142,7 +197,7 @@ class CultureGrowthModel:
         if not self.doses:
             current_dose = stock1_concentration
         else:
-            current_dose = self.doses[-1][0]
+            current_dose = self.doses.last_value()
 
         # Calculate resulting doses for each pump
         only_pump1_resulting_dose = (current_dose * current_volume + stock1_concentration * added_volume) / total_volume
@@ -178,12 +233,12 @@ class CultureGrowthModel:
         self.waste_medium_created.append(added_volume)
 
         new_dose = (current_dose * current_volume + stock1_concentration * pump1_volume + stock2_concentration * pump2_volume) / total_volume
-        self.doses.append((new_dose, self.time_current))
-        self.population[-1] = (self.population[-1][0] / dilution_factor, self.time_current)
+        self.doses.append(new_dose, self.minute)
+        self.population.set_last(self.population.last_value() / dilution_factor, self.minute)
         generation_number = np.log2(dilution_factor)
         if self.generations:
-            generation_number += self.generations[-1][0]
-        self.generations.append((generation_number, self.time_current))
+            generation_number += self.generations.last_value()
+        self.generations.append(generation_number, self.minute)
         
     def check_parameters(self):
         if self.initial_population < 0:
@@ -203,15 +258,43 @@ class CultureGrowthModel:
         if self.adaptation_rate_max < 0:
             raise ValueError("Maximum adaptation rate cannot be negative")
 
-    def simulate_experiment(self, simulation_hours=48):
+    def simulate_experiment(self, simulation_hours=48, method="minute"):
         """
         Simulate bacterial growth over a specified period, with a change in drug dose after 3 dilutions.
+        :param method: "minute" for fixed one-minute steps, "ode" for adaptive ODE integration between
+            dilutions (see ode_integration.simulate_experiment_ode)
         """
         self.check_parameters()
-        for t in range(1, int(simulation_hours * 60)):
-            self.time_current += timedelta(minutes=1)
+        self.equations = GrowthEquations.from_parameters(self, mu_max=self.mu_max)
+        if method == "ode":
+            return simulate_experiment_ode(self, simulation_hours=simulation_hours)
+        if method != "minute":
+            raise ValueError("Unknown simulation method %s" % method)
+        n_minutes = int(simulation_hours * 60)
+        for series in self._series():
+            series.reserve(len(series) + n_minutes + 1)
+        for t in range(1, n_minutes):
+            self.minute += 1
             self.simulate_experiment_minute()
 
+    def truncated(self, simulation_hours):
+        """
+        :return: copy of a simulated model holding only the first simulation_hours, identical to a model
+            simulated for simulation_hours since the simulation of every minute only depends on the past
+        """
+        n_minutes = int(simulation_hours * 60)
+        model = copy.copy(self)
+        model.minute = min(self.minute, max(n_minutes - 1, 0))
+        for name in ["population", "generations", "doses", "effective_doses", "ic50s",
+                     "effective_growth_rates", "adaptation_rates"]:
+            setattr(model, name, getattr(self, name).truncated(model.minute))
+        n_doses = len(model.doses)
+        model.pump1_volumes = self.pump1_volumes[:n_doses]
+        model.pump2_volumes = self.pump2_volumes[:n_doses]
+        model.waste_medium_created = self.waste_medium_created[:n_doses]
+        model._reset_effective_dose_state()
+        return model
+
     def plot_parameters(self):
         from .model_equations import dose_effective, mu_effective, adaptation_rate
         from .model_equations_plotting import plot_dose_effective, plot_mu_effective, \
@@ -225,14 +308,14 @@ class CultureGrowthModel:
         self.simulate_experiment(simulation_hours)
 
         # population, doses, effective_growth_rates, ic50s, adaptation_rates, effective_doses
-        times = [p[1] for p in self.population]
-        ods = [p[0] for p in self.population]
-        growth_rates, times_growth_rates = zip(*self.effective_growth_rates)
-        d50_values, times_d50s = zip(*self.ic50s)
-        doses_values, times_doses = zip(*self.doses)
+        times = self.population.timestamps()
+        ods = self.population.values
+        growth_rates, times_growth_rates = self.effective_growth_rates.values, self.effective_growth_rates.timestamps()
+        d50_values, times_d50s = self.ic50s.values, self.ic50s.timestamps()
+        doses_values, times_doses = tuple(self.doses.values), tuple(self.doses.timestamps())
         adaptation_rates = self.adaptation_rates
-        effective_dose_values, times_effective_doses = zip(*self.effective_doses)
-        generations, times_generations = zip(*self.generations)
+        effective_dose_values, times_effective_doses = self.effective_doses.values, self.effective_doses.timestamps()
+        generations, times_generations = self.generations.values, self.generations.timestamps()
 
 
 
@@ -268,7 +351,7 @@ class CultureGrowthModel:
 
         # Setup Adaptation Rate secondary y-axis (ax5)
         if len(adaptation_rates)>0:
-            adaptation_values, times_adaptation = zip(*adaptation_rates)
+            adaptation_values, times_adaptation = adaptation_rates.values, adaptation_rates.timestamps()
 
             ax5 = ax1.twinx()
             ax5.plot(times_adaptation, adaptation_values, 'o-', color='xkcd:violet', label='Adaptation Rate [1/h]', markersize=2, alpha=0.5)
@@ -0,0 +1,78 @@
+import numpy as np
+
+from .batch_simulation import BatchCultureSimulator, SHARED_PARAMETERS
+from .culture_growth_model import culture_growth_model_default_parameters
+from .morbidostat_updater import morbidostat_updater_default_parameters
+from .parameter_fit import FIT_BOUNDS
+
+DEFAULT_PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def sample_parameters(parameters, parameter_uncertainty, n_replicates, rng):
+    """
+    :param parameter_uncertainty: dictionary name -> relative standard deviation, every replicate gets
+        value * exp(N(0, sd)) (log-normal, keeps the sign of the value). Growth parameters with a valid range
+        (FIT_BOUNDS) are clipped to it, e.g. an IC10/IC50 ratio of 1 or more would invert the dose response.
+    :return: list of n_replicates parameter dictionaries
+    """
+    for name in parameter_uncertainty:
+        if name in SHARED_PARAMETERS:
+            raise ValueError("%s cannot vary between replicates" % name)
+        if name not in parameters:
+            raise ValueError("Unknown simulation parameter %s" % name)
+        if parameters[name] == -1:
+            raise ValueError("%s is disabled (-1) and cannot vary between replicates" % name)
+    samples = {name: float(parameters[name]) * np.exp(rng.normal(0, float(sd), n_replicates))
+               for name, sd in parameter_uncertainty.items()}
+    for name, values in samples.items():
+        if name in FIT_BOUNDS:
+            lower, upper, scale = FIT_BOUNDS[name]
+            np.clip(values, lower, upper, out=values)
+    return [{name: float(values[i]) for name, values in samples.items()} for i in range(n_replicates)]
+
+
+def simulate_ensemble(growth_parameters, updater_parameters, n_replicates=200, simulation_hours=48,
+                      od_noise=0.005, growth_rate_noise=0.05, parameter_uncertainty=None, washout_od=0.01,
+                      record_every_minutes=10, percentiles=None, seed=None):
+    """
+    Simulate n_replicates replicates of a culture at once (BatchCultureSimulator), with noisy OD and growth
+    rate measurements for the updater and replicate-specific growth and updater parameters drawn from
+    parameter_uncertainty.
+
+    :param washout_od: a replicate is washed out if its population falls below this OD
+    :return: dictionary with the percentile bands of OD, dose and IC50 over time, the washout probability
+        and the distribution of the final state
+    """
+    percentiles = DEFAULT_PERCENTILES if percentiles is None else percentiles
+    rng = np.random.default_rng(seed)
+    parameters = dict(culture_growth_model_default_parameters)
+    parameters.update(morbidostat_updater_default_parameters)
+    for given in [growth_parameters, updater_parameters]:
+        parameters.update({name: value for name, value in given.items() if name in parameters})
+    candidates = sample_parameters(parameters, parameter_uncertainty or {}, n_replicates, rng)
+    simulator = BatchCultureSimulator(candidates, growth_parameters=growth_parameters,
+                                      updater_parameters=updater_parameters, od_noise=od_noise,
+                                      growth_rate_noise=growth_rate_noise, seed=rng)
+    simulator.simulate(simulation_hours=simulation_hours, record_every_minutes=record_every_minutes)
+
+    bands = {}
+    for name, records in [("od", simulator.records["population"]), ("dose", simulator.records["dose"]),
+                          ("ic50", simulator.records["ic50"])]:
+        values = np.percentile(records, percentiles, axis=1) if len(records) else np.zeros((len(percentiles), 0))
+        bands[name] = {"p%g" % q: band.tolist() for q, band in zip(percentiles, values)}
+    washed_out = simulator.min_population < washout_od
+    ic50_fold_change = simulator.ic50 / simulator.parameters["ic50_initial"]
+    return {
+        "n_replicates": n_replicates,
+        "simulation_hours": simulation_hours,
+        "times_hours": (simulator.record_minutes / 60).tolist(),
+        "percentiles": list(percentiles),
+        "bands": bands,
+        "washout_od": washout_od,
+        "washout_probability": float(np.mean(washed_out)),
+        "volume_error_probability": float(np.mean(simulator.failed)),
+        "final_ic50_fold_change": {"p%g" % q: float(v) for q, v in
+                                   zip(percentiles, np.percentile(ic50_fold_change, percentiles))},
+        "n_dilutions": {"p%g" % q: float(v) for q, v in
+                        zip(percentiles, np.percentile(simulator.n_dilutions, percentiles))},
+    }
@@ -1,5 +1,96 @@
+"""
+Growth model equations. All functions are broadcast-safe: every argument may be a scalar or a NumPy array, and
+arrays of doses, times, populations and parameters broadcast against each other (e.g. doses[:, None] against
+parameter arrays of a batch of cultures).
+
+The steepness constants depend only on the model parameters. The *_steepness functions compute them, the
+*_from_steepness variants take them precomputed, and GrowthEquations holds them for a parameter set, so that
+simulations evaluating the equations every step compute them only once.
+"""
 import numpy as np
 
+LOG_9 = np.log(9)
+LOG_19 = np.log(19)
+
+
+def mu_steepness(ic10_ic50_ratio):
+    """:return: ic50 * k_mu, the slope constant of the growth rate sigmoid relative to the ic50"""
+    return LOG_9 / (1 - ic10_ic50_ratio)
+
+
+def dose_effective_steepness(slope_width_hrs):
+    """:return: k of the effective dose sigmoid for a 5% to 95% transition over slope_width_hrs [1/hour]"""
+    return LOG_19 / (0.5 * slope_width_hrs)
+
+
+def adaptation_steepness(ic10_ic50_ratio, adaptation_rate_ic10_ic50_ratio):
+    """:return: ic50 ** 2 * k_adapt, the width constant of the adaptation rate curve relative to the ic50"""
+    return -np.log(adaptation_rate_ic10_ic50_ratio) / ((ic10_ic50_ratio - 1) ** 2)
+
+
+def mu_from_steepness(dose, mu_min, mu_max, ic50, steepness):
+    """mu with the precomputed mu_steepness"""
+    return mu_min + mu_max / (1 + np.exp(-steepness * (1 - dose / ic50)))
+
+
+def dose_effective_from_steepness(dose, lag_time_hrs, time_since_addition_hrs, k):
+    """dose_effective with the precomputed dose_effective_steepness k"""
+    return dose / (1 + np.exp(-k * (time_since_addition_hrs - lag_time_hrs)))
+
+
+def mu_effective_from_steepness(dose, mu_min, mu_max, ic50, population, carrying_capacity, steepness):
+    """mu_effective with the precomputed mu_steepness"""
+    return mu_min + mu_from_steepness(dose, 0, mu_max, ic50, steepness) * (1 - population / carrying_capacity)
+
+
+def adaptation_rate_from_steepness(dose, adaptation_rate_max, ic50, steepness):
+    """adaptation_rate with the precomputed adaptation_steepness"""
+    relative_dose = dose / ic50
+    return adaptation_rate_max * np.exp(-steepness * (relative_dose - 1) ** 2) * relative_dose ** 2
+
+
+class GrowthEquations:
+    """
+    The model equations for one set of growth parameters, or for arrays of parameter sets of a batch of
+    cultures, with the steepness constants computed once.
+    """
+
+    def __init__(self, mu_min, mu_max, ic10_ic50_ratio, carrying_capacity, time_lag_drug_effect_mins,
+                 dose_effective_slope_width_mins, adaptation_rate_max, adaptation_rate_ic10_ic50_ratio):
+        self.mu_min = mu_min
+        self.mu_max = mu_max
+        self.carrying_capacity = carrying_capacity
+        self.lag_time_hrs = time_lag_drug_effect_mins / 60
+        self.adaptation_rate_max = adaptation_rate_max
+        self.mu_steepness = mu_steepness(ic10_ic50_ratio)
+        self.dose_effective_steepness = dose_effective_steepness(dose_effective_slope_width_mins / 60)
+        with np.errstate(divide="ignore"):
+            self.adaptation_steepness = adaptation_steepness(ic10_ic50_ratio, adaptation_rate_ic10_ic50_ratio)
+
+    @classmethod
+    def from_parameters(cls, parameters, mu_max=None):
+        """
+        :param parameters: CultureGrowthModel or dictionary of growth parameters (scalars or arrays)
+        :param mu_max: maximum growth rate, computed from doubling_time_mins if not given
+        """
+        get = (lambda name: getattr(parameters, name)) if not isinstance(parameters, dict) else parameters.__getitem__
+        if mu_max is None:
+            mu_max = np.log(2) / (get("doubling_time_mins") / 60)
+        return cls(get("mu_min"), mu_max, get("ic10_ic50_ratio"), get("carrying_capacity"),
+                   get("time_lag_drug_effect_mins"), get("dose_effective_slope_width_mins"),
+                   get("adaptation_rate_max"), get("adaptation_rate_ic10_ic50_ratio"))
+
+    def mu_effective(self, dose, ic50, population):
+        return mu_effective_from_steepness(dose, self.mu_min, self.mu_max, ic50, population, self.carrying_capacity,
+                                           self.mu_steepness)
+
+    def dose_effective(self, dose, time_since_addition_hrs):
+        return dose_effective_from_steepness(dose, self.lag_time_hrs, time_since_addition_hrs,
+                                             self.dose_effective_steepness)
+
+    def adaptation_rate(self, dose, ic50):
+        return adaptation_rate_from_steepness(dose, self.adaptation_rate_max, ic50, self.adaptation_steepness)
+
 
 def mu(dose, mu_min, mu_max, ic10_ic50_ratio, ic50):
     """
@@ -10,10 +101,7 @@ def mu(dose, mu_min, mu_max, ic10_ic50_ratio, ic50):
     d50: dose at which the growth rate is half of mu_max (ic50)
     return: growth rate
     """
-
-    dose_ic10 = ic50 * ic10_ic50_ratio
-    k_mu = np.log(9) / (ic50 - dose_ic10)
-    return mu_min + (mu_max / (1 + np.exp(-k_mu * (ic50 - dose))))
+    return mu_from_steepness(dose, mu_min, mu_max, ic50, mu_steepness(ic10_ic50_ratio))
 
 
 def dose_effective(dose, lag_time_hrs, time_since_addition_hrs, slope_width_hrs):
@@ -30,16 +118,9 @@ def dose_effective(dose, lag_time_hrs, time_since_addition_hrs, slope_width_hrs)
     Returns:
     - The effective dose, varying between 0 and the total dose.
     """
-    # Calculate the value of k using the slope_width_hrs to achieve the desired 5% to 95% transition
-    k = np.log(19) / (0.5 * slope_width_hrs)  # Based on solving the sigmoid function for 5% and 95%
-
-    # Adjust x to shift the sigmoid curve so that the inflection point is at the lag time
-    x_value = (time_since_addition_hrs - lag_time_hrs)
-
-    # Apply the sigmoid function to calculate the effective dose
-    effective_dose = dose / (1 + np.exp(-k * x_value))
-    # print("time_since_addition_hrs: {}, effective_dose: {}".format(time_since_addition_hrs, effective_dose))
-    return effective_dose
+    # the sigmoid has its inflection point at the lag time, k gives the 5% to 95% transition over slope_width_hrs
+    return dose_effective_from_steepness(dose, lag_time_hrs, time_since_addition_hrs,
+                                         dose_effective_steepness(slope_width_hrs))
 
 
 def mu_effective(dose, mu_min, mu_max, ic10_ic50_ratio, ic50, population, carrying_capacity):
@@ -55,7 +136,8 @@ def mu_effective(dose, mu_min, mu_max, ic10_ic50_ratio, ic50, population, carryi
     return: effective growth rate
     """
     # print("dose: {}, mu_max: {}, ic10_ic50_ratio: {}, ic50: {}, population: {}, carrying_capacity: {}".format(dose, mu_max, ic10_ic50_ratio, ic50, population, carrying_capacity))
-    return mu_min + mu(dose, 0, mu_max, ic10_ic50_ratio, ic50) * (1 - population / carrying_capacity)
+    return mu_effective_from_steepness(dose, mu_min, mu_max, ic50, population, carrying_capacity,
+                                       mu_steepness(ic10_ic50_ratio))
 
 
 def adaptation_rate(dose, adaptation_rate_max, ic50, ic10_ic50_ratio, adaptation_rate_ic10_ic50_ratio):
@@ -75,13 +157,6 @@ def adaptation_rate(dose, adaptation_rate_max, ic50, ic10_ic50_ratio, adaptation
     Returns:
     - Adaptation rate based on the given dose and curve parameters.
     """
-
-    # Calculate k_adapt dynamically based on height_at_50
-    ic10 = ic50 * ic10_ic50_ratio
-    k_adapt = -np.log(adaptation_rate_ic10_ic50_ratio) / ((ic10 - ic50) ** 2)
-    
-    # Use a modified Gaussian that decays faster at low doses
-    # The dose/ic50 term ensures faster decay when dose << ic50
-    adapt_rate = adaptation_rate_max * np.exp(-k_adapt * ((dose - ic50) ** 2)) * (dose/ic50) ** 2
-    
-    return adapt_rate
+    # modified Gaussian in dose / ic50: the (dose / ic50) ** 2 term makes it decay faster when dose << ic50
+    return adaptation_rate_from_steepness(dose, adaptation_rate_max, ic50,
+                                          adaptation_steepness(ic10_ic50_ratio, adaptation_rate_ic10_ic50_ratio))
@@ -39,13 +39,15 @@ def plot_dose_effective(model=None, dose_effective=None):
         plt.plot(time_since_addition_hrs, effective_doses, label='Lag Time Constant = {} mins, Slope Width = {} mins'.format(lag_time_mins,
                                                                                        slope_width_mins), color='black', linewidth=2)
 
-    for lag_time_mins in [30, 120]:
-        for slope_width_mins in [30, 240]:
-            effective_doses = dose_effective(dose, lag_time_mins / 60, time_since_addition_hrs,
-                                             slope_width_hrs=slope_width_mins / 60)
-            plt.plot(time_since_addition_hrs, effective_doses,
-                     label='Lag Time Constant = {} mins, Slope Width = {} mins'.format(lag_time_mins,
-                                                                                       slope_width_mins),alpha=0.3, linestyle='--')
+    # all reference curves in one broadcast call: rows are (lag time, slope width) combinations
+    lag_times_mins = np.array([30, 30, 120, 120])
+    slope_widths_mins = np.array([30, 240, 30, 240])
+    effective_doses = dose_effective(dose, lag_times_mins[:, None] / 60, time_since_addition_hrs,
+                                     slope_width_hrs=slope_widths_mins[:, None] / 60)
+    for lag_time_mins, slope_width_mins, curve in zip(lag_times_mins, slope_widths_mins, effective_doses):
+        plt.plot(time_since_addition_hrs, curve,
+                 label='Lag Time Constant = {} mins, Slope Width = {} mins'.format(lag_time_mins,
+                                                                                   slope_width_mins),alpha=0.3, linestyle='--')
     plt.xlabel('Time Since Drug Addition (hours)')
     plt.ylabel('Effective Dose (% actual dose)')
     plt.title('Drug effect lag afer addition')
@@ -65,10 +67,11 @@ def plot_mu_effective(model=None, mu_effective=None):
     plt.figure(figsize=(10, 6))
 
     doses = np.linspace(0, max_dose, 101)
-    for population in [f * carrying_capacity for f in [0.1, 0.3, 0.6, 0.9]]:
-        mu_values = mu_effective(doses, mu_min=mu_min, mu_max=mu_max, ic10_ic50_ratio=ic10_ic50_ratio, ic50=ic50,
-                                 population=population, carrying_capacity=carrying_capacity)
-        plt.plot(doses, mu_values, label='Effective Growth Rate (Population={:.3f})'.format(population))
+    populations = np.array([0.1, 0.3, 0.6, 0.9]) * carrying_capacity
+    mu_values = mu_effective(doses, mu_min=mu_min, mu_max=mu_max, ic10_ic50_ratio=ic10_ic50_ratio, ic50=ic50,
+                             population=populations[:, None], carrying_capacity=carrying_capacity)
+    for population, curve in zip(populations, mu_values):
+        plt.plot(doses, curve, label='Effective Growth Rate (Population={:.3f})'.format(population))
     plt.axvline(x=ic50, color='red', linestyle='--', label='IC50 = {}'.format(ic50))
     plt.xlabel('Antibiotic Dose')
     plt.ylabel('Effective Growth Rate')
@@ -94,10 +97,10 @@ def plot_adaptation_rate(model=None, adaptation_rate=None):
         adapt_rates = adaptation_rate(doses, adaptation_rate_max, ic50, ic10_ic50_ratio, model.adaptation_rate_ic10_ic50_ratio)
         plt.plot(doses, adapt_rates, label='adaptation_rate_ic10_ic50_ratio = {}'.format(model.adaptation_rate_ic10_ic50_ratio), color='black')
     else:
-        for adaptation_rate_ic10_ic50_ratio in [0.1, 0.5, 0.95, 0.99]:
-            adapt_rates = adaptation_rate(doses, adaptation_rate_max, ic50, ic10_ic50_ratio,
-                                          adaptation_rate_ic10_ic50_ratio)
-            plt.plot(doses, adapt_rates,
+        ratios = np.array([0.1, 0.5, 0.95, 0.99])
+        adapt_rates = adaptation_rate(doses, adaptation_rate_max, ic50, ic10_ic50_ratio, ratios[:, None])
+        for adaptation_rate_ic10_ic50_ratio, curve in zip(ratios, adapt_rates):
+            plt.plot(doses, curve,
                      label='adaptation_rate_ic10_ic50_ratio = {}'.format(adaptation_rate_ic10_ic50_ratio))
 
     plt.axvline(x=ic50, color='red', linestyle='--', label='IC50 = {}'.format(ic50))
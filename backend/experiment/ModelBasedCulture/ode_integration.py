@@ -0,0 +1,143 @@
+import math
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+
+RTOL = 1e-6
+ATOL = 1e-9
+
+
+class _Segment:
+    """Growth and adaptation of a culture between two updater checks, as an ODE in log population and log IC50"""
+
+    def __init__(self, model, start_minute):
+        self.model = model
+        self.equations = equations = model.equations
+        added_doses = np.diff(np.concatenate([[0], model.doses.values]))
+        addition_minutes = model.doses.minutes.astype(float)
+        nonzero = added_doses != 0
+        added_doses, addition_minutes = added_doses[nonzero], addition_minutes[nonzero]
+        # additions that are fully effective at the start stay so, they only shift the baseline
+        settled = equations.dose_effective(added_doses, (start_minute - addition_minutes) / 60) == added_doses
+        self.baseline = model.updater.pump1_stock_drug_concentration + added_doses[settled].sum()
+        self.added_doses = added_doses[~settled]
+        self.addition_minutes = addition_minutes[~settled]
+        self.added_dose_list = self.added_doses.tolist()
+        self.addition_minute_list = self.addition_minutes.tolist()
+        self.lag_hrs = float(equations.lag_time_hrs)
+        self.k = float(equations.dose_effective_steepness)
+
+    def effective_dose(self, minutes):
+        minutes = np.asarray(minutes, dtype=float)
+        if len(self.added_doses) == 0:
+            return np.full(minutes.shape, self.baseline, dtype=float)
+        time_since_addition_hrs = (minutes[..., None] - self.addition_minutes) / 60
+        return self.baseline + self.equations.dose_effective(self.added_doses, time_since_addition_hrs).sum(axis=-1)
+
+    def rates(self, minutes, population, ic50):
+        """:return: effective dose, effective growth rate and adaptation rate (0 without drug), per hour"""
+        effective_dose = self.effective_dose(minutes)
+        growth_rate = self.equations.mu_effective(effective_dose, ic50, population)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            adapt_rate = self.equations.adaptation_rate(effective_dose, ic50)
+        adapt_rate = np.where(effective_dose > 0, adapt_rate, 0.0)
+        return effective_dose, growth_rate, adapt_rate
+
+    def derivatives(self, minute, y):
+        """right hand side for solve_ivp, on Python floats: the solver calls it for single time points"""
+        population, ic50 = math.exp(y[0]), math.exp(y[1])
+        k = self.k
+        effective_dose = self.baseline
+        for added_dose, addition_minute in zip(self.added_dose_list, self.addition_minute_list):
+            effective_dose += added_dose / (1 + math.exp(-k * ((minute - addition_minute) / 60 - self.lag_hrs)))
+        growth_rate = self.equations.mu_effective(effective_dose, ic50, population)
+        adapt_rate = 0.0
+        if effective_dose > 0:
+            adapt_rate = self.equations.adaptation_rate(effective_dose, ic50)
+        return [growth_rate / 60, adapt_rate / 60]
+
+    def rk4_step(self, minute, y, step):
+        """single classic Runge-Kutta step, for pieces shorter than a minute"""
+        k1 = np.array(self.derivatives(minute, y))
+        k2 = np.array(self.derivatives(minute + step / 2, y + step / 2 * k1))
+        k3 = np.array(self.derivatives(minute + step / 2, y + step / 2 * k2))
+        k4 = np.array(self.derivatives(minute + step, y + step * k3))
+        return y + step / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def _next_check_minute(model, start_minute, end_minute):
+    """:return: minute at which the updater must be called at the latest, without an OD threshold crossing"""
+    updater = model.updater
+    stop_minute = end_minute
+    if updater.delay_dilution_max_hours >= 0 and model.doses:
+        time_triggered_minute = int(model.doses.minutes[-1] + math.ceil(updater.delay_dilution_max_hours * 60))
+        stop_minute = min(stop_minute, max(time_triggered_minute, start_minute + 1))
+    if 0 <= updater.od_dilution_threshold <= model.population.last_value():
+        # already above the threshold, the updater was waiting since the last dilution
+        wait_until = int(model.doses.minutes[-1]) + 4 if model.doses else start_minute + 1
+        stop_minute = min(stop_minute, max(wait_until, start_minute + 1))
+    return stop_minute
+
+
+def simulate_experiment_ode(model, simulation_hours=48, rtol=RTOL, atol=ATOL):
+    """
+    Simulate the culture like CultureGrowthModel.simulate_experiment, but integrate growth, IC50 adaptation and
+    the effective dose ramps as an ODE system with adaptive steps (scipy solve_ivp, RK45) between updater checks.
+
+    The updater is called only at the minutes when it can act: the first minute at or after the population
+    crosses the OD dilution threshold (found by event detection), the minute a time-triggered dilution is
+    due, and minute by minute while it must wait after a dilution. Dilutions change the state discontinuously
+    and start a new integration segment. The series are recorded on the same one-minute grid as the minute
+    model, from the dense output of the integrator.
+    """
+    n_minutes = int(simulation_hours * 60)
+    end_minute = model.minute + n_minutes - 1
+    if not model.population and model.minute < end_minute:
+        # first minute as in the minute model: initial population and initialization dilution
+        model.minute += 1
+        model.simulate_experiment_minute()
+
+    threshold = model.updater.od_dilution_threshold
+    while model.minute < end_minute:
+        start_minute = model.minute
+        stop_minute = _next_check_minute(model, start_minute, end_minute)
+        segment = _Segment(model, start_minute)
+        y0 = [math.log(model.population.last_value()), math.log(model.ic50s.last_value())]
+        events = None
+        if 0 <= threshold and model.population.last_value() < threshold:
+            def crosses_threshold(minute, y):
+                return y[0] - math.log(threshold)
+            crosses_threshold.terminal = True
+            crosses_threshold.direction = 1
+            events = crosses_threshold
+
+        minutes = np.arange(start_minute + 1, stop_minute + 1)
+        if stop_minute == start_minute + 1 and events is None:
+            y = segment.rk4_step(start_minute, np.array(y0), 1.0)[:, None]
+        else:
+            solution = solve_ivp(segment.derivatives, (start_minute, stop_minute), y0, method="RK45",
+                                 dense_output=True, events=events, rtol=rtol, atol=atol)
+            if not solution.success:
+                raise Exception("ODE integration failed at minute %d: %s" % (start_minute, solution.message))
+            if events is not None and len(solution.t_events[0]) > 0:
+                # the minute model checks the OD every minute: dilute at the first whole minute after the crossing
+                crossing_minute = solution.t_events[0][0]
+                stop_minute = min(stop_minute, max(start_minute + 1, math.ceil(crossing_minute)))
+                minutes = np.arange(start_minute + 1, stop_minute + 1)
+                y = solution.sol(minutes)
+                if stop_minute > crossing_minute:
+                    y[:, -1] = segment.rk4_step(crossing_minute, solution.y[:, -1], stop_minute - crossing_minute)
+            else:
+                y = solution.sol(minutes)
+        population, ic50 = np.exp(y[0]), np.exp(y[1])
+        effective_dose, growth_rate, adapt_rate = segment.rates(minutes, population, ic50)
+        with_drug = effective_dose > 0
+        model.effective_doses.extend(effective_dose, minutes)
+        model.effective_growth_rates.extend(growth_rate, minutes)
+        model.adaptation_rates.extend(adapt_rate[with_drug], minutes[with_drug])
+        model.ic50s.extend(ic50[with_drug], minutes[with_drug])
+        model.population.extend(population, minutes)
+
+        model.minute = stop_minute
+        model.updater.update(model=model)
@@ -0,0 +1,238 @@
+import time
+
+import numpy as np
+from scipy.optimize import minimize
+
+from .culture_growth_model import culture_growth_model_default_parameters
+from .model_equations import GrowthEquations, dose_effective_steepness
+
+# fitted growth parameters: (lower bound, upper bound, scale of the search)
+FIT_BOUNDS = {
+    'doubling_time_mins': (5, 600, "log"),
+    'ic50_initial': (1e-3, 1e4, "log"),
+    'ic10_ic50_ratio': (0.05, 0.95, "linear"),
+    'time_lag_drug_effect_mins': (0, 600, "linear"),
+    'dose_effective_slope_width_mins': (1, 600, "log"),
+    'adaptation_rate_max': (1e-4, 1, "log"),
+    'adaptation_rate_ic10_ic50_ratio': (0.01, 0.99, "linear"),
+}
+DEFAULT_FIT_PARAMETERS = list(FIT_BOUNDS)
+
+
+def to_unit(name, value):
+    """map a parameter value into the [0, 1] search box"""
+    lower, upper, scale = FIT_BOUNDS[name]
+    value = min(max(value, lower), upper)
+    if scale == "log":
+        return (np.log(value) - np.log(lower)) / (np.log(upper) - np.log(lower))
+    return (value - lower) / (upper - lower)
+
+
+def from_unit(name, x):
+    lower, upper, scale = FIT_BOUNDS[name]
+    if scale == "log":
+        return np.exp(np.log(lower) + x * (np.log(upper) - np.log(lower)))
+    return lower + x * (upper - lower)
+
+
+class RecordedCulture:
+    """
+    OD measurements and dilutions of a vial, times in minutes since the first OD measurement.
+    :param concentrations: drug concentration in the vial after each dilution
+    :param initial_concentration: concentration before the first dilution (pump 1 stock)
+    """
+
+    def __init__(self, od_minutes, ods, dilution_minutes, concentrations, initial_concentration=0.0):
+        order = np.argsort(od_minutes)
+        self.od_minutes = np.asarray(od_minutes, dtype=float)[order]
+        self.ods = np.asarray(ods, dtype=float)[order]
+        order = np.argsort(dilution_minutes)
+        self.dilution_minutes = np.asarray(dilution_minutes, dtype=float)[order]
+        self.concentrations = np.asarray(concentrations, dtype=float)[order]
+        self.initial_concentration = float(initial_concentration)
+
+    def __len__(self):
+        return len(self.ods)
+
+
+class CultureReplay:
+    """
+    Replays the recorded dose history of a vial through the CultureGrowthModel equations for a batch of
+    growth parameter sets at once, on a grid of step_minutes (exponential Euler steps, as the minute model).
+
+    The population is reset to the measured OD at the first measurement after every dilution, so the
+    growth between dilutions is predicted from the measured start (multiple shooting): the dilution volumes
+    are not needed and errors do not accumulate over the experiment. IC50 adaptation is carried through
+    the whole history. The effective dose of every addition follows its sigmoid ramp from the exact
+    dilution time.
+    """
+    min_od = 0.005  # measurements below are not fitted (log residuals of noise)
+    kernel_tolerance = 1e-9
+
+    def __init__(self, recorded, fixed_parameters, step_minutes=5):
+        self.recorded = recorded
+        self.fixed_parameters = dict(culture_growth_model_default_parameters)
+        self.fixed_parameters.update({name: value for name, value in fixed_parameters.items()
+                                      if name in self.fixed_parameters})
+        self.step_minutes = step_minutes
+        end_minute = recorded.od_minutes[-1] if len(recorded) else 0
+        self.grid = np.arange(0, end_minute + step_minutes, step_minutes, dtype=float)
+        od_index = np.minimum(np.round(recorded.od_minutes / step_minutes).astype(np.int64), len(self.grid) - 1)
+
+        # reset the population at the first measurement of the experiment and after every dilution
+        segment_of_od = np.searchsorted(recorded.dilution_minutes, recorded.od_minutes, side="left")
+        first_of_segment = np.ones(len(recorded), dtype=bool)
+        first_of_segment[1:] = segment_of_od[1:] != segment_of_od[:-1]
+        valid = recorded.ods > self.min_od
+        first_of_segment &= valid
+        self.reset_index = od_index[first_of_segment]
+        self.reset_od = recorded.ods[first_of_segment]
+        # fit every later valid measurement of a segment that has a reset
+        has_reset = np.isin(segment_of_od, segment_of_od[first_of_segment])
+        fitted = valid & has_reset & ~first_of_segment
+        self.fit_index = od_index[fitted]
+        self.log_ods = np.log(recorded.ods[fitted])
+
+        previous = np.concatenate([[recorded.initial_concentration], recorded.concentrations[:-1]])
+        self.added_doses = recorded.concentrations - previous
+        self.n_points = len(self.log_ods)
+
+    def _parameters(self, candidates):
+        """:return: dictionary name -> array over candidates"""
+        parameters = {name: np.full(len(candidates), float(value)) for name, value in self.fixed_parameters.items()}
+        for i, candidate in enumerate(candidates):
+            for name, value in candidate.items():
+                parameters[name][i] = value
+        return parameters
+
+    def _effective_doses(self, p):
+        """:return: effective dose on the grid for each candidate, shape (candidates, grid)"""
+        n = len(p["time_lag_drug_effect_mins"])
+        effective = np.full((n, len(self.grid)), self.recorded.initial_concentration)
+        if len(self.added_doses) == 0:
+            return effective
+        lag_hrs = p["time_lag_drug_effect_mins"][:, None] / 60
+        k = dose_effective_steepness(p["dose_effective_slope_width_mins"][:, None] / 60)
+        # the minute model applies an addition from the minute after the dilution
+        first = np.searchsorted(self.grid, self.recorded.dilution_minutes, side="right")
+        settled_after = np.max(lag_hrs - np.log(self.kernel_tolerance) / k) * 60
+        window = int(np.ceil(settled_after / self.step_minutes)) + 1
+        offsets = np.arange(window)
+        for addition_index, (start, added_dose, dilution_minute) in enumerate(
+                zip(first, self.added_doses, self.recorded.dilution_minutes)):
+            if added_dose == 0 or start >= len(self.grid):
+                continue
+            effective[:, start:] += added_dose
+            indices = start + offsets[start + offsets < len(self.grid)]
+            hours = (self.grid[indices] - dilution_minute) / 60
+            with np.errstate(over="ignore"):
+                effective[:, indices] += added_dose * (1 / (1 + np.exp(-k * (hours - lag_hrs))) - 1)
+        return effective
+
+    def residuals(self, candidates):
+        """
+        :param candidates: list of dictionaries with growth parameter values
+        :return: array (candidates, fitted points) of log(simulated OD) - log(measured OD)
+        """
+        p = self._parameters(candidates)
+        n = len(candidates)
+        effective_doses = self._effective_doses(p)
+        equations = GrowthEquations.from_parameters(p)
+        step_hrs = self.step_minutes / 60
+        reset_at = np.full(len(self.grid), -1, dtype=np.int64)
+        reset_at[self.reset_index] = np.arange(len(self.reset_index))
+        population = np.full(n, np.nan)
+        ic50 = p["ic50_initial"].copy()
+        log_population = np.empty((len(self.grid), n))
+        for j in range(len(self.grid)):
+            if reset_at[j] >= 0:
+                population = np.full(n, self.reset_od[reset_at[j]])
+            log_population[j] = np.log(population)
+            effective_dose = effective_doses[:, j]
+            with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+                growth_rate = equations.mu_effective(effective_dose, ic50, population)
+                adapt_rate = equations.adaptation_rate(effective_dose, ic50)
+            ic50 = np.where(effective_dose > 0, ic50 * np.exp(adapt_rate * step_hrs), ic50)
+            population = population * np.exp(growth_rate * step_hrs)
+        return log_population[self.fit_index].T - self.log_ods
+
+    def loss(self, candidates):
+        """:return: mean squared log OD residual of each candidate, inf where the simulation broke down"""
+        residuals = self.residuals(candidates)
+        loss = np.mean(residuals ** 2, axis=1)
+        return np.where(np.isfinite(loss), loss, np.inf)
+
+
+def _candidates(fit_names, xs):
+    return [{name: float(from_unit(name, x[i])) for i, name in enumerate(fit_names)} for x in xs]
+
+
+def _finite_difference_points(x, step):
+    """x and x + step along every axis (- step at the upper bound), :return: points, signed steps"""
+    points = [x]
+    steps = []
+    for i in range(len(x)):
+        h = step if x[i] + step <= 1 else -step
+        point = x.copy()
+        point[i] += h
+        points.append(point)
+        steps.append(h)
+    return points, np.array(steps)
+
+
+class _DeadlineReached(Exception):
+    pass
+
+
+def fit_from_start(replay, fit_names, x0, max_iterations=200, step=1e-4, deadline=None):
+    """
+    Minimize the replay loss from start point x0 (in the unit box) with L-BFGS-B. The loss and its forward
+    difference gradient are evaluated in a single batched replay of 1 + len(fit_names) parameter sets.
+    Runs in a worker process of the simulation pool.
+    :param deadline: time.time() after which the minimization stops with the best point evaluated so far
+    """
+    evaluations = [0]
+    best = {"x": list(x0), "loss": float("inf")}
+
+    def loss_and_gradient(x):
+        if deadline is not None and time.time() > deadline:
+            raise _DeadlineReached()
+        points, steps = _finite_difference_points(np.asarray(x, dtype=float), step)
+        losses = replay.loss(_candidates(fit_names, points))
+        evaluations[0] += 1
+        if not np.isfinite(losses[0]):
+            return 1e10, np.zeros(len(x))
+        if losses[0] < best["loss"]:
+            best.update(x=np.asarray(x, dtype=float).tolist(), loss=float(losses[0]))
+        gradient = np.where(np.isfinite(losses[1:]), (losses[1:] - losses[0]) / steps, 0.0)
+        return float(losses[0]), gradient
+
+    try:
+        result = minimize(loss_and_gradient, np.asarray(x0, dtype=float), jac=True, method="L-BFGS-B",
+                          bounds=[(0, 1)] * len(fit_names), options={"maxiter": max_iterations})
+    except _DeadlineReached:
+        return {"x": best["x"], "loss": best["loss"], "success": False, "message": "deadline reached",
+                "iterations": None, "evaluations": evaluations[0]}
+    return {"x": result.x.tolist(), "loss": float(result.fun), "success": bool(result.success),
+            "message": str(result.message), "iterations": int(result.nit), "evaluations": evaluations[0]}
+
+
+def fit_diagnostics(replay, fit_names, x, step=1e-4):
+    """
+    :return: RMSE of the log OD, and standard errors of the fitted parameters from the Gauss-Newton
+        approximation s^2 (J^T J)^-1 of the covariance, with the residual Jacobian J from forward differences
+    """
+    points, steps = _finite_difference_points(np.asarray(x, dtype=float), step)
+    residuals = replay.residuals(_candidates(fit_names, points))
+    jacobian = ((residuals[1:] - residuals[0]) / steps[:, None]).T  # points x parameters, unit box
+    n_points, n_parameters = jacobian.shape
+    dof = max(n_points - n_parameters, 1)
+    s2 = float(np.sum(residuals[0] ** 2) / dof)
+    covariance = s2 * np.linalg.pinv(jacobian.T @ jacobian)
+    standard_errors = {}
+    for i, name in enumerate(fit_names):
+        value_step = from_unit(name, min(x[i] + step, 1)) - from_unit(name, max(x[i] - step, 0))
+        x_step = min(x[i] + step, 1) - max(x[i] - step, 0)
+        standard_errors[name] = float(abs(value_step / x_step) * np.sqrt(max(covariance[i, i], 0)))
+    return {"rmse_log_od": float(np.sqrt(np.mean(residuals[0] ** 2))), "n_points": int(n_points),
+            "standard_errors": standard_errors}
@@ -6,8 +6,13 @@ class RealCultureWrapper:
     """
     Adapter class to convert the culture class to the model class.
     """
-    def __init__(self, culture):
+    def __init__(self, culture, dilution_requests=None):
+        """
+        :param dilution_requests: if a list is given, dilutions are not made but appended to it
+            as (target_dose, dilution_factor), to be executed later by a DilutionPlanner
+        """
         self.culture = culture
+        self.dilution_requests = dilution_requests
     
     @property
     def vial(self):
@@ -59,6 +64,9 @@ class RealCultureWrapper:
         self.print_updater_status()
         if dilution_factor is None:
             dilution_factor = self.culture.updater.dilution_factor
+        if self.dilution_requests is not None:
+            self.dilution_requests.append((target_dose, dilution_factor))
+            return
         self.culture.make_culture_dilution(target_dose, dilution_factor)
 
 
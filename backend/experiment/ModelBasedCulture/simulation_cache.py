@@ -0,0 +1,88 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+def parameter_hash(*parameter_dicts):
+    """:return: stable hash of parameter dictionaries, independent of key order"""
+    text = json.dumps(parameter_dicts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class SimulationCache:
+    """
+    Simulated CultureGrowthModels of the cultures, keyed by vial, simulation method and the hash of the growth
+    and updater parameters, least recently used entries are evicted beyond max_entries.
+
+    Only the longest simulated horizon is kept per key: a request for fewer simulation_hours is served by
+    truncating the cached model, a request for more hours reruns the simulation and replaces the entry.
+    Simulations run outside the lock, two requests for the same missing entry may both simulate.
+    """
+    max_entries = 32
+
+    def __init__(self, max_entries=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (vial, method, parameter hash) -> (simulation_hours, model)
+        self.hits = 0
+        self.truncated_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, vial, growth_parameters, updater_parameters, simulation_hours, method="minute"):
+        """:return: cached model for simulation_hours (shared with the cache, not to be modified) or None"""
+        key = (vial, method, parameter_hash(growth_parameters, updater_parameters))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < simulation_hours:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if entry[0] == simulation_hours:
+                return entry[1]
+            self.truncated_hits += 1
+            cached_model = entry[1]
+        return cached_model.truncated(simulation_hours)
+
+    def put(self, vial, growth_parameters, updater_parameters, simulation_hours, model, method="minute"):
+        key = (vial, method, parameter_hash(growth_parameters, updater_parameters))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < simulation_hours:
+                self.entries[key] = (simulation_hours, model)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_model(self, vial, growth_parameters, updater_parameters, simulation_hours, simulate, method="minute"):
+        """
+        :param simulate: callable running the simulation for simulation_hours, :return: the simulated model,
+            called on a cache miss
+        :return: simulated model, shared with the cache, not to be modified
+        """
+        model = self.get(vial, growth_parameters, updater_parameters, simulation_hours, method=method)
+        if model is None:
+            model = simulate(simulation_hours)
+            self.put(vial, growth_parameters, updater_parameters, simulation_hours, model, method=method)
+        return model
+
+    def invalidate(self, vial=None):
+        with self.lock:
+            for key in [key for key in self.entries if vial is None or key[0] == vial]:
+                del self.entries[key]
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "truncated_hits": self.truncated_hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / requests if requests else None,
+                    "cached": [{"vial": vial, "method": method, "simulation_hours": hours}
+                               for (vial, method, _), (hours, _) in self.entries.items()]}
+
+
+simulation_cache = SimulationCache()
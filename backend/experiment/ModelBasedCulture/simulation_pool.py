@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from logger.logger import logger
+from .batch_simulation import BatchCultureSimulator, parameter_grid
+from .culture_growth_model import CultureGrowthModel
+from .ensemble import simulate_ensemble
+from .morbidostat_updater import MorbidostatUpdater
+
+# simulation workers run at low priority on all but one core, the control threads of the API process keep
+# the GIL and a core for themselves
+WORKER_NICENESS = 10
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def simulate_culture(vial, growth_parameters, updater_parameters, simulation_hours, method="minute"):
+    """:return: CultureGrowthModel of the vial simulated for simulation_hours, picklable for the process pool"""
+    model = CultureGrowthModel(**growth_parameters)
+    model.vial = "%d(simulated)" % vial
+    model.updater = MorbidostatUpdater(**updater_parameters)
+    model.simulate_experiment(simulation_hours=simulation_hours, method=method)
+    return model
+
+
+def simulate_sweep(grid, growth_parameters, updater_parameters, simulation_hours):
+    """:return: BatchCultureSimulator results of every combination of the parameter values in grid"""
+    simulator = BatchCultureSimulator(parameter_grid(grid), growth_parameters=growth_parameters,
+                                      updater_parameters=updater_parameters)
+    return simulator.simulate(simulation_hours=simulation_hours).results()
+
+
+def simulation_summary(model):
+    """:return: final state and pump volumes of a simulated model"""
+    return {
+        "initial_population": model.initial_population,
+        "final_population": model.population.last_value() if model.population else None,
+        "final_effective_growth_rate": model.effective_growth_rates.last_value() if model.effective_growth_rates else None,
+        "final_dose": model.doses.last_value() if model.doses else None,
+        "final_generation": model.generations.last_value() if model.generations else None,
+        "initial_ic50": model.ic50_initial,
+        "final_ic50": model.ic50s.last_value() if model.ic50s else None,
+        "pump1_volume_used": sum(model.pump1_volumes),
+        "pump2_volume_used": sum(model.pump2_volumes),
+        "waste_medium_volume_created": sum(model.waste_medium_created),
+    }
+
+
+def _lower_priority():
+    try:
+        os.nice(WORKER_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def get_simulation_pool():
+    """
+    Process pool shared by all simulation requests, started on first use. Workers are spawned, not forked,
+    so they do not inherit the device threads and FTDI handles of the API process.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            max_workers = max(1, (os.cpu_count() or 2) - 1)
+            _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_lower_priority)
+            logger.info(f"Started simulation process pool with {max_workers} workers")
+        return _pool
+
+
+def _reset_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_simulations(jobs, simulation_hours, method="minute"):
+    """
+    Simulate several cultures in the process pool.
+    :param jobs: dictionary vial -> (growth_parameters, updater_parameters)
+    :return: generator of (vial, model, error) in the order the simulations finish, error is None on success
+    """
+    pool = get_simulation_pool()
+    futures = {}
+    try:
+        for vial, (growth_parameters, updater_parameters) in jobs.items():
+            futures[pool.submit(simulate_culture, vial, growth_parameters, updater_parameters,
+                                simulation_hours, method)] = vial
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                yield futures[future], None, e
+    except BrokenProcessPool:
+        logger.error("Simulation process pool broke, it will be restarted on the next request")
+        _reset_pool(pool)
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def run_in_pool(function, *args, **kwargs):
+    """run a module level function in the process pool, :return: its result, exceptions are raised here"""
+    pool = get_simulation_pool()
+    future = None
+    try:
+        future = pool.submit(function, *args, **kwargs)
+        return future.result()
+    except BrokenProcessPool:
+        logger.error("Simulation process pool broke, it will be restarted on the next request")
+        _reset_pool(pool)
+        raise
+    finally:
+        if future is not None:
+            future.cancel()
+
+
+def run_simulation_sweep(grid, growth_parameters, updater_parameters, simulation_hours):
+    """simulate_sweep in the process pool"""
+    return run_in_pool(simulate_sweep, grid, growth_parameters, updater_parameters, simulation_hours)
+
+
+def run_simulation_ensemble(growth_parameters, updater_parameters, **options):
+    """simulate_ensemble in the process pool"""
+    return run_in_pool(simulate_ensemble, growth_parameters, updater_parameters, **options)
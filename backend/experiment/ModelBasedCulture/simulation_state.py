@@ -0,0 +1,105 @@
+from datetime import timedelta
+
+import numpy as np
+
+
+class SimulationSeries:
+    """
+    Time series of a simulated culture in preallocated float64 columns: the values and the integer
+    simulation minute of each value. Timestamps are derived from the start time of the simulation
+    only when they are read.
+
+    Indexing and iteration give (value, datetime) tuples like the lists of the real culture
+    (RealCultureWrapper), so the MorbidostatUpdater works on both. Bulk readers (plots, summaries)
+    should use the values and minutes arrays or timestamps() instead.
+    """
+
+    def __init__(self, start_time, capacity=1024):
+        self.start_time = start_time
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._minutes = np.empty(capacity, dtype=np.int64)
+        self._length = 0
+
+    def reserve(self, capacity):
+        """make room for capacity values without reallocating"""
+        if capacity > len(self._values):
+            self._values = np.concatenate([self._values[:self._length],
+                                           np.empty(capacity - self._length, dtype=np.float64)])
+            self._minutes = np.concatenate([self._minutes[:self._length],
+                                            np.empty(capacity - self._length, dtype=np.int64)])
+
+    def append(self, value, minute):
+        if self._length == len(self._values):
+            self.reserve(max(2 * len(self._values), 16))
+        self._values[self._length] = value
+        self._minutes[self._length] = minute
+        self._length += 1
+
+    def truncated(self, max_minute):
+        """:return: copy of the series with the values up to and including max_minute"""
+        n = int(np.searchsorted(self.minutes, max_minute, side="right"))
+        series = SimulationSeries(self.start_time, capacity=max(n, 16))
+        series._values[:n] = self._values[:n]
+        series._minutes[:n] = self._minutes[:n]
+        series._length = n
+        return series
+
+    def extend(self, values, minutes):
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if self._length + n > len(self._values):
+            self.reserve(max(2 * len(self._values), self._length + n))
+        self._values[self._length:self._length + n] = values
+        self._minutes[self._length:self._length + n] = minutes
+        self._length += n
+
+    def set_last(self, value, minute):
+        self._values[self._length - 1] = value
+        self._minutes[self._length - 1] = minute
+
+    def last_value(self):
+        return float(self._values[self._length - 1])
+
+    @property
+    def values(self):
+        return self._values[:self._length]
+
+    @property
+    def minutes(self):
+        return self._minutes[:self._length]
+
+    def timestamps(self):
+        """:return: numpy datetime64 array of the timestamps of the values"""
+        return np.datetime64(self.start_time, "us") + self.minutes * np.timedelta64(60 * 10 ** 6, "us")
+
+    def timestamp(self, minute):
+        return self.start_time + timedelta(minutes=int(minute))
+
+    def _index(self, i):
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError("simulation series index out of range")
+        return i
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._length))]
+        i = self._index(i)
+        return float(self._values[i]), self.timestamp(self._minutes[i])
+
+    def __setitem__(self, i, item):
+        value, time = item
+        i = self._index(i)
+        self._values[i] = value
+        self._minutes[i] = (time - self.start_time) // timedelta(minutes=1)
+
+    def __iter__(self):
+        return zip(self.values.tolist(), self.timestamps().tolist())
+
+    def to_dict(self):
+        """:return: dictionary timestamp -> value, as returned for real cultures"""
+        return dict(zip(self.timestamps().tolist(), self.values.tolist()))
@@ -0,0 +1,136 @@
+"""
+Replay the recorded data of a vial through the MorbidostatUpdater with other settings, without a device.
+
+Run from the backend directory:
+    python -m experiment.backtest --experiment 3 --vial 2 --set od_dilution_threshold=0.4 --set dose_increase_factor=1.5
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .database_models import CultureData, CultureGenerationData, ExperimentModel
+from .ModelBasedCulture.backtest import RecordedVial, run_backtest, OD_MODES
+
+default_db_path = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'db',
+                                               'replifactory.db'))
+
+
+def load_recorded_vial(session_factory, experiment_id, vial, start=None, end=None):
+    """
+    :param start, end: datetimes limiting the replayed OD measurements, dilutions before start are loaded too
+    :return: RecordedVial with the OD measurements and dilutions of a vial in the experiment
+    """
+    with session_factory() as db:
+        query = db.query(CultureData.timestamp, CultureData.od, CultureData.growth_rate).filter(
+            CultureData.experiment_id == experiment_id,
+            CultureData.vial_number == vial,
+            CultureData.od.isnot(None))
+        if start is not None:
+            query = query.filter(CultureData.timestamp >= start)
+        if end is not None:
+            query = query.filter(CultureData.timestamp <= end)
+        od_rows = query.order_by(CultureData.timestamp).all()
+        query = db.query(CultureGenerationData.timestamp, CultureGenerationData.generation,
+                         CultureGenerationData.drug_concentration).filter(
+            CultureGenerationData.experiment_id == experiment_id,
+            CultureGenerationData.vial_number == vial)
+        if end is not None:
+            query = query.filter(CultureGenerationData.timestamp <= end)
+        dilution_rows = query.order_by(CultureGenerationData.timestamp).all()
+    od_rows = [row for row in od_rows if row[0] is not None]
+    dilution_rows = [row for row in dilution_rows if row[0] is not None]
+    return RecordedVial(od_timestamps=[row[0] for row in od_rows],
+                        ods=[row[1] for row in od_rows],
+                        growth_rates=[row[2] if row[2] is not None else float("nan") for row in od_rows],
+                        dilution_timestamps=[row[0] for row in dilution_rows],
+                        generations=[row[1] for row in dilution_rows],
+                        concentrations=[row[2] for row in dilution_rows])
+
+
+def recorded_updater_parameters(session_factory, experiment_id, vial):
+    """:return: culture (updater) parameters of a vial as currently stored with the experiment"""
+    with session_factory() as db:
+        experiment = db.query(ExperimentModel).filter(ExperimentModel.id == experiment_id).first()
+        if experiment is None:
+            raise KeyError("Experiment %s not found" % experiment_id)
+        return dict(experiment.parameters["cultures"][str(vial)])
+
+
+def backtest_vial(session_factory, experiment_id, vial, updater_parameters=None, start=None, end=None,
+                  od_mode="rescaled"):
+    """
+    Replay a vial with its stored updater parameters, overridden by updater_parameters.
+    :return: run_backtest result with the parameters used
+    """
+    parameters = recorded_updater_parameters(session_factory, experiment_id, vial)
+    parameters.update(updater_parameters or {})
+    recorded = load_recorded_vial(session_factory, experiment_id, vial, start=start, end=end)
+    result = run_backtest(recorded, parameters, vial=vial, od_mode=od_mode)
+    result["updater_parameters"] = parameters
+    return result
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the recorded data of a vial through the morbidostat "
+                                                 "updater with other settings")
+    parser.add_argument("--db", default=default_db_path, help="sqlite database file (default %(default)s)")
+    parser.add_argument("--experiment", type=int, required=True, help="experiment id")
+    parser.add_argument("--vial", type=int, required=True)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override an updater parameter, repeatable")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="ISO time of the first replayed measurement")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="ISO time of the last replayed measurement")
+    parser.add_argument("--od-mode", choices=OD_MODES, default="rescaled")
+    parser.add_argument("--json", action="store_true", help="print the full result as JSON")
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    for assignment in args.set:
+        name, separator, value = assignment.partition("=")
+        if not separator:
+            parser.error("--set expects NAME=VALUE, got %s" % assignment)
+        overrides[name.strip()] = _parse_value(value.strip())
+
+    engine = create_engine(f"sqlite:///{args.db}")
+    session_factory = sessionmaker(bind=engine)
+    result = backtest_vial(session_factory, args.experiment, args.vial, updater_parameters=overrides,
+                           start=args.start, end=args.end, od_mode=args.od_mode)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+
+    summary = result["summary"]
+    print("Vial %d, %s to %s (%.1f h, %d OD measurements), OD mode %s" % (
+        args.vial, result["start"], result["end"], summary["hours_replayed"], summary["od_measurements"],
+        result["od_mode"]))
+    print("%-22s %12s %12s" % ("", "replayed", "recorded"))
+    print("%-22s %12d %12d" % ("dilutions", summary["replayed_dilutions"], summary["recorded_dilutions"]))
+    print("%-22s %12d %12d" % ("dose changes", len(result["replayed_dose_changes"]),
+                               len(result["recorded_dose_changes"])))
+    for name, key in [("final dose", "final_dose"), ("max dose", "max_dose")]:
+        replayed, recorded = summary["replayed_" + key], summary["recorded_" + key]
+        print("%-22s %12s %12s" % (name, "-" if replayed is None else "%.3f" % replayed,
+                                   "-" if recorded is None else "%.3f" % recorded))
+    print("%d replayed dilutions within %g min of a recorded one" % (summary["matched_dilutions"],
+                                                                    summary["match_tolerance_minutes"]))
+    for change in result["replayed_dose_changes"]:
+        print("  replayed dose %s: %.3f -> %.3f" % (change["time"], change["from"], change["to"]))
+    print("replayed in %.3f s (%.0f minutes per second)" % (summary["elapsed_seconds"],
+                                                            summary["minutes_per_second"] or 0))
+
+
+if __name__ == "__main__":
+    main()
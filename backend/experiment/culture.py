@@ -4,11 +4,13 @@ import numpy as np
 from experiment.database_models import CultureData, PumpData, CultureGenerationData
 from experiment.growth_rate import calculate_last_growth_rate
 from experiment.ModelBasedCulture.morbidostat_updater import MorbidostatUpdater
-from minimal_device.dilution import make_device_dilution
+from minimal_device.dilution import make_device_dilution, PlannedDilution
 from logger.logger import logger
 
 
 from .ModelBasedCulture.culture_growth_model import CultureGrowthModel
+from .ModelBasedCulture.simulation_cache import simulation_cache
+from .ModelBasedCulture.simulation_pool import simulate_culture, run_simulation_sweep, run_simulation_ensemble
 from .ModelBasedCulture.real_culture_wrapper import RealCultureWrapper
 from .database_models import ExperimentModel, CultureData, PumpData, CultureGenerationData
 from .plot import plot_culture
@@ -80,18 +82,27 @@ class Culture:
         self.updater = MorbidostatUpdater(**self.parameters.inner_dict)
         self.adapted_culture = RealCultureWrapper(self)
         self.updater.update(self.adapted_culture)
+
+    def plan_update(self):
+        """
+        Run the updater like update(), but return the dilution it decides on instead of making it.
+        :return: PlannedDilution or None
+        """
+        self.updater = MorbidostatUpdater(**self.parameters.inner_dict)
+        dilution_requests = []
+        self.adapted_culture = RealCultureWrapper(self, dilution_requests=dilution_requests)
+        self.updater.update(self.adapted_culture)
+        if len(dilution_requests) == 0:
+            return None
+        target_dose, dilution_factor = dilution_requests[-1]
+        return self.plan_culture_dilution(target_concentration=target_dose, dilution_factor=dilution_factor)
     
     def plot_data(self, *args, **kwargs):
         return plot_culture(self, *args, **kwargs)
 
-    def plot_predicted(self, rerun=True, simulation_hours=48, title=None):
+    def plot_predicted(self, rerun=True, simulation_hours=48, title=None, method="minute"):
         if rerun:
-            self.updater = MorbidostatUpdater(**self.parameters.inner_dict)
-            growth_parameters = self.experiment.model.parameters["growth_parameters"][str(self.vial)]
-            self.culture_growth_model = CultureGrowthModel(**growth_parameters)
-            self.culture_growth_model.vial = "%d(simulated)" % self.vial
-            self.culture_growth_model.updater = self.updater
-            self.culture_growth_model.simulate_experiment(simulation_hours=simulation_hours)
+            self.run_and_save_simulation(simulation_hours=simulation_hours, method=method)
         return plot_culture(self.culture_growth_model, title=title)
     
     def plot_compare(self, vials, metric='od', limit=100000):
@@ -106,15 +117,44 @@ class Culture:
         from experiment.plot import plot_compare_metric
         return plot_compare_metric(self.experiment, vials, metric, limit)
     
-    def run_and_save_simulation(self, simulation_hours=48):
-        self.updater = MorbidostatUpdater(**self.parameters.inner_dict)
-        growth_parameters = self.experiment.model.parameters["growth_parameters"][str(self.vial)]
-        self.culture_growth_model = CultureGrowthModel(**growth_parameters)
-        self.culture_growth_model.vial = "%d(simulated)" % self.vial
-        self.culture_growth_model.updater = self.updater
-        self.culture_growth_model.simulate_experiment(simulation_hours=simulation_hours)
+    def simulation_parameters(self):
+        """:return: (growth parameters, updater parameters) of the culture simulation"""
+        growth_parameters = dict(self.experiment.model.parameters["growth_parameters"][str(self.vial)])
+        return growth_parameters, dict(self.parameters.inner_dict)
+
+    def set_simulated_model(self, model):
+        self.culture_growth_model = model
+        self.updater = model.updater
+
+    def run_and_save_simulation(self, simulation_hours=48, method="minute"):
+        """simulate the culture with its current parameters, reusing a cached simulation if they did not change"""
+        growth_parameters, updater_parameters = self.simulation_parameters()
+        model = simulation_cache.get_model(
+            self.vial, growth_parameters, updater_parameters, simulation_hours,
+            lambda hours: simulate_culture(self.vial, growth_parameters, updater_parameters, hours, method),
+            method=method)
+        self.set_simulated_model(model)
         return True
 
+    def run_simulation_sweep(self, grid, simulation_hours=48):
+        """
+        Simulate the culture with its current parameters for every combination of the parameter values in grid
+        ({name: [values]}, growth model or updater parameters), all candidates at once in the simulation
+        process pool.
+        :return: list of candidate results with the simulation efficiency metrics
+        """
+        growth_parameters, updater_parameters = self.simulation_parameters()
+        return run_simulation_sweep(grid, growth_parameters, updater_parameters, simulation_hours)
+
+    def run_simulation_ensemble(self, **options):
+        """
+        Simulate replicates of the culture with measurement noise and parameter uncertainty in the simulation
+        process pool, see simulate_ensemble for the options
+        :return: percentile bands of OD, dose and IC50 and the washout probability
+        """
+        growth_parameters, updater_parameters = self.simulation_parameters()
+        return run_simulation_ensemble(growth_parameters, updater_parameters, **options)
+
     def export_csv(self, output_directory=""):
         return export_culture_csv(self, output_directory=output_directory)
 
@@ -248,12 +288,15 @@ class Culture:
                             last_stress_increase_generation = gen_data[i+1].generation
                 self.last_stress_increase_generation = last_stress_increase_generation
 
-    def log_od_and_rpm(self, od=None, rpm=None):
+    def log_od_and_rpm(self, od=None, rpm=None, od_error=None, raw_signals=None):
+        """:param raw_signals: (transmitted, background) photodiode millivolts the od was calculated from"""
         self.od = od
+        if raw_signals is not None:
+            raw_signals = CultureData.pack_raw_signals(*raw_signals)
         self.new_culture_data = CultureData(
             experiment_id=self.experiment.model.id,
             vial_number=self.vial,
-            od=od, growth_rate=None, rpm=rpm)
+            od=od, od_error=od_error, growth_rate=None, rpm=rpm, raw_signals=raw_signals)
         with self.experiment.manager.get_session() as db:
             db.add(self.new_culture_data) 
             self.calculate_latest_growth_rate(include_current=True)
@@ -332,18 +375,23 @@ class Culture:
             db.commit()
 
     def calculate_latest_growth_rate(self, db=None, include_current=True):
-        od_dict, _, _ = self.get_last_ods_and_rpms(db=db, limit=200, since_pump=True, include_current=include_current)
+        od_dict, _, _, od_error_dict = self.get_last_ods_and_rpms(db=db, limit=200, since_pump=True,
+                                                                  include_current=include_current, return_errors=True)
         t = np.array(list(int(dt.timestamp()) for dt in od_dict.keys()))
         od = np.array([float(value) if value is not None else np.nan for value in od_dict.values()])
+        od_errors = np.array([od_error_dict.get(dt, np.nan) for dt in od_dict.keys()], dtype=float)
         if np.issubdtype(od.dtype, np.number):
             t = t[~np.isnan(od)]
+            od_errors = od_errors[~np.isnan(od)]
             od = od[~np.isnan(od)]
             od[od <= 0] = 1e-6
-            timepoint, mu, error = calculate_last_growth_rate(t, od)
+            if len(od_errors) == 0 or not np.all(np.isfinite(od_errors)):
+                od_errors = None  # weight points only when every point has a noise estimate
+            timepoint, mu, error = calculate_last_growth_rate(t, od, od_errors=od_errors)
             if np.isfinite(mu):
                 self.new_culture_data.growth_rate = mu
 
-    def get_last_ods_and_rpms(self, db=None, limit=100, since_pump=False, include_current=False):
+    def get_last_ods_and_rpms(self, db=None, limit=100, since_pump=False, include_current=False, return_errors=False):
         if db is None:
             db = self.experiment.manager.get_session()
 
@@ -360,6 +408,7 @@ class Culture:
                     extracted.append({
                         "timestamp": row.timestamp,
                         "od": row.od,
+                        "od_error": row.od_error,
                         "growth_rate": row.growth_rate,
                         "rpm": row.rpm
                     })
@@ -370,6 +419,7 @@ class Culture:
             od_dict = {d["timestamp"]: d["od"] for d in extracted if d["od"] is not None}
             mu_dict = {d["timestamp"]: d["growth_rate"] for d in extracted if d["growth_rate"] is not None}
             rpm_dict = {d["timestamp"]: d["rpm"] for d in extracted if d["rpm"] is not None}
+            od_error_dict = {d["timestamp"]: d["od_error"] for d in extracted if d["od_error"] is not None}
 
             # Optionally include the current (not-yet-committed) data.
             if include_current:
@@ -379,11 +429,16 @@ class Culture:
                         new_timestamp = self.new_culture_data.timestamp
                     if new_timestamp is not None and new_od is not None:
                         od_dict[new_timestamp] = new_od
+                        if self.new_culture_data.od_error is not None:
+                            od_error_dict[new_timestamp] = self.new_culture_data.od_error
 
         # Sort by timestamp
         od_dict = dict(sorted(od_dict.items()))
         mu_dict = dict(sorted(mu_dict.items()))
         rpm_dict = dict(sorted(rpm_dict.items()))
+        if return_errors:
+            od_error_dict = dict(sorted(od_error_dict.items()))
+            return od_dict, mu_dict, rpm_dict, od_error_dict
         return od_dict, mu_dict, rpm_dict
 
 
@@ -401,7 +456,8 @@ class Culture:
             concentration_dict = {k: v for k, v in sorted(concentration_dict.items(), key=lambda item: item[0])}
             return generation_dict, concentration_dict
 
-    def make_culture_dilution(self, target_concentration=None, dilution_factor=None, current_volume=None, postfill=False):
+    def plan_culture_dilution(self, target_concentration=None, dilution_factor=None, current_volume=None):
+        """:return: PlannedDilution that logs the pump and generation data of the culture when it is done"""
         if self.drug_concentration is None:
             self.drug_concentration = self.parameters["pump1_stock_drug_concentration"]
         if target_concentration is None:
@@ -409,24 +465,42 @@ class Culture:
         main_pump_volume, drug_pump_volume = self.calculate_pump_volumes(target_concentration=target_concentration,
                                                                          dilution_factor=dilution_factor,
                                                                          current_volume=current_volume)
-        lock_acquired_here = False
         self.updater.status_dict["dilution_pump_volumes"] = "current_concentration: %.2f, target_concentration: %.2f, main_pump_volume: %.2f, drug_pump_volume: %.2f" % (
             self.drug_concentration, target_concentration, main_pump_volume, drug_pump_volume)
+
+        def on_done():
+            self.finish_culture_dilution(main_pump_volume, drug_pump_volume)
+
+        return PlannedDilution(vial=self.vial,
+                               pump1_volume=main_pump_volume,
+                               pump2_volume=drug_pump_volume,
+                               extra_vacuum=5,
+                               postfill=self.parameters["postfill"] > 0,
+                               lock=self.experiment.locks[self.vial],
+                               on_done=on_done)
+
+    def finish_culture_dilution(self, main_pump_volume, drug_pump_volume):
+        self.last_dilution_time = datetime.now()
+        self.log_pump_data(main_pump_volume, drug_pump_volume)
+        self.calculate_generation_concentration_after_dil(main_pump_volume=main_pump_volume,
+                                                          drug_pump_volume=drug_pump_volume)
+
+    def make_culture_dilution(self, target_concentration=None, dilution_factor=None, current_volume=None, postfill=False):
+        dilution = self.plan_culture_dilution(target_concentration=target_concentration,
+                                              dilution_factor=dilution_factor,
+                                              current_volume=current_volume)
+        lock_acquired_here = False
         try:
             if not self.experiment.locks[self.vial].locked():
                 self.experiment.locks[self.vial].acquire(blocking=True)
                 lock_acquired_here = True
-            postfill = self.parameters["postfill"] > 0
             make_device_dilution(device=self.experiment.device,
                                     vial=self.vial,
-                                    pump1_volume=main_pump_volume,
-                                    pump2_volume=drug_pump_volume,
-                                    extra_vacuum=5,
-                                    postfill=postfill)
-            self.last_dilution_time = datetime.now()
-            self.log_pump_data(main_pump_volume, drug_pump_volume)
-            self.calculate_generation_concentration_after_dil(main_pump_volume=main_pump_volume,
-                                                              drug_pump_volume=drug_pump_volume)
+                                    pump1_volume=dilution.pump1_volume,
+                                    pump2_volume=dilution.pump2_volume,
+                                    extra_vacuum=dilution.extra_vacuum,
+                                    postfill=dilution.postfill)
+            dilution.on_done()
         finally:
             if lock_acquired_here:
                 self.experiment.locks[self.vial].release()
@@ -1,4 +1,5 @@
 # models.py
+import struct
 from datetime import datetime
 
 from flask_sqlalchemy import SQLAlchemy
@@ -100,12 +101,30 @@ class CultureData(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
 
     od = db.Column(db.Float, nullable=True)
+    od_error = db.Column(db.Float, nullable=True)  # standard error of the OD measurement
     growth_rate = db.Column(db.Float, nullable=True)
     rpm = db.Column(db.Float, nullable=True)
+    # transmitted and background photodiode millivolts (float32 pair), allows recomputing od after recalibration
+    raw_signals = db.Column(db.LargeBinary, nullable=True)
 
     # To represent the relationship between an experiment and its cultures
     experiment = db.relationship('ExperimentModel', backref='culture_data')
 
+    RAW_SIGNALS_FORMAT = "<ff"
+
+    @classmethod
+    def pack_raw_signals(cls, transmitted, background):
+        if transmitted is None or background is None:
+            return None
+        return struct.pack(cls.RAW_SIGNALS_FORMAT, transmitted, background)
+
+    @classmethod
+    def unpack_raw_signals(cls, raw_signals):
+        """:return: (transmitted, background) millivolts or None"""
+        if raw_signals is None:
+            return None
+        return struct.unpack(cls.RAW_SIGNALS_FORMAT, raw_signals)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -113,6 +132,101 @@ class CultureData(db.Model):
             'vial_number': self.vial_number,
             'timestamp': self.timestamp.isoformat(),
             'od': self.od_reading,
+            'od_error': self.od_error,
             'growth_rate': self.growth_rate,
             'rpm': self.rpm
         }
+
+
+class OdSeriesVersion(db.Model):
+    """An OD and growth rate series recomputed from the raw signals of an experiment with a given calibration"""
+    __tablename__ = 'od_series_versions'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiments.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    description = db.Column(db.String(256), nullable=True)
+    calibration = db.Column(JSON, nullable=False)  # vial -> [blank, scaling]
+    status = db.Column(db.String(64), nullable=False, default=lambda: "pending")
+    rows_total = db.Column(db.Integer, nullable=True)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    rows_skipped = db.Column(db.Integer, nullable=False, default=0)  # rows without timestamp or raw signals
+    error = db.Column(db.Text, nullable=True)
+
+    experiment = db.relationship('ExperimentModel', backref='od_series_versions')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'experiment_id': self.experiment_id,
+            'created_at': self.created_at.isoformat() if self.created_at is not None else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at is not None else None,
+            'description': self.description,
+            'calibration': self.calibration,
+            'status': self.status,
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'rows_skipped': self.rows_skipped,
+            'error': self.error
+        }
+
+
+class GrowthParameterFit(db.Model):
+    """Growth model parameters of a vial fitted to its recorded OD and dose history, proposed for use"""
+    __tablename__ = 'growth_parameter_fits'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiments.id'), nullable=False, index=True)
+    vial_number = db.Column(db.Integer, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    status = db.Column(db.String(64), nullable=False, default=lambda: "pending")
+    initial_parameters = db.Column(JSON, nullable=False)  # growth parameters the fit started from
+    fitted_parameters = db.Column(JSON, nullable=True)  # complete growth parameters with the fitted values
+    diagnostics = db.Column(JSON, nullable=True)
+    applied_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+
+    experiment = db.relationship('ExperimentModel', backref='growth_parameter_fits')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'experiment_id': self.experiment_id,
+            'vial_number': self.vial_number,
+            'created_at': self.created_at.isoformat() if self.created_at is not None else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at is not None else None,
+            'status': self.status,
+            'initial_parameters': self.initial_parameters,
+            'fitted_parameters': self.fitted_parameters,
+            'diagnostics': self.diagnostics,
+            'applied_at': self.applied_at.isoformat() if self.applied_at is not None else None,
+            'error': self.error
+        }
+
+
+class OdSeriesPoint(db.Model):
+    __tablename__ = 'od_series_points'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    version_id = db.Column(db.Integer, db.ForeignKey('od_series_versions.id'), nullable=False, index=True)
+    culture_data_id = db.Column(db.Integer, db.ForeignKey('culture_data.id'), nullable=False)
+    vial_number = db.Column(db.Integer, nullable=False, index=True)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+
+    od = db.Column(db.Float, nullable=True)
+    growth_rate = db.Column(db.Float, nullable=True)
+
+    def to_dict(self):
+        return {
+            'version_id': self.version_id,
+            'culture_data_id': self.culture_data_id,
+            'vial_number': self.vial_number,
+            'timestamp': self.timestamp.isoformat(),
+            'od': self.od,
+            'growth_rate': self.growth_rate
+        }
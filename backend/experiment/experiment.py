@@ -15,6 +15,7 @@ from .ModelBasedCulture.culture_growth_model import culture_growth_model_default
 from .ModelBasedCulture.morbidostat_updater import morbidostat_updater_default_parameters
 
 from .culture import Culture
+from minimal_device.dilution import DilutionPlanner
 
 class ExperimentWorker:
     def __init__(self, experiment):
@@ -27,6 +28,7 @@ class ExperimentWorker:
     def run_loop(self):
         self.experiment.device.valves.close_all()
         self.experiment.device.eeprom.save_config_to_eeprom()
+        self.experiment.device.signal_log.enabled = True
         while True:
             status = self.experiment.get_status()
             if status in ('stopped', 'stopping'):
@@ -47,6 +49,8 @@ class ExperimentWorker:
                     self.experiment.manager.emit_ws_message({"type": "progress", "action": "stop", "message": "Waiting for OD measurement..."})
         self.experiment.manager.emit_ws_message({"type": "progress", "action": "stop", "message": "Stopping stirrers"})
         self.experiment.device.stirrers.set_speed_all("stopped")
+        self.experiment.device.signal_log.enabled = False
+        self.experiment.device.signal_log.flush()
         self.experiment.manager.emit_ws_message({"type": "success", "action": "stop", "message": "Experiment stopped"})
 
 class QueueWorker:
@@ -237,9 +241,11 @@ class Experiment:
                         self.locks[vial].acquire(blocking=False) # blocking=False means don't wait for lock, just check if it's available
                         available_vials.append(vial)
                 new_rpms = self.device.stirrers.measure_all_rpms(vials_to_measure=available_vials)
-                new_ods = self.measure_od_all(vials_to_measure=available_vials)
+                new_ods, od_errors = self.measure_od_all(vials_to_measure=available_vials)
                 for vial in available_vials:
-                    self.cultures[vial].log_od_and_rpm(new_ods[vial],new_rpms[vial])
+                    raw_signals = self.device.od_sensors[vial].last_raw_signals
+                    self.cultures[vial].log_od_and_rpm(new_ods[vial], new_rpms[vial], od_error=od_errors.get(vial),
+                                                       raw_signals=raw_signals)
             finally:
                 for vial in available_vials:
                     self.locks[vial].release()
@@ -274,10 +280,16 @@ class Experiment:
 
     def update_cultures_in_background(self):
         def task():
+            # decide on all dilutions first, then run them as one overlapping cycle
+            dilutions = []
             for vial in range(1, 8):
                 if not self.status == "running":
                     break
-                self.cultures[vial].update()
+                dilution = self.cultures[vial].plan_update()
+                if dilution is not None:
+                    dilutions.append(dilution)
+            if self.status == "running" and len(dilutions) > 0:
+                DilutionPlanner(self.device).run(dilutions)
         if self.experiment_worker.dilution_worker.queue.empty():
             self.experiment_worker.dilution_worker.queue.put(task)
             # print("Task to update cultures queued for background execution.")
@@ -286,22 +298,13 @@ class Experiment:
 
     def measure_od_all(self, vials_to_measure=(1, 2, 3, 4, 5, 6, 7)):
         """
-        Measure optical density of all vials in the device
+        Measure optical density of all vials in the device.
+        Stirrer slow-downs are staggered so that the next vial settles while the current one is measured.
         :param vials_to_measure: tuple of vials to measure
-        :return: dictionary of measured optical density values
+        :return: dictionaries of measured optical density values and of their standard errors
         """
-        measured_od_values = {}
-        if len(vials_to_measure) > 0:
-            for vial in vials_to_measure:
-                self.device.stirrers.set_speed(vial=vial, speed="low")
-            time.sleep(4)
-
-            for vial in vials_to_measure:
-                od, signal = self.device.od_sensors[vial].measure_od()
-                measured_od_values[vial] = od
-            for vial in vials_to_measure:
-                self.device.stirrers.set_speed(vial=vial, speed="high")
-        return measured_od_values
+        measured_od_values, measured_od_errors = self.device.od_sweep.measure(vials_to_measure)
+        return measured_od_values, measured_od_errors
 
     def reconnect_device_if_disconnected(self):
         if self.device.is_connected():
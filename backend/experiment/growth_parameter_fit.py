@@ -0,0 +1,184 @@
+import threading
+import time
+import traceback
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import numpy as np
+
+from logger.logger import logger
+from .database_models import CultureData, CultureGenerationData, GrowthParameterFit
+from .ModelBasedCulture.parameter_fit import (RecordedCulture, CultureReplay, DEFAULT_FIT_PARAMETERS, FIT_BOUNDS,
+                                              fit_from_start, fit_diagnostics, to_unit, from_unit)
+from .ModelBasedCulture.simulation_pool import get_simulation_pool, _reset_pool
+
+running_fits = {}  # fit id -> GrowthParameterFitJob
+
+
+def load_recorded_culture(session_factory, experiment_id, vial, initial_concentration=0.0):
+    """:return: RecordedCulture with the OD measurements and dilutions of a vial, minutes since the first OD"""
+    with session_factory() as db:
+        od_rows = db.query(CultureData.timestamp, CultureData.od).filter(
+            CultureData.experiment_id == experiment_id,
+            CultureData.vial_number == vial,
+            CultureData.od.isnot(None)
+        ).order_by(CultureData.timestamp).all()
+        dilution_rows = db.query(CultureGenerationData.timestamp, CultureGenerationData.drug_concentration).filter(
+            CultureGenerationData.experiment_id == experiment_id,
+            CultureGenerationData.vial_number == vial
+        ).order_by(CultureGenerationData.timestamp).all()
+    od_rows = [row for row in od_rows if row[0] is not None]
+    if len(od_rows) == 0:
+        raise Exception("No OD data of vial %d to fit at time %s" % (vial, time.ctime()))
+    start = od_rows[0][0]
+    dilution_rows = [row for row in dilution_rows if row[0] is not None and row[0] >= start]
+    return RecordedCulture(
+        od_minutes=[(row[0] - start).total_seconds() / 60 for row in od_rows],
+        ods=[row[1] for row in od_rows],
+        dilution_minutes=[(row[0] - start).total_seconds() / 60 for row in dilution_rows],
+        concentrations=[row[1] for row in dilution_rows],
+        initial_concentration=initial_concentration)
+
+
+class GrowthParameterFitJob:
+    """
+    Fits the growth parameters of a vial to its recorded OD and dilution history, and stores the fitted values
+    as a proposed parameter set (GrowthParameterFit) with fit diagnostics. The current growth parameters are
+    not changed until the fit is applied.
+
+    The recorded dose history is replayed through the growth model equations (CultureReplay), the mean squared
+    log OD error is minimized with L-BFGS-B from n_starts start points: the current parameters and random points
+    of the search box. The starts run in parallel in the simulation process pool.
+
+    Cancelling is best-effort for the starts already running in a worker: the job is marked cancelled right
+    away and the starts not yet started are dropped, but a running start only stops at its max_iterations or
+    at the max_seconds deadline of the job.
+    """
+    max_iterations = 200
+    max_seconds = 900  # wall time of all starts, a start still running then returns its best point so far
+
+    def __init__(self, session_factory, experiment_id, vial, growth_parameters, updater_parameters,
+                 fit_parameters=None, n_starts=8, step_minutes=5, seed=None):
+        """
+        :param fit_parameters: names of the fitted growth parameters, the others stay at their current value
+        """
+        self.session_factory = session_factory
+        self.experiment_id = experiment_id
+        self.vial = int(vial)
+        self.growth_parameters = dict(growth_parameters)
+        self.updater_parameters = dict(updater_parameters)
+        self.fit_parameters = list(DEFAULT_FIT_PARAMETERS if fit_parameters is None else fit_parameters)
+        for name in self.fit_parameters:
+            if name not in FIT_BOUNDS:
+                raise ValueError("Parameter %s cannot be fitted, fittable: %s" % (name, ", ".join(FIT_BOUNDS)))
+        self.n_starts = max(1, int(n_starts))
+        self.step_minutes = step_minutes
+        self.seed = seed
+        self.fit_id = None
+        self.thread = None
+        self._cancel = threading.Event()
+
+    def start(self):
+        """create the fit row and run the job in a background thread, :return: fit id"""
+        with self.session_factory() as db:
+            fit = GrowthParameterFit(experiment_id=self.experiment_id, vial_number=self.vial, status="pending",
+                                     initial_parameters=self.growth_parameters)
+            db.add(fit)
+            db.commit()
+            self.fit_id = fit.id
+        running_fits[self.fit_id] = self
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.fit_id
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _update_fit(self, **values):
+        with self.session_factory() as db:
+            db.query(GrowthParameterFit).filter(GrowthParameterFit.id == self.fit_id).update(values)
+            db.commit()
+
+    def _start_points(self):
+        rng = np.random.default_rng(self.seed)
+        current = [float(to_unit(name, self.growth_parameters.get(name, FIT_BOUNDS[name][0])))
+                   for name in self.fit_parameters]
+        return [current] + [rng.uniform(0.05, 0.95, len(self.fit_parameters)).tolist()
+                            for _ in range(self.n_starts - 1)]
+
+    def run(self):
+        t0 = time.time()
+        try:
+            self._update_fit(status="running")
+            recorded = load_recorded_culture(self.session_factory, self.experiment_id, self.vial,
+                                             self.updater_parameters.get("pump1_stock_drug_concentration", 0.0))
+            replay = CultureReplay(recorded, self.growth_parameters, step_minutes=self.step_minutes)
+            if replay.n_points <= len(self.fit_parameters):
+                raise Exception("Only %d OD points of vial %d to fit %d parameters at time %s"
+                                % (replay.n_points, self.vial, len(self.fit_parameters), time.ctime()))
+
+            starts = self._start_points()
+            results = self._run_starts(replay, starts)
+            if self._cancel.is_set():
+                self._update_fit(status="cancelled", finished_at=datetime.now())
+                logger.info(f"Growth parameter fit {self.fit_id} of vial {self.vial} cancelled")
+                return
+            results = [result for result in results if np.isfinite(result["loss"])]
+            if len(results) == 0:
+                raise Exception("All fit starts of vial %d failed at time %s" % (self.vial, time.ctime()))
+
+            best = min(results, key=lambda result: result["loss"])
+            fitted_values = {name: float(from_unit(name, best["x"][i])) for i, name in enumerate(self.fit_parameters)}
+            fitted_parameters = {**self.growth_parameters, **fitted_values}
+            diagnostics = fit_diagnostics(replay, self.fit_parameters, np.array(best["x"]))
+            initial_rmse = float(np.sqrt(replay.loss([{}])[0]))
+            diagnostics.update({
+                "fitted_names": self.fit_parameters,
+                "initial_rmse_log_od": initial_rmse if np.isfinite(initial_rmse) else None,
+                "n_dilutions": int(len(recorded.dilution_minutes)),
+                "data_hours": float(recorded.od_minutes[-1] / 60),
+                "step_minutes": self.step_minutes,
+                "starts": [{"loss": result["loss"], "iterations": result["iterations"],
+                            "success": result["success"]} for result in results],
+                "elapsed_seconds": time.time() - t0,
+            })
+            self._update_fit(status="done", fitted_parameters=fitted_parameters, diagnostics=diagnostics,
+                             finished_at=datetime.now())
+            logger.info(f"Growth parameter fit {self.fit_id} of vial {self.vial} done: rmse log OD "
+                        f"{diagnostics['rmse_log_od']:.4f} ({replay.n_points} points) in {time.time() - t0:.1f} s")
+        except Exception as e:
+            logger.error(f"Growth parameter fit {self.fit_id} of vial {self.vial} failed: {e}")
+            logger.error(traceback.format_exc())
+            self._update_fit(status="failed", error=str(e), finished_at=datetime.now())
+        finally:
+            running_fits.pop(self.fit_id, None)
+
+    def _run_starts(self, replay, starts):
+        """:return: results of the starts that finished, in the order they finished"""
+        pool = get_simulation_pool()
+        futures = []
+        results = []
+        deadline = time.time() + self.max_seconds
+        try:
+            futures = [pool.submit(fit_from_start, replay, self.fit_parameters, x0, self.max_iterations,
+                                   deadline=deadline) for x0 in starts]
+            pending = set(futures)
+            while pending and not self._cancel.is_set():
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        results.append(future.result())
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        logger.warning(f"Growth parameter fit {self.fit_id} start failed: {e}")
+        except BrokenProcessPool:
+            logger.error("Simulation process pool broke, it will be restarted on the next request")
+            _reset_pool(pool)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+        return results
+
@@ -11,11 +11,12 @@ def growth_function(t, N0, growth_rate):
     return y
 
 
-def calculate_growth_rate(time_values, od_values):
+def calculate_growth_rate(time_values, od_values, od_errors=None):
     """
     fits exponential growth curve and returns growth rate calculated over the entire time window.
     time window must not include dilution.
     time values must be in seconds.
+    od_errors (optional) are standard errors of the od values, used to weight the fit.
     """
     assert (
         1 < time_values[-1] < 1e10
@@ -39,13 +40,15 @@ def calculate_growth_rate(time_values, od_values):
         )
         time_values = time_values[median_window : -(median_window - 1)]
         od_values = od_values[median_window : -(median_window - 1)]
+        if od_errors is not None:
+            od_errors = od_errors[median_window : -(median_window - 1)]
 
     # convert to hrs
     hours = np.array(time_values) / 3600
     hours = hours - min(hours)
 
     try:
-        popt, pcov = curve_fit(growth_function, hours, od_values, p0=(1e-3, 0.3))
+        popt, pcov = curve_fit(growth_function, hours, od_values, p0=(1e-3, 0.3), sigma=od_errors)
     except Exception:
         return np.nan, np.nan, np.nan
     timepoint = (float(time_values[0]) + time_values[-1]) / 2
@@ -67,10 +70,11 @@ def calculate_growth_rate(time_values, od_values):
 #     return timepoint, growth_rate, error
 
 
-def calculate_last_growth_rate(t, od):
+def calculate_last_growth_rate(t, od, od_errors=None):
     """
     returns the most recent growth rate in an OD sequence,
     calculated over an appropriate time window (~t_doubling/2)
+    od_errors (optional) are standard errors of the od values, used to weight the fit.
     """
     if len(od) == 0:
         return np.nan, np.nan, np.nan
@@ -93,7 +97,8 @@ def calculate_last_growth_rate(t, od):
         imin = np.where(t >= tmin)[0][0]
         tw = t[imin:]
         odw = od[imin:]
-        timepoint, growth_rate, error = calculate_growth_rate(tw, odw)
+        errw = od_errors[imin:] if od_errors is not None else None
+        timepoint, growth_rate, error = calculate_growth_rate(tw, odw, od_errors=errw)
         td = np.log(2) / growth_rate  # hours
         if not np.isfinite(td):
             break
@@ -117,6 +122,22 @@ def calculate_last_growth_rate(t, od):
     return timepoint, growth_rate, error
 
 
+def last_growth_rates(windows):
+    """
+    calculate_last_growth_rate of many OD sequences, e.g. in a worker of the simulation process pool.
+    windows: list of (time values in seconds, od values)
+    returns a list with the growth rate of every window, None where it could not be fitted.
+    """
+    growth_rates = []
+    for t, od in windows:
+        try:
+            timepoint, growth_rate, error = calculate_last_growth_rate(np.asarray(t), np.array(od, dtype=float))
+        except Exception:
+            growth_rate = np.nan
+        growth_rates.append(float(growth_rate) if np.isfinite(growth_rate) else None)
+    return growth_rates
+
+
 def sliding_window_growth_rate(time_values, od_values, window_size_minutes):
     """
     time_values in seconds
@@ -0,0 +1,170 @@
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from logger.logger import logger
+from minimal_device.od_sensor import CalibrationTransform
+from .database_models import CultureData, CultureGenerationData, OdSeriesVersion, OdSeriesPoint
+from .growth_rate import last_growth_rates
+from .ModelBasedCulture.simulation_pool import run_in_pool
+
+running_jobs = {}  # version id -> OdRecomputeJob
+
+
+class OdRecomputeJob:
+    """
+    Recomputes the OD (and optionally growth rate) history of an experiment from the raw photodiode signals
+    stored with each CultureData row, using the given calibration, and stores the result as a new OdSeriesVersion.
+    The original CultureData values are not touched.
+
+    Rows are streamed in chunks ordered by time, each chunk is converted with one vectorized calibration call
+    and committed in its own short session, with a pause in between so the live experiment is never blocked
+    on the database for long. Growth rates are fitted like during the experiment: over the last 200 points
+    since the latest dilution, without od error weights (the errors were computed with the old calibration).
+    The growth rates of a chunk are fitted in one task of the simulation process pool, outside the API process.
+    Rows without a timestamp or raw signals are counted as skipped.
+    """
+    chunk_size = 500
+    pause_between_chunks = 0.05  # seconds
+    growth_rate_window = 200  # points, as in Culture.calculate_latest_growth_rate
+
+    def __init__(self, session_factory, experiment_id, calibration, vials=None, recompute_growth_rate=True,
+                 description=None):
+        """
+        :param session_factory: callable returning a new database session, e.g. experiment_manager.get_session
+        :param calibration: dictionary vial -> (blank, scaling)
+        """
+        self.session_factory = session_factory
+        self.experiment_id = experiment_id
+        self.calibration = {int(vial): [float(c) for c in coefs] for vial, coefs in calibration.items()}
+        self.vials = sorted(self.calibration) if vials is None else [int(v) for v in vials]
+        self.recompute_growth_rate = recompute_growth_rate
+        self.description = description
+        self.version_id = None
+        self.thread = None
+        self._cancel = threading.Event()
+
+    def start(self):
+        """create the series version and run the job in a background thread, :return: version id"""
+        with self.session_factory() as db:
+            rows_total = db.query(CultureData).filter(
+                CultureData.experiment_id == self.experiment_id,
+                CultureData.vial_number.in_(self.vials)).count()
+            version = OdSeriesVersion(experiment_id=self.experiment_id, calibration=self.calibration,
+                                      description=self.description, status="pending", rows_total=rows_total,
+                                      rows_processed=0, rows_skipped=0)
+            db.add(version)
+            db.commit()
+            self.version_id = version.id
+        running_jobs[self.version_id] = self
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.version_id
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _update_version(self, **values):
+        with self.session_factory() as db:
+            db.query(OdSeriesVersion).filter(OdSeriesVersion.id == self.version_id).update(values)
+            db.commit()
+
+    def run(self):
+        t0 = time.time()
+        try:
+            self._update_version(status="running")
+            processed, skipped = 0, 0
+            for vial in self.vials:
+                if self._cancel.is_set():
+                    break
+                vial_processed, vial_skipped = self._recompute_vial(vial, processed, skipped)
+                processed += vial_processed
+                skipped += vial_skipped
+            status = "cancelled" if self._cancel.is_set() else "done"
+            self._update_version(status=status, finished_at=datetime.now())
+            logger.info(f"OD series {self.version_id} {status}: {processed} rows ({skipped} without timestamp or raw "
+                        f"signals) in {time.time() - t0:.1f} s")
+        except Exception as e:
+            logger.error(f"OD series {self.version_id} failed: {e}")
+            logger.error(traceback.format_exc())
+            self._update_version(status="failed", error=str(e), finished_at=datetime.now())
+        finally:
+            running_jobs.pop(self.version_id, None)
+
+    def _dilution_times(self, vial):
+        with self.session_factory() as db:
+            rows = db.query(CultureGenerationData.timestamp).filter(
+                CultureGenerationData.experiment_id == self.experiment_id,
+                CultureGenerationData.vial_number == vial
+            ).order_by(CultureGenerationData.timestamp).all()
+        return [row[0] for row in rows if row[0] is not None]
+
+    def _recompute_vial(self, vial, processed, skipped):
+        blank, scaling = self.calibration[vial]
+        transform = CalibrationTransform(blank, scaling, vial)
+        dilution_times = self._dilution_times(vial)
+        i_dilution = 0  # index of the next dilution after the current row
+        window = deque(maxlen=self.growth_rate_window)  # (unix time, od) since the last dilution
+        last_id = 0
+        vial_processed, vial_skipped = 0, 0
+        while not self._cancel.is_set():
+            with self.session_factory() as db:
+                rows = db.query(CultureData.id, CultureData.timestamp, CultureData.raw_signals).filter(
+                    CultureData.experiment_id == self.experiment_id,
+                    CultureData.vial_number == vial,
+                    CultureData.id > last_id
+                ).order_by(CultureData.id).limit(self.chunk_size).all()
+            if len(rows) == 0:
+                break
+            last_id = rows[-1][0]
+            with_signals = [row for row in rows if row[1] is not None and row[2] is not None]
+            vial_skipped += len(rows) - len(with_signals)
+
+            raw = np.array([CultureData.unpack_raw_signals(row[2]) for row in with_signals], dtype=float)
+            if len(with_signals) > 0:
+                signals = raw[:, 0] - raw[:, 1]
+                signals[signals <= 0] = 0.001  # as in OdSensor.measure_od
+                ods = transform(signals)
+            else:
+                ods = np.zeros(0)
+
+            windows = []
+            for (row_id, timestamp, _), od in zip(with_signals, ods):
+                while i_dilution < len(dilution_times) and dilution_times[i_dilution] < timestamp:
+                    window.clear()  # a dilution happened before this point
+                    i_dilution += 1
+                window.append((int(timestamp.timestamp()), float(od)))
+                if self.recompute_growth_rate:
+                    windows.append(([p[0] for p in window], [p[1] for p in window]))
+            if len(windows) > 0:
+                growth_rates = run_in_pool(last_growth_rates, windows)
+            else:
+                growth_rates = [None] * len(with_signals)
+            points = [{"version_id": self.version_id, "culture_data_id": row_id, "vial_number": vial,
+                       "timestamp": timestamp, "od": float(od), "growth_rate": growth_rate}
+                      for (row_id, timestamp, _), od, growth_rate in zip(with_signals, ods, growth_rates)]
+
+            vial_processed += len(rows)
+            with self.session_factory() as db:
+                db.bulk_insert_mappings(OdSeriesPoint, points)
+                db.query(OdSeriesVersion).filter(OdSeriesVersion.id == self.version_id).update(
+                    {"rows_processed": processed + vial_processed, "rows_skipped": skipped + vial_skipped})
+                db.commit()
+            time.sleep(self.pause_between_chunks)
+        return vial_processed, vial_skipped
+
+
+def get_series(session_factory, version_id, vial=None, limit=None):
+    """:return: points of an OD series version ordered by time"""
+    with session_factory() as db:
+        query = db.query(OdSeriesPoint).filter(OdSeriesPoint.version_id == version_id)
+        if vial is not None:
+            query = query.filter(OdSeriesPoint.vial_number == vial)
+        query = query.order_by(OdSeriesPoint.timestamp)
+        if limit is not None:
+            query = query.limit(limit)
+        return [point.to_dict() for point in query.all()]
@@ -9,17 +9,19 @@ def plot_culture(culture, limit=100000, title=None):
     culture_parameters = culture.updater.__dict__
 
     if isinstance(culture, CultureGrowthModel):
-        ods = {p[1]: p[0] for p in culture.population}
-        mus = {p[1]: p[0] for p in culture.effective_growth_rates}
-        concs = {p[1]: p[0] for p in culture.doses}
-        gens = {p[1]: p[0] for p in culture.generations}
-        rpms = {}
+        # simulated series go to plotly as arrays, without per point dictionaries
+        (od_x, od_y), (mu_x, mu_y), (conc_x, conc_y), (gen_x, gen_y) = [
+            (series.timestamps(), series.values) for series in
+            [culture.population, culture.effective_growth_rates, culture.doses, culture.generations]]
+        rpm_x, rpm_y = [], []
     else:
         # Extract data from real experiment
         ods, mus, rpms = culture.get_last_ods_and_rpms(limit=limit)
         gens, concs = culture.get_last_generations(limit=limit)
+        (od_x, od_y), (mu_x, mu_y), (rpm_x, rpm_y), (gen_x, gen_y), (conc_x, conc_y) = [
+            (list(series.keys()), list(series.values())) for series in [ods, mus, rpms, gens, concs]]
 
-    if len(ods) == 0:
+    if len(od_y) == 0:
         trace1 = go.Scattergl(
             x=[],
             y=[],
@@ -32,8 +34,8 @@ def plot_culture(culture, limit=100000, title=None):
         )
     else:
         trace1 = go.Scattergl(
-            x=list(ods.keys()),
-            y=list(ods.values()),
+            x=od_x,
+            y=od_y,
             mode='markers',
             marker=dict(
                 color='black'
@@ -42,8 +44,8 @@ def plot_culture(culture, limit=100000, title=None):
             yaxis='y1')
 
     trace2 = go.Scattergl(
-        x=list(gens.keys()),
-        y=list(gens.values()),
+        x=gen_x,
+        y=gen_y,
         mode='lines+markers',
         line=dict(
             color='red',
@@ -54,8 +56,8 @@ def plot_culture(culture, limit=100000, title=None):
     )
 
     trace3 = go.Scattergl(
-        x=list(concs.keys()),
-        y=list(concs.values()),
+        x=conc_x,
+        y=conc_y,
         mode='lines+markers',
         line=dict(
             color='green',
@@ -64,10 +66,10 @@ def plot_culture(culture, limit=100000, title=None):
         name='Concentration',
         yaxis='y3'  # Set to the third y-axis
     )
-    if len(mus) > 0:
+    if len(mu_y) > 0:
         trace4 = go.Scattergl(
-            x=list(mus.keys()),
-            y=list(mus.values()),
+            x=mu_x,
+            y=mu_y,
             mode='markers',
             line=dict(
                 color='blue',
@@ -88,15 +90,9 @@ def plot_culture(culture, limit=100000, title=None):
             name='Growth Rate',
             yaxis='y4'  # Set to the fourth y-axis
         )
-    if len(rpms) == 0:
-        x_rpm = []
-        y_rpm = []
-    else:
-        x_rpm = list(rpms.keys())
-        y_rpm = list(rpms.values())
     trace5 = go.Scattergl(
-        x=x_rpm,
-        y=y_rpm,
+        x=rpm_x,
+        y=rpm_y,
         mode='markers',
         line=dict(
             color='orange',
@@ -111,8 +107,8 @@ def plot_culture(culture, limit=100000, title=None):
     pretty_parameters = pretty_parameters.replace('\n', '<br>')
 
     try:
-        xp = list(ods.keys())[0]
-        yp = list(ods.values())[0]+0.01
+        xp = od_x[0]
+        yp = od_y[0]+0.01
     except IndexError:
         xp = datetime.now()
         yp = 0.01
@@ -3,7 +3,25 @@ import time
 import pyftdi.i2c
 
 
+def decode_adc_counts(data, bitrate):
+    """signed output code of the MCP3421 from the big-endian data bytes (two's complement)"""
+    counts = int.from_bytes(bytes(data), "big") & ((1 << bitrate) - 1)
+    if counts >> (bitrate - 1):  # sign bit
+        counts -= 1 << bitrate
+    return counts
+
+
 class Photodiodes:
+    bitrate_to_samples_per_second = {
+        12: 240,  # from MCP3421 datasheet
+        14: 60,
+        16: 15,
+        18: 3.75,
+    }
+    # the internal oscillator may run up to ~20% slow, start polling a bit before nominal completion
+    early_poll_fraction = 0.8
+    poll_interval_fraction = 0.05
+
     def __init__(self, device):
         self.device = device
         self.adc_port = None
@@ -13,14 +31,16 @@ class Photodiodes:
             self.connect()
 
     def connect(self):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="photodiodes")
         if not lock_acquired:
             raise Exception("Could not acquire lock to connect photodiodes at time %s" % time.ctime())
         try:  # estimated time to complete the operation: 0.5s
-            self.adc_port = self.device.i2c.get_port(
-                self.device.PORT_ADC
+            self.adc_port = self.device.get_i2c_port(
+                "adc", self.device.PORT_ADC
             )  # photodiodes ADC
-            self.multiplexer_port = self.device.i2c.get_port(self.device.PORT_GPIO_MULTIPLEXER_ADC)
+            self.multiplexer_port = self.device.get_i2c_port(
+                "adc_multiplexer", self.device.PORT_GPIO_MULTIPLEXER_ADC, chip="pca9555"
+            )
             self.multiplexer_port.write_to(6, [0x00])  # set all GPIO pins as output
             self.multiplexer_port.write_to(7, [0x00])  # set all GPIO pins as output
         except pyftdi.i2c.I2cNackError:
@@ -33,6 +53,10 @@ class Photodiodes:
         assert 0 <= vial <= 6
         self.multiplexer_port.write_to(3, [6 - vial])
 
+    def conversion_time(self, bitrate=16):
+        """nominal duration of a single one-shot conversion in seconds"""
+        return 1 / self.bitrate_to_samples_per_second[bitrate]
+
     def measure(self, gain=8, bitrate=16, continuous_conversion=False):
         ready_bit = 0b10000000
         if continuous_conversion:
@@ -40,12 +64,6 @@ class Photodiodes:
         else:
             conversion_mode = 0b00000000  # One-shot conversion mode
         bitrate_bits = {12: 0b0000, 14: 0b0100, 16: 0b1000, 18: 0b1100}
-        bitrate_to_samples_per_second = {
-            12: 240,  # from MCP3421 datasheet
-            14: 60,
-            16: 15,
-            18: 3.75,
-        }
         gain_bits = {1: 0b00, 2: 0b01, 4: 0b10, 8: 0b11}
 
         write_byte = (
@@ -53,12 +71,15 @@ class Photodiodes:
         )
         self.adc_port.write([write_byte])
 
-        new_data_is_ready = False
-        for _ in range(100):  # try reading until conversion ready
-            samples_per_second = bitrate_to_samples_per_second[bitrate]
-            seconds_per_sample = 1 / samples_per_second
+        # the conversion can not finish before the nominal sample period, so sleep through most of it
+        # and then poll the ready bit at a fraction of the sample period instead of a full period.
+        seconds_per_sample = self.conversion_time(bitrate)
+        poll_interval = seconds_per_sample * self.poll_interval_fraction
+        deadline = time.time() + 100 * seconds_per_sample
+        time.sleep(seconds_per_sample * self.early_poll_fraction)
 
-            time.sleep(seconds_per_sample)
+        new_data_is_ready = False
+        while True:  # try reading until conversion ready
             response = self.adc_port.read(4)
             data = response[:2]
             config = response[3:]
@@ -68,17 +89,12 @@ class Photodiodes:
             new_data_is_ready = (
                 config[0] < 128
             )  # if bit 7 (ready bit) is 1: NOT READY YET!
-            if new_data_is_ready:
+            if new_data_is_ready or time.time() > deadline:
                 break
+            time.sleep(poll_interval)
 
         assert new_data_is_ready
-        data_bits = "".join([bin(x)[2:].rjust(8, "0") for x in data])[-bitrate:]
-        sign_bit = data_bits[0]
-        digital_signal = sum(
-            [2**i for i in range(len(data_bits)) if data_bits[::-1][i] == "1"]
-        )
-        if sign_bit == "1":
-            digital_signal = digital_signal - 2**bitrate
+        digital_signal = decode_adc_counts(data, bitrate)
         millivolts = 2 * 2.048 / 2**bitrate * digital_signal * 1000 / gain
         millivolts = round(millivolts, 10)
         lsb_mv = (
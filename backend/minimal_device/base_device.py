@@ -1,6 +1,7 @@
 import os
 import threading
 import time
+from collections import deque
 from datetime import datetime
 import traceback
 import warnings
@@ -15,10 +16,15 @@ from pyftdi.spi import SpiController
 from pyftdi.usbtools import UsbTools
 
 from .adc import Photodiodes
+from .bus_arbiter import BusArbiter
 from .eeprom import EEPROM
 from .lasers import Lasers
+from .motion import MotionMonitor
 from .led import RGBLedController
 from .od_sensor import OdSensor
+from .od_sweep import OdSweep
+from .shadow_registers import ShadowPort, Pca9555ShadowPort, Pca9685ShadowPort
+from .signal_log import SignalLog
 from .pump import Pump
 from .pwm import PwmController
 from .stirrers import Stirrers
@@ -61,6 +67,8 @@ class BaseDevice:
 
         self.i2c = None
         self.spi = None
+        self.i2c_ports = {}  # shadow-register ports by name, kept across reconnects for traffic counters
+        self.connect_timings = {}  # seconds spent in each step of the last connect()
         self.device_data = default_device_data
 
         self.drying_prevention_pump_period_hrs = 12
@@ -69,10 +77,14 @@ class BaseDevice:
 
         self.locks_vials = {v: threading.Lock() for v in range(1, 8)}
         self.lock_pumps = threading.Lock()
+        self.motion_monitor = MotionMonitor()
+        self.dilution_timings = deque(maxlen=100)  # phase durations of the last dilutions
+        self.dilution_cycles = deque(maxlen=100)  # makespans of the last DilutionPlanner cycles
         # self.lock_spi = threading.Lock()
         # self.lock_i2c = threading.Lock()
 
-        self.lock_ftdi = threading.Lock()
+        # shared by all I2C and SPI transactions, serves waiting clients by priority
+        self.lock_ftdi = BusArbiter()
 
         self.file_lock = threading.Lock()
         # self.pump_calibrations_rotations_to_ml = {1: {}, 2: {}, 3: {}, 4: {}}
@@ -87,12 +99,15 @@ class BaseDevice:
         self.lasers = Lasers(device=self)
         self.rgb_leds = RGBLedController(device=self)
         self.od_sensors = {v: OdSensor(device=self, vial_number=v) for v in range(1, 8)}
+        self.od_sweep = OdSweep(device=self)
         self.pump1 = Pump(device=self, cs=0)
         self.pump2 = Pump(device=self, cs=1)
         self.pump3 = Pump(device=self, cs=2)
         self.pump4 = Pump(device=self, cs=3)
         self.thermometers = Thermometers(device=self)
         self.eeprom = EEPROM(device=self)
+        db_directory = "db" if os.path.exists("db") else "../db"
+        self.signal_log = SignalLog(os.path.join(db_directory, "photodiode_signals.ring"))
         self.cultures = CultureDict(self)
         self.cultures[1] = None
         self.cultures[2] = None
@@ -128,6 +143,10 @@ class BaseDevice:
                 self.od_worker.stop()
         except Exception as e:
             logger.error(f"Error stopping od worker: {e}")
+        try:
+            self.signal_log.close()
+        except Exception as e:
+            logger.error(f"Error closing signal log: {e}")
         logger.info("All device workers stopped")
 
     def connect_i2c_spi(self, ftdi_address="ftdi://ftdi:2232h", retries=5):
@@ -156,79 +175,77 @@ class BaseDevice:
             self.lock_pumps.release()
         raise ConnectionError("Failed to connect to I2C and SPI")
 
+    def _connect_part(self, name, connect_function):
+        t0 = time.time()
+        try:
+            connect_function()
+        except Exception as e:
+            warnings.warn(f"Failed to connect {name}: {e}")
+        self.connect_timings[name] = time.time() - t0
+
     def connect(self):
         logger.info("Attempting to connect to device...")
+        t_connect = time.time()
+        self.connect_timings = {}
+        self.resync_shadow_registers()  # chips may have been reset while disconnected
         self.connect_i2c_spi()
-        try:
-            self.eeprom.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect eeprom: {e}")
+        self.connect_timings["i2c_spi"] = time.time() - t_connect
+        self._connect_part("eeprom", self.eeprom.connect)
 
         try:
             frequency = self.device_data["frequency_multiplier"] * 50
         except Exception as e:
             frequency = None
-        try:
-            self.pwm_controller.connect(frequency=frequency)
-        except Exception as e:
-            warnings.warn(f"Failed to connect pwm_controller: {e}")
-
-        try:
-            self.stirrers.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect stirrers: {e}")
-
-        try:
-            self.photodiodes.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect photodiodes: {e}")
-
-        try:
-            self.lasers.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect lasers: {e}")
-
-        try:
-            self.rgb_leds.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect rgb_leds: {e}")
-
-        try:
-            self.thermometers.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect thermometers: {e}")
-
-        try:
-            self.pump1.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect pump1: {e}")
-
-        try:
-            self.pump2.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect pump2: {e}")
-
-        try:
-            self.pump3.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect pump3: {e}")
-
-        try:
-            self.pump4.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect pump4: {e}")
-
-        try:
-            logger.info("Connecting valves")
-            self.valves.connect()
-        except Exception as e:
-            warnings.warn(f"Failed to connect valves: {e}")
+        self._connect_part("pwm_controller", lambda: self.pwm_controller.connect(frequency=frequency))
+        self._connect_part("stirrers", self.stirrers.connect)
+        self._connect_part("photodiodes", self.photodiodes.connect)
+        self._connect_part("lasers", self.lasers.connect)
+        self._connect_part("rgb_leds", self.rgb_leds.connect)
+        self._connect_part("thermometers", self.thermometers.connect)
+        self._connect_part("pump1", self.pump1.connect)
+        self._connect_part("pump2", self.pump2.connect)
+        self._connect_part("pump3", self.pump3.connect)
+        self._connect_part("pump4", self.pump4.connect)
+        logger.info("Connecting valves")
+        self._connect_part("valves", self.valves.connect)
 
         self.dilution_worker = QueueWorker(device=self, worker_name="dilution")
         self.od_worker = QueueWorker(device=self, worker_name="od")
         self.hard_stop_trigger = False
         self.soft_stop_trigger = False
         self.release_vial_locks()
+        self.connect_timings["total"] = time.time() - t_connect
+        logger.info("Device ready %.2f s after connect (eeprom %.2f s)"
+                    % (self.connect_timings["total"], self.connect_timings["eeprom"]))
+
+    def get_i2c_port(self, name, address, chip=None):
+        """
+        I2C port wrapped in a shadow-register layer, see ShadowPort.
+        :param chip: "pca9555", "pca9685" or None for chips that are only counted, not cached
+        """
+        shadow_port = self.i2c_ports.get(name)
+        if shadow_port is None or shadow_port.address != address:
+            if chip == "pca9555":
+                shadow_port = Pca9555ShadowPort(name, address)
+            elif chip == "pca9685":
+                shadow_port = Pca9685ShadowPort(name, address)
+            else:
+                shadow_port = ShadowPort(name, address, cache=False)
+            self.i2c_ports[name] = shadow_port
+        shadow_port.bind(self.i2c.get_port(address))
+        return shadow_port
+
+    def resync_shadow_registers(self):
+        for shadow_port in self.i2c_ports.values():
+            shadow_port.resync()
+
+    def get_i2c_traffic(self):
+        """per-chip I2C transaction counters"""
+        return {name: shadow_port.get_counters() for name, shadow_port in self.i2c_ports.items()}
+
+    def reset_i2c_traffic(self):
+        for shadow_port in self.i2c_ports.values():
+            shadow_port.reset_counters()
 
     @staticmethod
     def reset_usb_device():
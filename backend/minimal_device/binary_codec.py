@@ -0,0 +1,261 @@
+"""
+Compact tagged binary encoding of the device_data dictionary for the EEPROM.
+
+Every value starts with a one byte tag. Integers are zigzag varints. Floats with a short decimal
+representation (calibration values like 0.234) are stored as a decimal mantissa and exponent,
+other floats as float32 when that round-trips exactly and as float64 otherwise.
+Strings and bytes are length prefixed, repeated strings ('open', 'low', ...) refer back to their
+first occurrence within the same section.
+A PAD byte may appear wherever a tag is expected and is skipped by the decoder; encode() can
+use padding to move sections that would straddle a segment boundary to the start of the next
+segment, so that a change in one section shifts at most the sections sharing its segment instead
+of all following ones. Every section starts with a SECTION tag that resets the string table.
+With compress=True every innermost section is stored as a DEFLATE tag with its raw deflate
+compressed encoding when that is shorter, so sections stay independent of each other: a change
+in one section does not alter the bytes of the others, at most their position.
+"""
+import binascii
+import struct
+import zlib
+from decimal import Decimal
+
+import numpy as np
+
+PAD = 0x00
+NONE = 0x01
+FALSE = 0x02
+TRUE = 0x03
+INT = 0x04
+FLOAT64 = 0x05
+STR = 0x06
+LIST = 0x07
+DICT = 0x08
+TUPLE = 0x09
+BYTES = 0x0A
+FLOAT32 = 0x0B
+DECIMAL = 0x0C
+STR_REF = 0x0D
+SECTION = 0x0E
+DEFLATE = 0x0F
+
+
+def _write_varint(out, value):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def _encode_float(out, value):
+    if value == value and abs(value) != float("inf"):
+        sign, digits, exponent = Decimal(repr(value)).as_tuple()
+        if len(digits) <= 9 and -30 <= exponent <= 30:
+            mantissa = int("".join(map(str, digits))) * (-1 if sign else 1)
+            if float("%de%d" % (mantissa, exponent)) == value and not (value == 0 and sign):
+                out.append(DECIMAL)
+                _write_varint(out, _zigzag(mantissa))
+                _write_varint(out, _zigzag(exponent))
+                return
+    packed = struct.pack(">f", value)
+    if struct.unpack(">f", packed)[0] == value or value != value:
+        out.append(FLOAT32)
+        out += packed
+    else:
+        out.append(FLOAT64)
+        out += struct.pack(">d", value)
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)  # raw deflate, no zlib header and checksum
+    return compressor.compress(bytes(data)) + compressor.flush()
+
+
+def _section_encoding(value, compress):
+    """:return: (encoding of a section value, whether it is the DEFLATE encoding)"""
+    plain = bytearray()
+    encode_value(plain, value)
+    if compress:
+        compressed = _deflate(plain)
+        if len(compressed) + 2 < len(plain):
+            section = bytearray([DEFLATE])
+            _write_varint(section, len(compressed))
+            return section + compressed, True
+    return plain, False
+
+
+def encode_value(out, value, align=None, align_depth=0, strings=None, compress=False):
+    """
+    Append the encoding of value to the bytearray out.
+    :param align: callback called with out and the unpadded size of the value before every dictionary value
+        up to align_depth levels deep, used to insert padding
+    :param strings: dictionary string -> index of the strings already written in the current section
+    :param compress: compress the innermost aligned sections, see the module docstring
+    """
+    if strings is None:
+        strings = {}
+    if isinstance(value, np.generic):
+        value = value.item()
+    elif isinstance(value, np.ndarray):
+        value = value.tolist()
+
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        _write_varint(out, _zigzag(value))
+    elif isinstance(value, float):
+        _encode_float(out, value)
+    elif isinstance(value, str):
+        if value in strings:
+            out.append(STR_REF)
+            _write_varint(out, strings[value])
+        else:
+            strings[value] = len(strings)
+            encoded = value.encode("utf-8")
+            out.append(STR)
+            _write_varint(out, len(encoded))
+            out += encoded
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(TUPLE if isinstance(value, tuple) else LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            encode_value(out, item, strings=strings)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            encode_value(out, key, strings=strings)
+            if align is not None and align_depth > 0:
+                innermost = align_depth == 1 or not isinstance(item, dict)
+                section, compressed = _section_encoding(item, compress and innermost)
+                align(out, len(section) + 1)
+                out.append(SECTION)
+                strings.clear()
+                if compressed:
+                    out += section
+                    continue
+            encode_value(out, item, align=align, align_depth=align_depth - 1, strings=strings, compress=compress)
+    else:
+        raise TypeError("Cannot encode %s of type %s" % (value, type(value)))
+
+
+def decode_value(data, pos=0, strings=None):
+    """:return: (value, position after the value)"""
+    if strings is None:
+        strings = []
+    while data[pos] == PAD or data[pos] == SECTION:
+        if data[pos] == SECTION:
+            strings.clear()
+        pos += 1
+    tag = data[pos]
+    pos += 1
+    if tag == NONE:
+        return None, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == INT:
+        zigzag, pos = _read_varint(data, pos)
+        return _unzigzag(zigzag), pos
+    if tag == DECIMAL:
+        mantissa, pos = _read_varint(data, pos)
+        exponent, pos = _read_varint(data, pos)
+        return float("%de%d" % (_unzigzag(mantissa), _unzigzag(exponent))), pos
+    if tag == FLOAT32:
+        return struct.unpack(">f", bytes(data[pos:pos + 4]))[0], pos + 4
+    if tag == FLOAT64:
+        return struct.unpack(">d", bytes(data[pos:pos + 8]))[0], pos + 8
+    if tag == STR or tag == BYTES:
+        length, pos = _read_varint(data, pos)
+        raw = bytes(data[pos:pos + length])
+        if tag == BYTES:
+            return raw, pos + length
+        value = raw.decode("utf-8")
+        strings.append(value)
+        return value, pos + length
+    if tag == STR_REF:
+        index, pos = _read_varint(data, pos)
+        return strings[index], pos
+    if tag == DEFLATE:
+        length, pos = _read_varint(data, pos)
+        section = zlib.decompress(bytes(data[pos:pos + length]), -15)
+        value, _ = decode_value(section, 0)
+        return value, pos + length
+    if tag == LIST or tag == TUPLE:
+        length, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(length):
+            item, pos = decode_value(data, pos, strings)
+            items.append(item)
+        return (tuple(items) if tag == TUPLE else items), pos
+    if tag == DICT:
+        length, pos = _read_varint(data, pos)
+        result = {}
+        for _ in range(length):
+            key, pos = decode_value(data, pos, strings)
+            result[key], pos = decode_value(data, pos, strings)
+        return result, pos
+    raise ValueError("Unknown tag 0x%02x at byte %d" % (tag, pos - 1))
+
+
+def encode(value, segment_size=None, align_depth=1, compress=False):
+    """
+    Encode value as sections: every dictionary value up to align_depth levels deep that does not fit
+    into the rest of the current segment of segment_size bytes starts at the beginning of the next one.
+    :param compress: compress every innermost section on its own (requires segment_size)
+    """
+    out = bytearray()
+    align = None
+    if segment_size is not None:
+        def align(buffer, size):
+            offset = len(buffer) % segment_size
+            if offset and offset + size > segment_size:
+                buffer += bytes([PAD] * (segment_size - offset))
+    encode_value(out, value, align=align, align_depth=align_depth, compress=compress)
+    return bytes(out)
+
+
+def decode(data):
+    value, pos = decode_value(data, 0)
+    return value
+
+
+def crc16(data):
+    return binascii.crc_hqx(bytes(data), 0xFFFF)
+
+
+def crc32(data):
+    return binascii.crc32(bytes(data)) & 0xFFFFFFFF
@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class BusArbiter:
+    """
+    Priority-aware replacement for the global FTDI lock.
+
+    Drop-in compatible with threading.Lock (acquire/release/locked, context manager), but waiting
+    clients are served by priority first and arrival order second:
+    control-critical valve and pump operations, then measurements, then EEPROM persistence.
+
+    Long transactions (EEPROM page writes) call yield_to_waiters() between slices, which hands the
+    bus over if a client of equal or higher priority is waiting, or if any client is waiting and the
+    holder has held the bus for longer than max_slice_seconds since it last acquired it.
+
+    Wait times are recorded per client in a histogram.
+    """
+    PRIORITY_CONTROL = 0
+    PRIORITY_MEASUREMENT = 1
+    PRIORITY_PERSISTENCE = 2
+
+    client_priorities = {
+        "valves": PRIORITY_CONTROL,
+        "pumps": PRIORITY_CONTROL,
+        "pwm": PRIORITY_CONTROL,
+        "photodiodes": PRIORITY_MEASUREMENT,
+        "od_sensors": PRIORITY_MEASUREMENT,
+        "stirrers": PRIORITY_MEASUREMENT,
+        "thermometers": PRIORITY_MEASUREMENT,
+        "eeprom": PRIORITY_PERSISTENCE,
+    }
+    # upper bounds of the wait time histogram bins in seconds, the last bin collects everything longer
+    histogram_bins = (0.001, 0.01, 0.1, 1.0, 10.0)
+    max_slice_seconds = 0.5
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._waiters = []  # heap of (priority, sequence number)
+        self._sequence = itertools.count()
+        self._busy = False
+        self._holder = None  # (client, priority, time acquired)
+        self._stats = {}
+
+    def _client_stats(self, client):
+        if client not in self._stats:
+            self._stats[client] = {
+                "acquisitions": 0,
+                "timeouts": 0,
+                "yields": 0,
+                "total_wait_seconds": 0.0,
+                "max_wait_seconds": 0.0,
+                "total_hold_seconds": 0.0,
+                "max_hold_seconds": 0.0,
+                "wait_histogram": [0] * (len(self.histogram_bins) + 1),
+            }
+        return self._stats[client]
+
+    def _record_wait(self, client, wait, timed_out=False):
+        stats = self._client_stats(client)
+        if timed_out:
+            stats["timeouts"] += 1
+        else:
+            stats["acquisitions"] += 1
+        stats["total_wait_seconds"] += wait
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+        bin_index = len(self.histogram_bins)
+        for i, upper_bound in enumerate(self.histogram_bins):
+            if wait < upper_bound:
+                bin_index = i
+                break
+        stats["wait_histogram"][bin_index] += 1
+
+    def acquire(self, blocking=True, timeout=-1, client="unknown", priority=None):
+        if priority is None:
+            priority = self.client_priorities.get(client, self.PRIORITY_MEASUREMENT)
+        t0 = time.monotonic()
+        with self._condition:
+            if self._busy or len(self._waiters) > 0:
+                if not blocking:
+                    self._record_wait(client, 0.0, timed_out=True)
+                    return False
+                ticket = (priority, next(self._sequence))
+                heapq.heappush(self._waiters, ticket)
+                deadline = None if timeout is None or timeout < 0 else t0 + timeout
+                while self._busy or self._waiters[0] != ticket:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._waiters.remove(ticket)
+                        heapq.heapify(self._waiters)
+                        self._record_wait(client, time.monotonic() - t0, timed_out=True)
+                        self._condition.notify_all()
+                        return False
+                    self._condition.wait(remaining)
+                heapq.heappop(self._waiters)
+            self._busy = True
+            now = time.monotonic()
+            self._holder = (client, priority, now)
+            self._record_wait(client, now - t0)
+            return True
+
+    def release(self):
+        with self._condition:
+            if not self._busy:
+                raise RuntimeError("release unlocked bus arbiter")
+            client, priority, t_acquired = self._holder
+            hold = time.monotonic() - t_acquired
+            stats = self._client_stats(client)
+            stats["total_hold_seconds"] += hold
+            stats["max_hold_seconds"] = max(stats["max_hold_seconds"], hold)
+            self._busy = False
+            self._holder = None
+            self._condition.notify_all()
+
+    def locked(self):
+        return self._busy
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def yield_to_waiters(self, timeout=15):
+        """
+        Called by the bus holder between slices of a long transaction. Releases the bus and queues up again
+        if a client of equal or higher priority is waiting or the current slice took too long.
+        :return: True if the bus was handed over
+        """
+        with self._condition:
+            if not self._busy or len(self._waiters) == 0:
+                return False
+            client, priority, t_acquired = self._holder
+            urgent = self._waiters[0][0] <= priority
+            overdue = time.monotonic() - t_acquired > self.max_slice_seconds
+            if not (urgent or overdue):
+                return False
+            self._client_stats(client)["yields"] += 1
+        self.release()
+        if not self.acquire(timeout=timeout, client=client, priority=priority):
+            raise Exception("Could not reacquire bus for %s after yielding at time %s" % (client, time.ctime()))
+        return True
+
+    def get_wait_stats(self):
+        """per client acquisition counts, wait and hold times, and wait time histograms"""
+        labels = ["<%gs" % b for b in self.histogram_bins] + [">=%gs" % self.histogram_bins[-1]]
+        with self._condition:
+            result = {}
+            for client, stats in self._stats.items():
+                client_result = dict(stats)
+                client_result["wait_histogram"] = dict(zip(labels, stats["wait_histogram"]))
+                n = stats["acquisitions"] + stats["timeouts"]
+                client_result["mean_wait_seconds"] = stats["total_wait_seconds"] / n if n > 0 else 0.0
+                result[client] = client_result
+            result["_queue_length"] = len(self._waiters)
+            result["_holder"] = self._holder[0] if self._holder is not None else None
+            return result
+
+    def reset_wait_stats(self):
+        with self._condition:
+            self._stats = {}
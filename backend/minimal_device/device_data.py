@@ -48,6 +48,7 @@ default_device_data = {
     'ods': {
       'states': {1:0, 2:0, 3:0, 4:0, 5:0, 6:0, 7:0},
         'odsignals': {1:0, 2:0, 3:0, 4:0, 5:0, 6:0, 7:0},
+        'od_errors': {1:None, 2:None, 3:None, 4:None, 5:None, 6:None, 7:None},
         'calibration': {
         1: {0.00123: 40.123,
             0.234: 26.750,
@@ -1,6 +1,13 @@
 import os
+import threading
 import time
 
+from logger.logger import logger
+
+STIRRER_SPINUP_TIME = 0.2  # seconds at high speed before opening the valve
+STIRRER_STOP_DELAY = 3  # seconds of waste pumping before the stirrer is stopped
+VALVE_SETTLE_TIME = 2  # seconds after the last pump finished before the valve is closed
+
 
 def close_valve_gracefully(device, vial):
     try:
@@ -18,63 +25,251 @@ def close_valve_gracefully(device, vial):
         print("Error closing valve %d: %s" % (vial, e))
 
 
+class PlannedDilution:
+    """
+    One dilution of a vial, executed by make_device_dilution or as part of a cycle by DilutionPlanner.
+    :param lock: additional lock (e.g. the experiment lock of the vial) held from the preparation of the vial
+        until its valve is closed. In a DilutionPlanner cycle a dilution whose locks can not be acquired is
+        skipped (skipped is set), the other dilutions of the cycle go on
+    :param on_done: called after the valve was closed
+    """
+
+    def __init__(self, vial, pump1_volume=0, pump2_volume=0, pump3_volume=0, extra_vacuum=5, postfill=True,
+                 lock=None, on_done=None):
+        assert 0 <= pump1_volume <= 30
+        assert 0 <= pump2_volume <= 30
+        assert 0 <= pump1_volume + pump2_volume <= 30
+        assert 0 <= pump3_volume <= 30
+        assert 0 <= extra_vacuum <= 20
+        self.vial = vial
+        self.pump1_volume = pump1_volume
+        self.pump2_volume = pump2_volume
+        self.pump3_volume = pump3_volume
+        self.extra_vacuum = extra_vacuum
+        self.postfill = postfill
+        self.lock = lock
+        self.on_done = on_done
+        self.dilution_volume = pump1_volume + pump2_volume + pump3_volume
+        self.waste_volume = self.dilution_volume + extra_vacuum
+        self.timings = {"vial": vial, "time": time.time(), "phases": {}, "predicted": {}}
+        self.t_phase = time.monotonic()
+        self.locks_held = []
+        self.skipped = False
+
+    def end_phase(self, name):
+        now = time.monotonic()
+        self.timings["phases"][name] = self.timings["phases"].get(name, 0) + now - self.t_phase
+        self.t_phase = now
+
+    def finish_timings(self, device):
+        self.timings["total"] = sum(self.timings["phases"].values())
+        device.dilution_timings.append(self.timings)
+        logger.info("Dilution vial %d took %.1f s: %s" % (
+            self.vial, self.timings["total"],
+            ", ".join("%s %.2f s" % item for item in self.timings["phases"].items())))
+
+
+def _acquire_vial_locks(device, dilution):
+    if dilution.lock is not None:
+        if not dilution.lock.acquire(timeout=10):
+            raise Exception("Could not acquire experiment lock for vial %d at time %s" % (dilution.vial, time.ctime()))
+        dilution.locks_held.append(dilution.lock)
+    if not device.locks_vials[dilution.vial].acquire(timeout=10):
+        _release_vial_locks(dilution)
+        raise Exception("Could not acquire lock for vial %d at time %s" % (dilution.vial, time.ctime()))
+    dilution.locks_held.append(device.locks_vials[dilution.vial])
+
+
+def _release_vial_locks(dilution):
+    while dilution.locks_held:
+        dilution.locks_held.pop().release()
+
+
+def _open_vial(device, dilution):
+    dilution.t_phase = time.monotonic()
+    device.stirrers.set_speed(vial=dilution.vial, speed="high")
+    time.sleep(STIRRER_SPINUP_TIME)
+    dilution.end_phase("stirrer_spinup")
+    device.valves.open(dilution.vial)
+    dilution.end_phase("valve_open")
+
+
+def _hard_stop(device):
+    return lambda: device.hard_stop_trigger
+
+
+def _pump_waste(device, dilution):
+    if dilution.waste_volume <= 0:
+        # Pump.pump does not start a motion for 0 ml, pump4.motion would be stale or None
+        dilution.timings["predicted"]["waste"] = 0
+        dilution.end_phase("waste")
+        return
+    monitor = device.motion_monitor
+    device.stirrers.set_speed(vial=dilution.vial, speed="low")
+    device.pump4.pump(dilution.waste_volume)
+    motion = device.pump4.motion
+    dilution.timings["predicted"]["waste"] = motion.predicted_seconds
+    if not monitor.wait([motion], timeout=STIRRER_STOP_DELAY, abort=_hard_stop(device)):
+        device.stirrers.set_speed(vial=dilution.vial, speed="stopped")
+        monitor.wait([motion], abort=_hard_stop(device))
+    device.stirrers.set_speed(vial=dilution.vial, speed="high")
+    dilution.end_phase("waste")
+
+
+def _fill(device, dilution):
+    motions = []
+    for pump, volume in [(device.pump1, dilution.pump1_volume), (device.pump2, dilution.pump2_volume),
+                         (device.pump3, dilution.pump3_volume)]:
+        if volume > 0:
+            pump.pump(volume)
+            motions.append(pump.motion)
+    dilution.timings["predicted"]["fill"] = max([m.predicted_seconds for m in motions], default=0)
+    device.motion_monitor.wait(motions, abort=_hard_stop(device))
+    dilution.end_phase("fill")
+
+
+def _settle(dilution):
+    time.sleep(VALVE_SETTLE_TIME)
+    dilution.end_phase("settle")
+
+
 def make_device_dilution(device, vial, pump1_volume=0, pump2_volume=0, pump3_volume=0, extra_vacuum=5, postfill=True):
-    assert 0 <= pump1_volume <= 30
-    assert 0 <= pump2_volume <= 30
-    assert 0 <= pump1_volume + pump2_volume <= 30
-    assert 0 <= pump3_volume <= 30
-    assert 0 <= extra_vacuum <= 20
-    dilution_volume = pump1_volume + pump2_volume + pump3_volume
-    waste_volume = dilution_volume + extra_vacuum
-
-    vial_lock_acquired = device.locks_vials[vial].acquire(timeout=10)
-    if not vial_lock_acquired:
-        raise Exception("Could not acquire lock for vial %d at time %s" % (vial, time.ctime()))
+    dilution = PlannedDilution(vial, pump1_volume=pump1_volume, pump2_volume=pump2_volume, pump3_volume=pump3_volume,
+                               extra_vacuum=extra_vacuum, postfill=postfill)
+    _acquire_vial_locks(device, dilution)
 
     lock_pumps_acquired = device.lock_pumps.acquire(timeout=10)
     if not lock_pumps_acquired:
-        device.locks_vials[vial].release()
+        _release_vial_locks(dilution)
         raise Exception("Could not acquire lock for pumps at time %s" % time.ctime())
 
-    def pump_waste():
-        device.stirrers.set_speed(vial=vial, speed="low")
-        device.pump4.pump(waste_volume)
-        vacuum_time_0 = time.time()
-        stirrer_stopped = False
-        while device.pump4.is_pumping():
-            time.sleep(1)
-            if time.time() - vacuum_time_0 > 3 and not stirrer_stopped:
-                device.stirrers.set_speed(vial=vial, speed="stopped")
-                stirrer_stopped = True
-        device.stirrers.set_speed(vial=vial, speed="high")
-
     try:
         assert not device.is_pumping(), "pumping in progress"
-        device.stirrers.set_speed(vial=vial, speed="high")
-        time.sleep(0.2)
-        device.valves.open(vial)
-
+        _open_vial(device, dilution)
         if postfill:
-            pump_waste()
-
+            _pump_waste(device, dilution)
         # add media to vial
-        if pump1_volume > 0:
-            device.pump1.pump(pump1_volume)
-        if pump2_volume > 0:
-            device.pump2.pump(pump2_volume)
-        if pump3_volume > 0:
-            device.pump3.pump(pump3_volume)
-
-        while device.is_pumping():
-            time.sleep(1)
-            assert not device.hard_stop_trigger
-
+        _fill(device, dilution)
         # pump waste
         if not postfill:
-            pump_waste()
-        time.sleep(2)
+            _pump_waste(device, dilution)
+        _settle(dilution)
     finally:
         close_valve_gracefully(device, vial)
-        device.locks_vials[vial].release()
+        dilution.end_phase("valve_close")
+        _release_vial_locks(dilution)
         device.lock_pumps.release()
-    return 0
\ No newline at end of file
+        dilution.finish_timings(device)
+    return 0
+
+
+class DilutionPlanner:
+    """
+    Executes all dilutions of an update cycle as one pipeline instead of one make_device_dilution after another.
+
+    The dilutions are computed first and run in vial order. As soon as the media pumps of a vial are finished,
+    the stirrer of the next vial is spun up and its valve opened in a background thread, overlapping the
+    waste pumping and settling of the current vial. Media is only pumped while a single valve is open, so it
+    can not be split between vials; the valve of a vial is closed only after all its pumps finished, and
+    while the next valve is already open, so the last open valve is never closed while pumping.
+    The order does not change the makespan: the overlap window (waste and settle time) is always longer
+    than opening a valve.
+
+    A vial whose locks can not be acquired in time (e.g. while its OD is being measured) is skipped with a
+    warning and the next vial is prepared instead; the updater decides again in its next cycle. Other errors
+    abort the cycle.
+
+    Per dilution phase timings go to device.dilution_timings, the makespan of every cycle, together with
+    the time the same dilutions would have taken one after another, to device.dilution_cycles.
+    """
+
+    def __init__(self, device):
+        self.device = device
+
+    @staticmethod
+    def order(dilutions):
+        return sorted(dilutions, key=lambda d: d.vial)
+
+    def _prepare(self, dilution, errors):
+        try:
+            _acquire_vial_locks(self.device, dilution)
+        except Exception as e:
+            logger.warning("Skipping dilution of vial %d: %s" % (dilution.vial, e))
+            dilution.skipped = True
+            return
+        try:
+            _open_vial(self.device, dilution)
+        except Exception as e:
+            errors.append(e)
+
+    def _close(self, dilution, completed=False):
+        """close the valve, and log a completed dilution (on_done) before its locks are released, so that no
+        OD of the diluted vial is measured before its pump and generation data are stored"""
+        close_valve_gracefully(self.device, dilution.vial)
+        dilution.end_phase("valve_close")
+        try:
+            if completed and dilution.on_done is not None:
+                dilution.on_done()
+        finally:
+            _release_vial_locks(dilution)
+            dilution.finish_timings(self.device)
+
+    def run(self, dilutions):
+        """:return: dictionary with the makespan of the cycle, or None if there was nothing to dilute"""
+        dilutions = self.order(dilutions)
+        if len(dilutions) == 0:
+            return None
+        device = self.device
+        lock_pumps_acquired = device.lock_pumps.acquire(timeout=10)
+        if not lock_pumps_acquired:
+            raise Exception("Could not acquire lock for pumps at time %s" % time.ctime())
+        t0 = time.monotonic()
+        started = []  # dilutions whose valve may be open
+        preparing = None
+        errors = []
+        try:
+            assert not device.is_pumping(), "pumping in progress"
+            started.append(dilutions[0])
+            self._prepare(dilutions[0], errors)
+            for i, dilution in enumerate(dilutions):
+                if preparing is not None:
+                    preparing.join()
+                    preparing = None
+                if errors:
+                    raise errors[0]
+                if dilution.skipped:
+                    # no valve is open now, prepare the next vial without overlap
+                    started.remove(dilution)
+                    if i + 1 < len(dilutions):
+                        started.append(dilutions[i + 1])
+                        self._prepare(dilutions[i + 1], errors)
+                    continue
+                dilution.t_phase = time.monotonic()  # waiting for the previous vial is not part of this dilution
+                if dilution.postfill:
+                    _pump_waste(device, dilution)
+                _fill(device, dilution)
+                if i + 1 < len(dilutions):
+                    # media pumps are done, open the next valve while this vial is emptied and settles
+                    started.append(dilutions[i + 1])
+                    preparing = threading.Thread(target=self._prepare, args=(dilutions[i + 1], errors), daemon=True)
+                    preparing.start()
+                if not dilution.postfill:
+                    _pump_waste(device, dilution)
+                _settle(dilution)
+                started.remove(dilution)
+                self._close(dilution, completed=True)
+        finally:
+            if preparing is not None:
+                preparing.join()
+            for dilution in started:
+                self._close(dilution)
+            device.lock_pumps.release()
+            makespan = time.monotonic() - t0
+            sequential = sum(d.timings.get("total", 0) for d in dilutions)
+            cycle = {"time": time.time(), "vials": [d.vial for d in dilutions if not d.skipped],
+                     "skipped_vials": [d.vial for d in dilutions if d.skipped], "makespan": makespan,
+                     "sequential_seconds": sequential, "saved_seconds": sequential - makespan}
+            device.dilution_cycles.append(cycle)
+            logger.info("Dilution cycle of vials %s took %.1f s (%.1f s one after another)" % (
+                cycle["vials"], makespan, sequential))
+        return cycle
@@ -7,8 +7,13 @@ from queue import Queue
 import numpy as np
 import yaml
 import gzip
+import zlib
+from minimal_device import binary_codec
 from minimal_device.device_data import default_device_data
 
+# libyaml based loader is an order of magnitude faster when available
+YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
+
 def make_addr_bytes(page=511, byte=63):
     two_bytes = page << 6 | byte
     byte1 = two_bytes >> 8
@@ -18,8 +23,46 @@ def make_addr_bytes(page=511, byte=63):
 
 class EEPROM:
     PAGE_TEST = 511
+    N_PAGES = 512
+    PAGE_SIZE = 64
+    # binary image: page 0 is the image header, data pages start with a version byte and a crc16.
+    # Version 1 images hold the plain binary encoding, version 2 images compress it with zlib as a whole,
+    # version 3 images compress every page aligned section on its own
+    IMAGE_MAGIC = b"RFV7"
+    IMAGE_VERSION = 3
+    PAGE_HEADER_SIZE = 3
+    PAGE_PAYLOAD_SIZE = PAGE_SIZE - PAGE_HEADER_SIZE
+    ALIGN_DEPTH = 2  # sections like valves/states and ods/odsignals start on their own page
+    RATED_WRITE_CYCLES = 1000000
+    # pages per sequential read, the bus is offered to waiting clients in between. At 50 kHz a page takes
+    # ~12 ms on the bus, so reading pages past the end of the image costs more than the saved transactions
+    READ_CHUNK_PAGES = 16
+    LEGACY_CHUNK_PAGES = 4  # length of legacy images is unknown, keep the over-read past the terminator short
 
     class EepromWriter:
+        """
+        Coalescing persistence worker.
+
+        Changes are collected for up to coalesce_window seconds and written once, so a dilution that moves
+        a valve and updates stirrer and OD states results in a single write. The age of the oldest unwritten
+        change is bounded by the window. Changes outside the frequently updated state sections
+        (calibrations, duty cycles, settings), or changes added with critical=True, are written immediately.
+        Changes are detected by a fingerprint of the stable sections, which costs about a millisecond. It is
+        skipped for changes added with states_only=True, like a valve opening during a dilution, and while a
+        write is already due. Pending changes are flushed on stop().
+        """
+        coalesce_window = 10  # seconds
+        # frequently updated sections that may wait for the coalescing window
+        volatile_paths = [
+            ("valves", "states"),
+            ("pumps", "states"),
+            ("stirrers", "states"),
+            ("ods", "states"),
+            ("ods", "odsignals"),
+            ("ods", "od_errors"),
+            ("thermometers", "states"),
+        ]
+
         def __init__(self, eeprom):
             print("Starting EEPROM writer worker thread", time.ctime())
             self.eeprom = eeprom
@@ -27,31 +70,123 @@ class EEPROM:
             self.queue = Queue()
             self.timer = None
             self.lock = threading.Lock()
+            self.condition = threading.Condition(self.lock)
             self._should_exit = False
+            self.pending_since = None
+            self.flush_now = False
+            self.written_fingerprint = None
+            self.stats = self._new_stats()
             self.worker_thread = threading.Thread(target=self.worker)  # non-daemon
             self.worker_thread.start()
 
+        @staticmethod
+        def _new_stats():
+            return {
+                "logical_changes": 0,
+                "physical_writes": 0,
+                "critical_writes": 0,
+                "failed_writes": 0,
+                "max_staleness_seconds": 0.0,
+                "last_write_time": None,
+            }
+
+        def fingerprint(self, data):
+            """crc of everything except the volatile state sections"""
+            stable = dict(data)
+            for section, key in self.volatile_paths:
+                if isinstance(stable.get(section), dict) and key in stable[section]:
+                    stable[section] = {k: v for k, v in stable[section].items() if k != key}
+            try:
+                return binary_codec.crc32(binary_codec.encode(stable))
+            except TypeError:
+                return None  # not encodable, treat as critical
+
         def worker(self):
-            while not self._should_exit:
-                with self.lock:
+            while True:
+                with self.condition:
+                    while not self._should_exit and not self._flush_due():
+                        timeout = None
+                        if self.pending_since is not None:
+                            timeout = max(self.pending_since + self.coalesce_window - time.time(), 0)
+                        self.condition.wait(timeout)
+                    if self._should_exit and self.data is None:
+                        return
                     data = self.data
+                    critical = self.flush_now
+                    staleness = time.time() - self.pending_since
                     self.data = None
-                    if data is not None:
-                        self.eeprom._write_to_eeprom(data)
-                time.sleep(1)
+                    self.pending_since = None
+                    self.flush_now = False
+                self._flush(data, critical, staleness)
 
-        def add_data(self, data):
-            with self.lock:
+        def _flush_due(self):
+            if self.data is None:
+                return False
+            return self.flush_now or time.time() - self.pending_since >= self.coalesce_window
+
+        def _flush(self, data, critical, staleness):
+            try:
+                fingerprint = self.fingerprint(data)
+                self.eeprom._write_to_eeprom(data)
+            except Exception:
+                self.stats["failed_writes"] += 1
+                print("EEPROM writer failed to write data at time %s" % time.ctime())
+                traceback.print_exc()
+                return
+            self.written_fingerprint = fingerprint
+            self.stats["physical_writes"] += 1
+            if critical:
+                self.stats["critical_writes"] += 1
+            self.stats["max_staleness_seconds"] = max(self.stats["max_staleness_seconds"], staleness)
+            self.stats["last_write_time"] = time.time()
+
+        def add_data(self, data, critical=False, states_only=False):
+            """:param states_only: only the volatile state sections changed, no need to compare fingerprints"""
+            with self.condition:
                 self.data = data
+                self.stats["logical_changes"] += 1
+                if self.pending_since is None:
+                    self.pending_since = time.time()
+                if critical:
+                    self.flush_now = True
+                elif not states_only and not self.flush_now:
+                    self.flush_now = self.fingerprint(data) != self.written_fingerprint
+                self.condition.notify_all()
                 # print("Added data to EEPROM writer queue", time.ctime())
 
+        def get_stats(self):
+            with self.lock:
+                stats = dict(self.stats)
+                stats["pending"] = self.data is not None
+                stats["pending_seconds"] = time.time() - self.pending_since if self.pending_since is not None else 0
+            stats["coalesce_window"] = self.coalesce_window
+            stats["write_amplification"] = stats["physical_writes"] / stats["logical_changes"] \
+                if stats["logical_changes"] > 0 else None
+            stats["page_writes"] = int(self.eeprom.page_write_counts.sum())
+            stats["page_writes_per_change"] = stats["page_writes"] / stats["logical_changes"] \
+                if stats["logical_changes"] > 0 else None
+            return stats
+
+        def reset_stats(self):
+            with self.lock:
+                self.stats = self._new_stats()
+
         def stop(self):
-            self._should_exit = True
+            """write pending changes and stop the worker"""
+            with self.condition:
+                self._should_exit = True
+                self.condition.notify_all()
             self.worker_thread.join()
 
     def __init__(self, device):
         self.device = device
         self.port = None
+        self.last_image = None  # pages last written to / read from the EEPROM, None if unknown
+        self.page_write_counts = np.zeros(self.N_PAGES, dtype=int)
+        self.bytes_written = 0
+        self.image_writes = 0
+        self.pages_skipped = 0
+        self.last_write_pages = []
         self.writer = self.EepromWriter(self)
         if self.device.is_connected():
             self.connect()
@@ -72,7 +207,7 @@ class EEPROM:
             print(f"Created {filename} with default device data.")
         else:
             with open(filename, 'r') as file:
-                self.device.device_data = yaml.load(file, Loader=yaml.Loader)
+                self.device.device_data = yaml.load(file, Loader=YamlLoader)
             print(f"Loaded device data from {filename}.")
         self.using_filewriter = True
 
@@ -84,7 +219,7 @@ class EEPROM:
     def _read_from_file(self):
         filename = self.filename
         with open(filename, 'r') as file:
-            data = yaml.load(file, Loader=yaml.Loader)
+            data = yaml.load(file, Loader=YamlLoader)
         print(f"Read data from {filename}.")
         return data
 
@@ -111,50 +246,128 @@ class EEPROM:
             traceback.print_exc()
             raise Exception("Could not connect to EEPROM")
 
-    def save_config_to_eeprom(self):
+    def save_config_to_eeprom(self, critical=False, states_only=False):
         """
         Writes the device object config to the EEPROM
-        :param from_file: file directory, the config is read from the file instead of the device object
+        :param critical: write immediately instead of coalescing with other changes
+        :param states_only: only states (valves, pumps, stirrers, ods, thermometers) changed since the last save
         :return:
         """
-        self.writer.add_data(self.device.device_data)
+        self.writer.add_data(self.device.device_data, critical=critical, states_only=states_only)
 
     def _write_to_eeprom(self, data):
         if self.using_filewriter:
             self._write_to_file(data)
             return
 
-        config_to_write = data
-        config_to_write = yaml.dump(config_to_write)
-        config_to_write = config_to_write.encode("utf-8")
-        config_to_write = gzip.compress(config_to_write)
-        config_bytes = bytearray(config_to_write)
-        # filler_size = 32768 - len(config_bytes)
-        filler_size = 64
-        # print("Writing", len(config_bytes), "bytes to EEPROM", time.ctime())
-        # print(filler_size, "bytes of filler to write to EEPROM")
-        for i in range(filler_size):
-            config_bytes.append(0xFF)
-        n_pages_to_write = int(np.ceil(len(config_bytes) / 64))
-
-
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        self._write_binary_image(data)
+
+    def _encode_image(self, data):
+        """
+        Encode data into a list of 64 byte pages: the image header page followed by the data pages.
+        The payload is the binary encoding with every section (like valves/states or ods/calibration)
+        compressed on its own and moved to the next page if it would straddle a page boundary, so a change
+        of one section usually only changes the pages it is on, as without compression (a change of its
+        compressed size can move the following sections). Compressing saves about a third of the pages.
+        Header page: magic, version, payload length, payload crc32, header crc16. It only depends on the
+        payload, so it is unchanged as long as the data is.
+        Data page: version, crc16 of page number and payload, 61 payload bytes.
+        """
+        payload = binary_codec.encode(data, segment_size=self.PAGE_PAYLOAD_SIZE, align_depth=self.ALIGN_DEPTH,
+                                      compress=True)
+        n_data_pages = int(np.ceil(len(payload) / self.PAGE_PAYLOAD_SIZE))
+        if n_data_pages + 1 > self.PAGE_TEST:
+            raise Exception("device data too large for EEPROM (%d bytes) at time %s" % (len(payload), time.ctime()))
+        padded = payload + bytes([binary_codec.PAD] * (n_data_pages * self.PAGE_PAYLOAD_SIZE - len(payload)))
+
+        header = bytearray(self.IMAGE_MAGIC)
+        header.append(self.IMAGE_VERSION)
+        header += len(payload).to_bytes(4, "big")
+        header += binary_codec.crc32(payload).to_bytes(4, "big")
+        header += binary_codec.crc16(header).to_bytes(2, "big")
+        header += bytes([0xFF] * (self.PAGE_SIZE - len(header)))
+        pages = [bytes(header)]
+        for i in range(n_data_pages):
+            page_payload = padded[i * self.PAGE_PAYLOAD_SIZE:(i + 1) * self.PAGE_PAYLOAD_SIZE]
+            page_number = i + 1
+            crc = binary_codec.crc16(page_number.to_bytes(2, "big") + page_payload)
+            pages.append(bytes([self.IMAGE_VERSION]) + crc.to_bytes(2, "big") + page_payload)
+        return pages
+
+    def _decode_data_page(self, page_number, page_bytes, version):
+        """:return: payload of a data page, raises if the page is torn or from another format version"""
+        if page_bytes[0] != version:
+            raise Exception("EEPROM page %d has version %d, expected %d" % (page_number, page_bytes[0], version))
+        payload = bytes(page_bytes[self.PAGE_HEADER_SIZE:self.PAGE_SIZE])
+        crc = int.from_bytes(page_bytes[1:3], "big")
+        if crc != binary_codec.crc16(page_number.to_bytes(2, "big") + payload):
+            raise Exception("EEPROM page %d checksum mismatch (torn write?)" % page_number)
+        return payload
+
+    def _parse_image_header(self, header_page):
+        """:return: (version, payload length, payload crc32) or None if the page is not a binary image header"""
+        header_page = bytes(header_page)
+        if not header_page.startswith(self.IMAGE_MAGIC):
+            return None
+        version = header_page[4]
+        if version not in (1, 2, self.IMAGE_VERSION):
+            raise Exception("Unsupported EEPROM image version %d" % version)
+        offset = 9 if version == 1 else 5  # version 1 headers have a generation number before the length
+        if binary_codec.crc16(header_page[:offset + 8]) != int.from_bytes(header_page[offset + 8:offset + 10], "big"):
+            raise Exception("EEPROM image header checksum mismatch")
+        length = int.from_bytes(header_page[offset:offset + 4], "big")
+        crc = int.from_bytes(header_page[offset + 4:offset + 8], "big")
+        return version, length, crc
+
+    def _write_binary_image(self, data):
+        """
+        Write only the pages that differ from the last image, including the header page. Data pages are
+        written first and the header page last, so an interrupted write leaves a header whose payload crc
+        does not match.
+        """
+        pages = self._encode_image(data)
+        previous = self.last_image
+        dirty_pages = [page for page in list(range(1, len(pages))) + [0]
+                       if previous is None or page >= len(previous) or previous[page] != pages[page]]
+        if len(dirty_pages) == 0 and len(previous) == len(pages):
+            self.pages_skipped += len(pages)
+            self.last_write_pages = []
+            return
+
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="eeprom")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire ftdi lock for writing to EEPROM at time %s" % time.ctime())
         try:
-            # print(n_pages_to_write,"pages to write to EEPROM")
-            for page in range(n_pages_to_write):
+            for page in dirty_pages:
                 b1, b2 = make_addr_bytes(page=page, byte=0)
-                self.port.write([b1, b2] + [b for b in config_bytes[64 * page : 64 * (page + 1)]])
+                self.port.write([b1, b2] + list(pages[page]))
+                self.page_write_counts[page] += 1
+                self.bytes_written += self.PAGE_SIZE
+                self.device.lock_ftdi.yield_to_waiters()  # let valves, pumps and measurements in between pages
             self.eeprom_config = self.device.device_data
         finally:
             self.device.lock_ftdi.release()
-        #     if page % 20 == 0:
-        #         print(
-        #             "Writing to EEPROM: %d%% done" % (page / 5.12),
-        #             end="                              \r",
-        #         )
-        # print("Writing new config to EEPROM COMPLETE")
+        self.last_image = pages
+        self.image_writes += 1
+        self.pages_skipped += len(pages) - len(dirty_pages)
+        self.last_write_pages = dirty_pages
+
+    def get_wear_stats(self):
+        """bytes and pages written since startup, and write counts per page"""
+        written = np.nonzero(self.page_write_counts)[0]
+        most_worn_page = int(np.argmax(self.page_write_counts))
+        return {
+            "image_writes": self.image_writes,
+            "bytes_written": self.bytes_written,
+            "page_writes": int(self.page_write_counts.sum()),
+            "pages_skipped": self.pages_skipped,
+            "image_pages": len(self.last_image) if self.last_image is not None else None,
+            "last_write_pages": self.last_write_pages,
+            "most_worn_page": most_worn_page,
+            "max_page_writes": int(self.page_write_counts[most_worn_page]),
+            "max_wear_fraction": float(self.page_write_counts[most_worn_page]) / self.RATED_WRITE_CYCLES,
+            "page_write_counts": {int(page): int(self.page_write_counts[page]) for page in written},
+        }
 
     def load_config_from_eeprom(self):
         """
@@ -207,55 +420,115 @@ class EEPROM:
 
     def read_from_page(self, page):
         tail = bytearray([0xFF] * 1)
-        b1, b2 = make_addr_bytes(page=page, byte=0)
-        self.port.write([b1, b2], relax=False)
-        bytes_read = self.port.read(64)
+        bytes_read = self._read_pages(page, 1)
         assert len(bytes_read.partition(tail)[-1]) > 0
         decoded_data = bytes_read.partition(tail)[0].decode("utf-8")
-        data = yaml.load(decoded_data, Loader=yaml.Loader)
+        data = yaml.load(decoded_data, Loader=YamlLoader)
         return data
 
     def erase_memory(self):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="eeprom")
         if not lock_acquired:
             raise Exception("Could not acquire lock for erasing EEPROM at time %s" % time.ctime())
         try:
             for page in range(512):
                 b1, b2 = make_addr_bytes(page=page, byte=0)
                 self.port.write([b1, b2] + [0xFF] * 64)
+                self.page_write_counts[page] += 1
+                self.bytes_written += self.PAGE_SIZE
+                self.device.lock_ftdi.yield_to_waiters()
                 if page % 10 == 0:
                     print(
                         "Erasing EEPROM: %d%% done" % (page / 5.12),
                         end="                 \r",
                     )
             print("Erasing EEPROM complete")
+            self.last_image = None
+        finally:
+            self.device.lock_ftdi.release()
+
+    def _read_pages(self, first_page, n_pages):
+        """
+        Sequential read: one address write followed by a single read of n_pages consecutive pages,
+        the EEPROM increments the address internally. Must be called with lock_ftdi held.
+        """
+        b1, b2 = make_addr_bytes(page=first_page, byte=0)
+        self.port.write([b1, b2], relax=False)
+        return bytes(self.port.read(self.PAGE_SIZE * n_pages))
+
+    def _read_binary_image(self):
+        """:return: device data from a binary image, None if the EEPROM holds the legacy gzip format"""
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="eeprom")
+        if not lock_acquired:
+            raise Exception("Could not acquire lock for reading EEPROM at time %s" % time.ctime())
+        try:
+            raw = self._read_pages(0, 1)
+            header = self._parse_image_header(raw)
+            if header is None:
+                return None
+            version, length, crc = header
+            n_pages = int(np.ceil(length / self.PAGE_PAYLOAD_SIZE)) + 1
+            while len(raw) < n_pages * self.PAGE_SIZE:
+                self.device.lock_ftdi.yield_to_waiters()
+                n_chunk = min(self.READ_CHUNK_PAGES, n_pages - len(raw) // self.PAGE_SIZE)
+                raw += self._read_pages(len(raw) // self.PAGE_SIZE, n_chunk)
         finally:
             self.device.lock_ftdi.release()
+        pages = [raw[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE] for page in range(n_pages)]
+        payload = b"".join(self._decode_data_page(page, pages[page], version)
+                           for page in range(1, len(pages)))[:length]
+        if binary_codec.crc32(payload) != crc:
+            raise Exception("EEPROM image crc mismatch, the last write was not completed")
+        if version == 2:
+            payload = zlib.decompress(payload)
+        data = binary_codec.decode(payload)
+        # images of older versions are rewritten in the current version on the next save
+        self.last_image = pages if version == self.IMAGE_VERSION else None
+        return data
 
     def read_eeprom(self):
         if self.using_filewriter:
             return self._read_from_file()
-        pages_read = []
-        tail = bytearray([0xFF] * 63)
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        try:
+            loaded_data = self._read_binary_image()
+        except Exception:
+            traceback.print_exc()
+            self.using_filewriter = True
+            print("Falling back to file writer")
+            return self._read_from_file()
+        if loaded_data is not None:
+            self._write_to_file(loaded_data)
+            return loaded_data
+        return self._read_legacy_eeprom()
+
+    def _read_legacy_eeprom(self):
+        """gzip compressed YAML terminated by 0xFF bytes, as written before the binary image format"""
+        pages_read = bytearray()
+        tail = bytes([0xFF] * 63)
+        end = -1
+        first_page = 0
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="eeprom")
         if not lock_acquired:
             raise Exception("Could not acquire lock for reading EEPROM at time %s" % time.ctime())
         try:
-            for page in range(512):
-                b1, b2 = make_addr_bytes(page=page, byte=0)
-                self.port.write([b1, b2], relax=False)
-                bytes_read = self.port.read(64)
-                pages_read += bytes_read
-                if len(bytes_read.partition(tail)[-1]) > 0:
+            while first_page < self.N_PAGES:
+                if first_page > 0:
+                    self.device.lock_ftdi.yield_to_waiters()
+                n_chunk = min(self.LEGACY_CHUNK_PAGES, self.N_PAGES - first_page)
+                searched = len(pages_read)
+                pages_read += self._read_pages(first_page, n_chunk)
+                # only search the new chunk and a terminator that may start in the previous one
+                end = pages_read.find(tail, max(0, searched - len(tail) + 1))
+                if end >= 0:
                     break
-                print("Reading EEPROM: content found in %d pages" % (page + 1),end="                    \r",)
+                first_page += n_chunk
         finally:
             self.device.lock_ftdi.release()
         try:
-            compressed_data = bytearray(pages_read).partition(tail)[0]
+            compressed_data = pages_read[:end] if end >= 0 else pages_read
             loaded_data = gzip.decompress(compressed_data)
             loaded_data = loaded_data.decode("utf-8")
-            loaded_data = yaml.load(loaded_data, Loader=yaml.Loader)
+            loaded_data = yaml.load(loaded_data, Loader=YamlLoader)
         except Exception:
             traceback.print_exc()
             print("Pages read:", pages_read)
@@ -24,8 +24,8 @@ class Lasers:
 
     def connect(self):
         try:
-            self.multiplexer_port = self.device.i2c.get_port(
-                self.device.PORT_GPIO_MULTIPLEXER_LASERS
+            self.multiplexer_port = self.device.get_i2c_port(
+                "lasers_multiplexer", self.device.PORT_GPIO_MULTIPLEXER_LASERS, chip="pca9555"
             )
             self.multiplexer_port.write_to(6, [0x00])  # set all GPIO pins as output
             self.multiplexer_port.write_to(7, [0x00])  # set all GPIO pins as output
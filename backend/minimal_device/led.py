@@ -4,6 +4,8 @@ import time
 import pyftdi.i2c
 import warnings
 
+from .pwm import ALL_LED_ON_L, plan_channel_bursts
+
 
 class RGBLedController:
     """Controller for RGB LEDs using PCA9685 on two I2C addresses."""
@@ -29,11 +31,11 @@ class RGBLedController:
         """Establish connections to the PCA9685 controllers and configure them."""
         try:
             # Connect to the first PCA9685 (LEDs 1-5)
-            self.port_rgb_pwm1 = self.device.i2c.get_port(self.device.PORT_RGB_PWM1)
+            self.port_rgb_pwm1 = self.device.get_i2c_port("rgb_pwm1", self.device.PORT_RGB_PWM1, chip="pca9685")
             self._initialize_pwm_controller(self.port_rgb_pwm1)
 
             # Connect to the second PCA9685 (LEDs 6-7)
-            self.port_rgb_pwm2 = self.device.i2c.get_port(self.device.PORT_RGB_PWM2)
+            self.port_rgb_pwm2 = self.device.get_i2c_port("rgb_pwm2", self.device.PORT_RGB_PWM2, chip="pca9685")
             self._initialize_pwm_controller(self.port_rgb_pwm2)
 
             print("Connected to both PCA9685 RGB controllers")
@@ -43,6 +45,8 @@ class RGBLedController:
     def _initialize_pwm_controller(self, port):
         """Initialize a PCA9685 controller."""
         self._set_frequency(port, self.frequency)
+        with self.lock:
+            port.write_to(ALL_LED_ON_L, [0x00, 0x00])  # ON count 0 for all channels
         self._set_all_leds(port, 0, 0, 0)  # Turn off all LEDs initially
 
     def set_flicker_frequency(self, frequency):
@@ -58,9 +62,9 @@ class RGBLedController:
         """Set the PWM frequency on a specific PCA9685 port."""
         pre_scale = round(25000000 / (4096 * frequency)) - 1
         with self.lock:
-            port.write_to(0x00, [0x10])  # Enter sleep mode
+            port.write_to(0x00, [0x30])  # Enter sleep mode, register auto-increment
             port.write_to(0xFE, [pre_scale])  # Set frequency
-            port.write_to(0x00, [0x80])  # Restart in normal mode
+            port.write_to(0x00, [0xA0])  # Restart in normal mode, register auto-increment
 
     def set_led(self, led_number, red, green, blue):
         """
@@ -82,20 +86,23 @@ class RGBLedController:
 
         self._set_rgb_pwm(port, base_pin, red, green, blue)
 
+    @staticmethod
+    def _rgb_pin_values(base_pin, red, green, blue):
+        return {base_pin + 1: red, base_pin + 2: green, base_pin: blue}
+
     def _set_rgb_pwm(self, port, base_pin, red, green, blue):
         """Set the PWM values for an RGB LED."""
-        self._set_pwm(port, base_pin + 1, red)
-        self._set_pwm(port, base_pin + 2, green)
-        self._set_pwm(port, base_pin, blue)
+        self._set_pwm_values(port, self._rgb_pin_values(base_pin, red, green, blue))
 
     def _set_pwm(self, port, pin, duty_cycle):
         """Set the PWM duty cycle for a specific pin on a given port."""
-        msb, lsb = divmod(round(4095 * duty_cycle), 0x100)
+        self._set_pwm_values(port, {pin: duty_cycle})
+
+    def _set_pwm_values(self, port, duty_cycle_by_pin):
+        """Set the PWM duty cycles of several pins on a given port in as few burst writes as possible."""
         with self.lock:
-            # port.write_to(0x06 + pin * 4, [0x00])  # ON low byte
-            # port.write_to(0x07 + pin * 4, [0x00])  # ON high byte
-            port.write_to(0x08 + pin * 4, [lsb])   # OFF low byte
-            port.write_to(0x09 + pin * 4, [msb])   # OFF high byte
+            for start_register, data in plan_channel_bursts(duty_cycle_by_pin, getattr(port, "registers", None)):
+                port.write_to(start_register, data)
 
     def set_all_leds(self, red, green, blue):
         """
@@ -109,9 +116,11 @@ class RGBLedController:
 
     def _set_all_leds(self, port, red, green, blue):
         """Set all LEDs connected to a specific port to the same color."""
+        duty_cycle_by_pin = {}
         for i in range(5 if port == self.port_rgb_pwm1 else 2):
             base_pin = i * 3
-            self._set_rgb_pwm(port, base_pin, red, green, blue)
+            duty_cycle_by_pin.update(self._rgb_pin_values(base_pin, red, green, blue))
+        self._set_pwm_values(port, duty_cycle_by_pin)
 
     def blink_hello(self):
         """Blink green LEDs."""
@@ -0,0 +1,162 @@
+import math
+import threading
+import time
+
+from logger.logger import logger
+
+TICK = 250e-9  # L6470 internal tick, 250 ns
+STEPS_PER_ROTATION = 200
+
+
+def register_acceleration_rps2(value, n_bits=12):
+    """rotations/s^2 programmed by Stepper.set_acceleration(value) (ACC/DEC unit: 2^-40 step/tick^2)"""
+    register = max(1, int(value * (2 ** n_bits - 1)))
+    return register * 2 ** -40 / TICK ** 2 / STEPS_PER_ROTATION
+
+
+def register_max_speed_rps(rot_per_sec):
+    """rotations/s programmed by Stepper.set_max_speed(rot_per_sec), after register quantization"""
+    speed_integer = int(STEPS_PER_ROTATION * rot_per_sec * TICK * 2 ** 18)
+    register = max(1, int(speed_integer * 2 ** -10 * (2 ** 10 - 1)))
+    return register * 2 ** -18 / TICK / STEPS_PER_ROTATION
+
+
+def predict_move_duration(n_rotations, rot_per_sec, acceleration, deceleration):
+    """
+    Duration of a L6470 move command with a trapezoidal speed profile (triangular if the move is too
+    short to reach the maximum speed). Speeds in rotations/s, accelerations in rotations/s^2.
+    """
+    distance = abs(n_rotations)
+    if distance == 0:
+        return 0.0
+    distance_ramps = rot_per_sec ** 2 / (2 * acceleration) + rot_per_sec ** 2 / (2 * deceleration)
+    if distance_ramps <= distance:
+        return rot_per_sec / acceleration + rot_per_sec / deceleration + (distance - distance_ramps) / rot_per_sec
+    peak_speed = math.sqrt(2 * distance * acceleration * deceleration / (acceleration + deceleration))
+    return peak_speed / acceleration + peak_speed / deceleration
+
+
+class Motion:
+    """A single stepper move, done is set when the driver reports the move finished."""
+
+    def __init__(self, name, n_rotations, predicted_seconds):
+        self.name = name
+        self.n_rotations = n_rotations
+        self.predicted_seconds = predicted_seconds
+        self.started = time.monotonic()
+        self.finished = None
+        self.polls = 0
+        self.overdue = False
+        self.done = threading.Event()
+        self._wake = threading.Event()
+
+    def wake(self):
+        """start polling the driver now, e.g. after the motor was stopped before the predicted end"""
+        self._wake.set()
+
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    def to_dict(self):
+        return {"name": self.name, "n_rotations": self.n_rotations, "predicted_seconds": self.predicted_seconds,
+                "elapsed_seconds": self.elapsed(), "polls": self.polls, "overdue": self.overdue,
+                "done": self.done.is_set()}
+
+
+class MotionMonitor:
+    """
+    Motion-completion service for the pump steppers.
+
+    Every move is followed by its own thread, which sleeps until wake_margin seconds before the end
+    predicted from the move length, speed and acceleration, and then polls the BUSY flag of the driver
+    every poll_interval seconds until the move is finished and sets motion.done.
+    A move that takes longer than predicted (stall, wrong calibration of the speed registers) is polled
+    further at overdue_poll_interval, completion is never signalled before the driver reports it.
+    """
+    wake_margin = 0.3  # seconds
+    poll_interval = 0.05  # seconds
+    overdue_factor = 1.5
+    overdue_seconds = 5
+    overdue_poll_interval = 1  # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def watch(self, stepper, n_rotations, rot_per_sec):
+        """start following a move that was just sent to stepper, :return: Motion"""
+        predicted = predict_move_duration(n_rotations,
+                                          register_max_speed_rps(rot_per_sec),
+                                          register_acceleration_rps2(stepper.acceleration),
+                                          register_acceleration_rps2(stepper.deceleration))
+        motion = Motion("pump%d" % (stepper.cs + 1), n_rotations, predicted)
+        thread = threading.Thread(target=self._follow, args=(stepper, motion), daemon=True)
+        thread.start()
+        return motion
+
+    def _follow(self, stepper, motion):
+        motion._wake.wait(max(0.0, motion.predicted_seconds - self.wake_margin))
+        deadline = motion.started + motion.predicted_seconds * self.overdue_factor + self.overdue_seconds
+        try:
+            while True:
+                try:
+                    busy = stepper.is_busy()
+                except Exception as e:
+                    logger.warning(f"Could not read busy flag of {motion.name}: {e}")
+                    busy = True
+                motion.polls += 1
+                if not busy:
+                    break
+                if time.monotonic() > deadline:
+                    if not motion.overdue:
+                        logger.warning(f"{motion.name} still busy {motion.elapsed():.1f} s after a move predicted "
+                                       f"to take {motion.predicted_seconds:.1f} s")
+                    motion.overdue = True
+                    time.sleep(self.overdue_poll_interval)
+                else:
+                    time.sleep(self.poll_interval)
+        finally:
+            motion.finished = time.monotonic()
+            self._record(motion)
+            motion.done.set()
+
+    def _record(self, motion):
+        error = motion.elapsed() - motion.predicted_seconds
+        with self.lock:
+            stats = self.stats.setdefault(motion.name, {"moves": 0, "polls": 0, "overdue": 0,
+                                                        "total_seconds": 0.0, "max_prediction_error_seconds": 0.0,
+                                                        "total_prediction_error_seconds": 0.0})
+            stats["moves"] += 1
+            stats["polls"] += motion.polls
+            stats["overdue"] += int(motion.overdue)
+            stats["total_seconds"] += motion.elapsed()
+            stats["total_prediction_error_seconds"] += error
+            if abs(error) > abs(stats["max_prediction_error_seconds"]):
+                stats["max_prediction_error_seconds"] = error
+
+    def wait(self, motions, timeout=None, abort=None):
+        """
+        Wait until all motions are done.
+        :param abort: callable checked while waiting, an exception is raised when it returns True
+        :return: True if all motions are done, False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for motion in motions:
+            while not motion.done.is_set():
+                if abort is not None and abort():
+                    raise Exception("Waiting for %s aborted at time %s" % (motion.name, time.ctime()))
+                remaining = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+                if remaining <= 0:
+                    return False
+                motion.done.wait(remaining)
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            result = {}
+            for name, stats in self.stats.items():
+                result[name] = dict(stats)
+                result[name]["mean_prediction_error_seconds"] = stats["total_prediction_error_seconds"] / stats["moves"]
+                result[name]["mean_polls"] = stats["polls"] / stats["moves"]
+            return result
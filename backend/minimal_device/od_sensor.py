@@ -1,4 +1,4 @@
-import os
+import math
 import time
 
 import numpy as np
@@ -123,35 +123,99 @@ def BeerLambertScaledInverse(od, blank, scaling):
         return np.zeros_like(od) if od.shape else 0.0
 
 
+class CalibrationTransform:
+    """
+    Signal to optical density conversion of one vial, compiled from the fitted Beer-Lambert blank and scaling.
+    Works on scalars and numpy arrays; like BeerLambertScaled, invalid signals convert to 0 OD.
+    """
+
+    def __init__(self, blank, scaling, vial_number=None):
+        self.blank = blank
+        self.scaling = scaling
+        self.vial_number = vial_number
+        self.valid = (blank is not None and scaling is not None and np.isfinite(blank) and np.isfinite(scaling)
+                      and blank > 0 and scaling > 0)
+
+    def __call__(self, mv):
+        if isinstance(mv, (int, float)):
+            # scalar fast path for live measurements
+            if not self.valid:
+                return 0.0
+            if not (0 < mv < math.inf):
+                logger.warning(f"Invalid signal {mv} for vial {self.vial_number} (must be positive), returning 0 OD")
+                return 0.0
+            return -math.log10(mv / self.blank) * self.scaling
+        mv = np.asarray(mv, dtype=float)
+        if not self.valid:
+            od = np.zeros_like(mv)
+        else:
+            valid_signal = np.isfinite(mv) & (mv > 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                od = -np.log10(mv / self.blank) * self.scaling
+            od = np.where(valid_signal & np.isfinite(od), od, 0.0)
+            n_invalid = mv.size - np.count_nonzero(valid_signal)
+            if n_invalid > 0:
+                logger.warning(f"{n_invalid} invalid signal(s) for vial {self.vial_number} (must be positive and finite), "
+                               f"returning 0 OD")
+        if od.ndim == 0:
+            return float(od)
+        return od
+
+    def __repr__(self):
+        return "CalibrationTransform(vial=%s, blank=%s, scaling=%s)" % (self.vial_number, self.blank, self.scaling)
+
+
 class OdSensor:
+    laser_warmup_time = 0.02
+    sample_overhead_time = 0.01  # I2C traffic for multiplexer, lasers and ADC per sample pair
+    max_samples = 64
+
     def __init__(self, device, vial_number):
         self.device = device
         self.vial_number = vial_number
+        self._calibration_transform = None
+        self._calibration_source = None  # device_data the transform was compiled from
+        self.last_raw_signals = None  # (transmitted, background) mean millivolts of the last measure_od
+        self.last_od_error = None  # standard error of the od from the last measure_od
+
+    def invalidate_calibration(self):
+        """forget the compiled calibration transform, called whenever calibration data changes"""
+        self._calibration_transform = None
+
+    def calibration_transform(self):
+        """cached signal -> OD transform, compiled on first use after the calibration changed"""
+        if self._calibration_transform is None or self._calibration_source is not self.device.device_data:
+            self._calibration_source = self.device.device_data
+            self._calibration_transform = self._compile_calibration_transform()
+        return self._calibration_transform
 
     def mv_to_od(self, mv):
-        # Validate input
-        if not np.isfinite(mv):
-            logger.error(f"Invalid mv value {mv} for vial {self.vial_number}")
-            return 0.0
-            
+        """
+        convert photodiode signal to optical density
+        :param mv: signal in millivolts, scalar or array (e.g. a whole history of signals after recalibration)
+        :return: float for scalar input, numpy array otherwise
+        """
+        return self.calibration_transform()(mv)
+
+    def _compile_calibration_transform(self):
         coefs = self.device.device_data['ods']['calibration_coefs'][self.vial_number]
         if len(coefs) > 3:
             self.fit_calibration_function()
-            print("fit calibration function with beer-lambert scaled because there were too many calibration coefficients")
+            logger.info("fit calibration function with beer-lambert scaled because there were too many calibration coefficients")
             coefs = self.device.device_data['ods']['calibration_coefs'][self.vial_number]
-            
+
         # Validate coefficients
         if len(coefs) < 2:
             logger.error(f"Insufficient calibration coefficients for vial {self.vial_number}: {coefs}")
-            return 0.0
-            
+            return CalibrationTransform(None, None, self.vial_number)
+
         blank_signal, scaling = coefs
-        
+
         # Validate coefficients for NaN/infinity
         if not np.isfinite(blank_signal) or not np.isfinite(scaling):
             logger.error(f"Invalid calibration coefficients for vial {self.vial_number}: blank={blank_signal}, scaling={scaling}")
-            return 0.0
-            
+            return CalibrationTransform(None, None, self.vial_number)
+
         # if the minimum value in calibration is equal to 0 or 0.0, use it as blank
         try:
             calibration_keys = list(self.device.device_data['ods']['calibration'][self.vial_number].keys())
@@ -163,17 +227,13 @@ class OdSensor:
                         blank_signal = blank_from_calibration
             else:
                 logger.info(f"No calibration data available for vial {self.vial_number} yet")
-        except (ValueError, KeyError) as e:
+        except (ValueError, KeyError, TypeError) as e:
             logger.warning(f"Could not check for OD=0 calibration point for vial {self.vial_number}: {e}")
-            
-        result = BeerLambertScaled(mv, blank_signal, scaling)
-        
-        # Final validation of result
-        if not np.isfinite(result):
-            logger.error(f"mv_to_od produced invalid result {result} for vial {self.vial_number}")
-            return 0.0
-            
-        return result
+
+        transform = CalibrationTransform(blank_signal, scaling, self.vial_number)
+        if not transform.valid:
+            logger.error(f"Invalid calibration for vial {self.vial_number}: blank={blank_signal}, scaling={scaling}")
+        return transform
 
     def assign_blank(self, value):
         """assign a blank value to the vial, assuming known scaling factor"""
@@ -184,56 +244,92 @@ class OdSensor:
         if self.device.is_connected():
             self.device.eeprom.save_config_to_eeprom()
     
-    def measure_transmitted_intensity(self):
+    def measure_transmitted_intensity(self, bitrate=16):
         """
         returns the intensity of the transmitted light
         :return:
         """
         self.device.photodiodes.switch_to_vial(vial=self.vial_number)
         self.device.lasers.switch_on(vial=self.vial_number)
-        time.sleep(0.02)
-        mv, err = self.device.photodiodes.measure(gain=8, bitrate=16)
+        time.sleep(self.laser_warmup_time)
+        mv, err = self.device.photodiodes.measure(gain=8, bitrate=bitrate)
         self.device.lasers.switch_off(vial=self.vial_number)
         return mv, err
 
-    def measure_background_intensity(self):
+    def measure_background_intensity(self, bitrate=16):
         """
         returns the intensity of the background light (no laser)
         :return:
         """
         self.device.photodiodes.switch_to_vial(vial=self.vial_number)
-        mv, err = self.device.photodiodes.measure(gain=8, bitrate=16)
+        mv, err = self.device.photodiodes.measure(gain=8, bitrate=bitrate)
         return mv, err
 
-    def log_mv(self, background, transmitted):
-        directory = os.path.join(self.device.directory, "vial_%d" % self.vial_number)
-        if not os.path.exists(directory):
-            os.mkdir(directory)
-
-        filepath = os.path.join(directory, "photodiode_millivolts.csv")
-        if not os.path.exists(filepath):
-            with open(filepath, "w+") as f:
-                f.write("time,transmitted,background\n")
-        with open(filepath, "a") as f:
-            data_string = "%d,%.4f,%.4f\n" % (int(time.time()), transmitted, background)
-            f.write(data_string)
-
-    def measure_signal(self):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+    def log_mv(self, background, transmitted, lsb_mv=np.nan):
+        """append the raw signals to the device signal log (buffered, see SignalLog)"""
+        signal_log = getattr(self.device, "signal_log", None)
+        if signal_log is not None:
+            signal_log.append(self.vial_number, transmitted, background, lsb_mv)
+
+    def sample_pair_time(self, bitrate=16):
+        """estimated duration of one background + transmitted sample pair in seconds"""
+        return 2 * self.device.photodiodes.conversion_time(bitrate) + self.laser_warmup_time + self.sample_overhead_time
+
+    def choose_n_samples(self, time_budget, bitrate=16):
+        """largest number of interleaved sample pairs that fits in the time budget (seconds)"""
+        if time_budget is None:
+            return 1
+        n_samples = int(time_budget // self.sample_pair_time(bitrate))
+        return min(max(n_samples, 1), self.max_samples)
+
+    def measure_signal_samples(self, n_samples=1, bitrate=16):
+        """
+        measures n_samples interleaved background/transmitted pairs in one bus transaction
+        :return: arrays of background and transmitted millivolts, least significant bit millivolts
+        """
+        assert n_samples >= 1
+        background = np.zeros(n_samples)
+        transmitted = np.zeros(n_samples)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="od_sensors")
         if not lock_acquired:
             raise Exception("Could not acquire lock to measure OD signal at time %s" % time.ctime())
         try:
-            background = self.measure_background_intensity()[0]
-            transmitted = self.measure_transmitted_intensity()[0]
+            for i in range(n_samples):
+                background[i], lsb_mv = self.measure_background_intensity(bitrate=bitrate)
+                transmitted[i], lsb_mv = self.measure_transmitted_intensity(bitrate=bitrate)
         finally:
             self.device.lock_ftdi.release()
-        if self.device.directory is not None:
-            self.log_mv(background=background, transmitted=transmitted)
-        signal = transmitted - background
-        
+        return background, transmitted, lsb_mv
+
+    def measure_signal_statistics(self, n_samples=1, bitrate=16):
+        """
+        measures n_samples interleaved background/transmitted pairs and returns signal statistics.
+        The standard error is never reported below the quantization noise of a single pair.
+        :return: dictionary with mean, std, sem of the signal (mV), mean transmitted and background (mV),
+            n_samples and bitrate
+        """
+        background, transmitted, lsb_mv = self.measure_signal_samples(n_samples=n_samples, bitrate=bitrate)
+        self.log_mv(background=background.mean(), transmitted=transmitted.mean(), lsb_mv=lsb_mv)
+        signals = transmitted - background
+        mean = float(signals.mean())
+        if n_samples > 1:
+            std = float(signals.std(ddof=1))
+        else:
+            std = np.nan
+        quantization_sem = lsb_mv * np.sqrt(2 / 12) / np.sqrt(n_samples)
+        if np.isfinite(std):
+            sem = max(std / np.sqrt(n_samples), quantization_sem)
+        else:
+            sem = quantization_sem
+        return {"mean": mean, "std": std, "sem": float(sem), "n_samples": n_samples, "bitrate": bitrate,
+                "transmitted": float(transmitted.mean()), "background": float(background.mean())}
+
+    def measure_signal(self, n_samples=1, bitrate=16):
+        signal = self.measure_signal_statistics(n_samples=n_samples, bitrate=bitrate)["mean"]
+
         # Handle problematic signal values that would cause NaN/inf in OD calculation
         if signal <= 0:
-            logger.warning(f"Vial {self.vial_number}: Signal is {signal} (transmitted={transmitted}, background={background}). Setting to small positive value to avoid log(0).")
+            logger.warning(f"Vial {self.vial_number}: Signal is {signal}. Setting to small positive value to avoid log(0).")
             signal = 0.001  # Small positive value to avoid log(0) = -inf
         
         # Validate signal is finite
@@ -243,8 +339,23 @@ class OdSensor:
             
         return signal
 
-    def measure_od(self):
-        signal = self.measure_signal()
+    def od_error_from_signal_error(self, signal, signal_error):
+        """propagate the signal standard error through the calibration function"""
+        if not np.isfinite(signal_error) or signal - signal_error <= 0:
+            return None
+        od_low = self.mv_to_od(signal + signal_error)
+        od_high = self.mv_to_od(signal - signal_error)
+        return abs(od_high - od_low) / 2
+
+    def measure_od(self, n_samples=1, bitrate=16):
+        statistics = self.measure_signal_statistics(n_samples=n_samples, bitrate=bitrate)
+        signal = statistics["mean"]
+        self.last_raw_signals = (statistics["transmitted"], statistics["background"])
+
+        # Handle problematic signal values that would cause NaN/inf in OD calculation
+        if signal <= 0:
+            logger.warning(f"Vial {self.vial_number}: Signal is {signal}. Setting to small positive value to avoid log(0).")
+            signal = 0.001  # Small positive value to avoid log(0) = -inf
         
         # Validate signal measurement
         if not np.isfinite(signal):
@@ -262,14 +373,19 @@ class OdSensor:
         except (ValueError, TypeError) as e:
             logger.error(f"Could not convert OD to float for vial {self.vial_number}: {e}, using 0.0")
             od = 0.0
+
+        od_error = self.od_error_from_signal_error(signal, statistics["sem"])
+        self.last_od_error = od_error
             
         self.device.device_data["ods"]['states'][self.vial_number] = od
         self.device.device_data["ods"]['odsignals'][self.vial_number] = signal
+        self.device.device_data["ods"].setdefault('od_errors', {})[self.vial_number] = od_error
         return od, signal
 
     def measure_od_calibration(self, odValue):
         sig = self.measure_signal()
         self.device.device_data['ods']['calibration'][self.vial_number][odValue] = sig
+        self.invalidate_calibration()
 
     def check(self):
         v = self.vial_number
@@ -293,8 +409,8 @@ class OdSensor:
         
         # Count valid calibration points
         num_points = len(calibration_od)
-        logger.info(f"calibration_od: {calibration_od}")
-        logger.info(f"calibration_mv: {calibration_mv}")
+        logger.debug(f"calibration_od: {calibration_od}")
+        logger.debug(f"calibration_mv: {calibration_mv}")
         logger.info(f"Number of calibration points for vial {self.vial_number}: {num_points}")
 
         try:
@@ -311,9 +427,9 @@ class OdSensor:
         calibration_mv_filled = np.array(
             [list(i) + [np.nan] * (max_len - len(i)) for i in calibration_mv]
         )
-        print(calibration_mv_filled)
+        logger.debug(f"calibration_mv_filled: {calibration_mv_filled}")
         calibration_mv_err = np.nanstd(calibration_mv_filled, 1)
-        print(calibration_mv_err)
+        logger.debug(f"calibration_mv_err: {calibration_mv_err}")
         # calibration_mv = np.array(list(self.calibration_od_to_mv.values())).mean(1)
         calibration_mv = np.nanmean(calibration_mv_filled, 1)
 
@@ -399,6 +515,7 @@ class OdSensor:
         logger.info(f"fitted calibration function for vial {self.vial_number} with blank {blank_signal} and scaling {scaling}")
         # a, b, c, d, g = coefs
         self.device.device_data['ods']['calibration_coefs'][self.vial_number] = coefs
+        self.invalidate_calibration()
         if self.device.is_connected():
             self.device.eeprom.save_config_to_eeprom()
         # self.plot_calibration_curve()
@@ -0,0 +1,129 @@
+import time
+
+from logger.logger import logger
+
+
+class OdSweep:
+    """
+    Pipelined optical density measurement of several vials.
+
+    Instead of slowing down all stirrers at once and waiting for all of them to settle,
+    the stirrer of each vial is slowed down on a staggered schedule, spaced by the expected
+    duration of a single vial measurement. Vial N+1 settles while vial N is being converted,
+    and every stirrer is restored to high speed right after its vial has been measured.
+
+    With a time budget, each vial is measured with as many interleaved background/transmitted
+    sample pairs as fit in the budget left after the settle time.
+    """
+    settle_time = 4  # seconds for a stirrer to spin down and the culture to calm down
+    restore_speed = "high"
+
+    def __init__(self, device, bitrate=16, time_budget=None):
+        self.device = device
+        self.bitrate = bitrate
+        self.time_budget = time_budget  # seconds for the whole sweep, None for a single sample pair per vial
+        # running estimate of the time needed to measure one background + transmitted sample pair
+        self.sample_pair_time = None
+        self.vial_measurement_time = None
+        self.last_sweep_time = None
+        self.last_sweep_vial_times = {}
+        self.last_sweep_n_samples = None
+
+    def estimate_sample_pair_time(self):
+        if self.sample_pair_time is not None:
+            return self.sample_pair_time
+        return self.device.od_sensors[1].sample_pair_time(bitrate=self.bitrate)
+
+    def choose_n_samples(self, n_vials):
+        if self.time_budget is None or n_vials == 0:
+            return 1
+        vial_time_budget = max(self.time_budget - self.settle_time, 0) / n_vials
+        return self.device.od_sensors[1].choose_n_samples(vial_time_budget, bitrate=self.bitrate)
+
+    def estimate_vial_measurement_time(self, n_samples=1):
+        return n_samples * self.estimate_sample_pair_time()
+
+    def estimate_sweep_time(self, n_vials):
+        """lower bound of the sweep duration: one settle period plus one measurement per vial"""
+        if n_vials == 0:
+            return 0
+        n_samples = self.choose_n_samples(n_vials)
+        return self.settle_time + n_vials * self.estimate_vial_measurement_time(n_samples)
+
+    def _slow_down_due_stirrers(self, schedule, slowed_down_at):
+        now = time.time()
+        for vial, scheduled_time in schedule.items():
+            if vial not in slowed_down_at and scheduled_time <= now:
+                self.device.stirrers.set_speed(vial=vial, speed="low")
+                slowed_down_at[vial] = time.time()
+
+    def measure(self, vials_to_measure=(1, 2, 3, 4, 5, 6, 7)):
+        """
+        Measure optical density of the vials with staggered stirrer slow-downs
+        :param vials_to_measure: tuple of vials to measure, measured in the given order
+        :return: dictionaries of measured optical density values and of their standard errors
+        """
+        vials_to_measure = list(vials_to_measure)
+        measured_od_values = {}
+        measured_od_errors = {}
+        if len(vials_to_measure) == 0:
+            return measured_od_values, measured_od_errors
+
+        t0 = time.time()
+        n_samples = self.choose_n_samples(len(vials_to_measure))
+        spacing = self.estimate_vial_measurement_time(n_samples)
+        schedule = {vial: t0 + i * spacing for i, vial in enumerate(vials_to_measure)}
+        slowed_down_at = {}
+        vial_times = {}
+        try:
+            for vial in vials_to_measure:
+                # wait until this vial has settled, slowing down the following stirrers on schedule
+                while True:
+                    self._slow_down_due_stirrers(schedule, slowed_down_at)
+                    now = time.time()
+                    if vial in slowed_down_at and now - slowed_down_at[vial] >= self.settle_time:
+                        break
+                    next_events = [t for v, t in schedule.items() if v not in slowed_down_at]
+                    if vial in slowed_down_at:
+                        next_events.append(slowed_down_at[vial] + self.settle_time)
+                    time.sleep(max(0.0, min(next_events) - now))
+
+                t_vial = time.time()
+                od, signal = self.device.od_sensors[vial].measure_od(n_samples=n_samples, bitrate=self.bitrate)
+                measured_od_values[vial] = od
+                measured_od_errors[vial] = self.device.od_sensors[vial].last_od_error
+                vial_times[vial] = time.time() - t_vial
+                self.device.stirrers.set_speed(vial=vial, speed=self.restore_speed)
+        finally:
+            # restore stirrers that were slowed down but not measured because of an error
+            for vial in slowed_down_at:
+                if vial not in vial_times:
+                    self.device.stirrers.set_speed(vial=vial, speed=self.restore_speed)
+
+        if len(vial_times) > 0:
+            mean_vial_time = sum(vial_times.values()) / len(vial_times)
+            self.vial_measurement_time = mean_vial_time
+            pair_time = mean_vial_time / n_samples
+            if self.sample_pair_time is None:
+                self.sample_pair_time = pair_time
+            else:
+                self.sample_pair_time = 0.7 * self.sample_pair_time + 0.3 * pair_time
+        self.last_sweep_time = time.time() - t0
+        self.last_sweep_vial_times = vial_times
+        self.last_sweep_n_samples = n_samples
+        logger.info("OD sweep of %d vials with %d sample pairs at %d bit took %.2f s (%.3f s per vial measurement)"
+                    % (len(vials_to_measure), n_samples, self.bitrate, self.last_sweep_time,
+                       self.estimate_vial_measurement_time(n_samples)))
+        return measured_od_values, measured_od_errors
+
+    def get_stats(self):
+        return {
+            "last_sweep_time": self.last_sweep_time,
+            "vial_measurement_time": self.vial_measurement_time,
+            "sample_pair_time": self.sample_pair_time,
+            "n_samples": self.last_sweep_n_samples,
+            "bitrate": self.bitrate,
+            "time_budget": self.time_budget,
+            "last_sweep_vial_times": self.last_sweep_vial_times,
+            "settle_time": self.settle_time,
+        }
@@ -5,6 +5,66 @@ import math
 import pyftdi.i2c
 from logger.logger import logger
 
+LED0_ON_L = 0x06
+ALL_LED_ON_L = 250
+ALL_LED_OFF_L = 252
+MAX_BRIDGE_BYTES = 10  # rewriting up to ~10 known bytes is cheaper than starting a new I2C transaction
+
+
+def duty_cycle_to_bytes(duty_cycle):
+    """least and most significant byte of the 12 bit OFF count"""
+    msb, lsb = divmod(round(4095 * duty_cycle), 0x100)
+    return lsb, msb
+
+
+def plan_channel_bursts(duty_by_channel, shadow_registers=None, n_channels=16):
+    """
+    Plan auto-increment burst writes that set the OFF registers of several PCA9685 channels
+    in as few I2C transactions as possible.
+
+    Channels whose OFF registers already hold the target value (according to the shadow registers) are skipped.
+    If all channels end up with the same value, a single ALL_LED_OFF burst is used. Otherwise neighbouring
+    channels are merged into one burst when the registers in between (ON registers, unchanged channels)
+    have known values that can be rewritten, and the gap is short.
+    :param duty_by_channel: dictionary channel -> duty cycle (0-1)
+    :param shadow_registers: dictionary register -> last written value, e.g. ShadowPort.registers
+    :return: list of (start register, list of bytes)
+    """
+    if shadow_registers is None:
+        shadow_registers = {}
+    targets = {}
+    for channel, duty_cycle in duty_by_channel.items():
+        assert 0 <= channel < n_channels
+        assert 0 <= duty_cycle <= 1
+        targets[LED0_ON_L + 4 * channel + 2], targets[LED0_ON_L + 4 * channel + 3] = duty_cycle_to_bytes(duty_cycle)
+
+    def known(register):
+        return targets.get(register, shadow_registers.get(register))
+
+    changed = sorted(c for c in duty_by_channel
+                     if any(shadow_registers.get(LED0_ON_L + 4 * c + i) != targets[LED0_ON_L + 4 * c + i] for i in (2, 3)))
+    if len(changed) == 0:
+        return []
+
+    all_off = [(known(LED0_ON_L + 4 * c + 2), known(LED0_ON_L + 4 * c + 3)) for c in range(n_channels)]
+    if len(changed) > 1 and None not in all_off[0] and all(v == all_off[0] for v in all_off):
+        return [(ALL_LED_OFF_L, list(all_off[0]))]
+
+    bursts = []
+    start = LED0_ON_L + 4 * changed[0] + 2
+    end = start + 1  # last register of the current burst
+    for channel in changed[1:]:
+        next_start = LED0_ON_L + 4 * channel + 2
+        gap = range(end + 1, next_start)
+        if len(gap) <= MAX_BRIDGE_BYTES and all(known(r) is not None for r in gap):
+            end = next_start + 1
+        else:
+            bursts.append((start, [known(r) for r in range(start, end + 1)]))
+            start, end = next_start, next_start + 1
+    bursts.append((start, [known(r) for r in range(start, end + 1)]))
+    return bursts
+
+
 class PwmController:
     """PCA9685 PWM controller"""
 
@@ -25,7 +85,7 @@ class PwmController:
         try:
             for i in range(3):
                 try:
-                    self.port = self.device.i2c.get_port(self.device.PORT_PWM)
+                    self.port = self.device.get_i2c_port("pwm", self.device.PORT_PWM, chip="pca9685")
                     break
                 except Exception as e:
                     traceback.print_exc()
@@ -44,14 +104,11 @@ class PwmController:
             print("PCA9685 PWM controller connection ERROR. exiting connect()")
 
     def write_all_zeros(self):
-        all_led_on_l = 250
-        all_led_on_h = 251
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not lock_acquired:
             raise Exception("Could not acquire lock to connect PWM controller at time %s" % time.ctime())
         try:
-            self.port.write_to(all_led_on_l, [0x0])
-            self.port.write_to(all_led_on_h, [0x00])
+            self.port.write_to(ALL_LED_ON_L, [0x00, 0x00])  # ON_L, ON_H of all channels
         finally:
             self.device.lock_ftdi.release()
 
@@ -64,19 +121,19 @@ class PwmController:
         logger.info(f"Setting frequency to {frequency}")
         pre_scale = math.floor(25000000 / (4096 * frequency)) - 1
 
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire i2c port lock for set_frequency at time %s" % time.ctime())
         try:
             try:
-                self.port.write_to(0x00, [0b00010001])  # sleep mode
+                self.port.write_to(0x00, [0b00110001])  # sleep mode, register auto-increment
             except Exception:
                 time.sleep(0.5)
                 self.port.write_to(0x00, [0b0])  # reset
                 print("Reset PWM driver")
-                self.port.write_to(0x00, [0b00010001])  # sleep mode
+                self.port.write_to(0x00, [0b00110001])  # sleep mode, register auto-increment
             self.port.write_to(0xFE, [pre_scale])  # SET_PWM_FREQUENCY
-            self.port.write_to(0x00, [0b10000001])  # restart mode
+            self.port.write_to(0x00, [0b10100001])  # restart mode, register auto-increment
         finally:
             self.device.lock_ftdi.release()
 
@@ -87,14 +144,12 @@ class PwmController:
         :return:
         """
         led_off_l = led_number * 4 + 8
-        led_off_h = led_number * 4 + 9
 
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire i2c port lock for get_duty_cycle at time %s" % time.ctime())
         try:
-            lsbr = self.port.read_from(led_off_l, 1)[0]
-            msbr = self.port.read_from(led_off_h, 1)[0]
+            lsbr, msbr = self.port.read_from(led_off_l, 2)
             duty_cycle_read = ((msbr << 8) + lsbr) / 4095
             return duty_cycle_read
         finally:
@@ -109,38 +164,39 @@ class PwmController:
         """
         assert 0 <= led_number <= 15
         assert 0 <= duty_cycle <= 1
-        msb, lsb = divmod(
-            round(4095 * duty_cycle), 0x100
-        )  # most and least significant bytes
-        led_off_l = led_number * 4 + 8
-        led_off_h = led_number * 4 + 9
+        self.set_duty_cycles({led_number: duty_cycle})
 
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+    def set_duty_cycles(self, duty_cycle_by_led):
+        """
+        Set the duty cycles of several pins with the minimum number of auto-increment burst writes.
+        :param duty_cycle_by_led: dictionary led_number -> duty cycle (0-1)
+        :return: number of I2C transactions used
+        """
+        bursts = plan_channel_bursts(duty_cycle_by_led, getattr(self.port, "registers", None))
+        if len(bursts) == 0:
+            return 0
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
-            raise Exception("Could not acquire i2c port lock for set_duty_cycle at time %s" % time.ctime())
+            raise Exception("Could not acquire i2c port lock for set_duty_cycles at time %s" % time.ctime())
         try:
-            self.port.write_to(led_off_l, [lsb])
-            self.port.write_to(led_off_h, [msb])
+            for start_register, data in bursts:
+                self.port.write_to(start_register, data)
         finally:
             self.device.lock_ftdi.release()
+        return len(bursts)
 
     def set_duty_cycle_all(self, duty_cycle):
         """
         Set the duty cycle of all pins.
         :param duty_cycle: 0-1
         """
-        msb, lsb = divmod(
-            round(4095 * duty_cycle), 0x100
-        )  # most and least significant bytes
-        all_led_off_l = 252
-        all_led_off_h = 253
+        lsb, msb = duty_cycle_to_bytes(duty_cycle)
 
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire i2c port lock for set_duty_cycle_all at time %s" % time.ctime())
         try:
-            self.port.write_to(all_led_off_l, [lsb])
-            self.port.write_to(all_led_off_h, [msb])
+            self.port.write_to(ALL_LED_OFF_L, [lsb, msb])  # OFF_L, OFF_H of all channels in one burst
         finally:
             self.device.lock_ftdi.release()
 
@@ -149,11 +205,11 @@ class PwmController:
         Stop all PWM signals.
         :return:
         """
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire i2c port lock for stop_all at time %s" % time.ctime())
         try:
-            self.port.write_to(0x00, [0b10001])
+            self.port.write_to(0x00, [0b110001])
         finally:
             self.device.lock_ftdi.release()
 
@@ -162,13 +218,13 @@ class PwmController:
         Start all PWM signals.
         :return:
         """
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire i2c port lock for start_all at time %s" % time.ctime())
         try:
-            self.port.write_to(0x00, [0b00001])
+            self.port.write_to(0x00, [0b100001])
             time.sleep(0.002)
-            self.port.write_to(0x00, [0b10000001])
+            self.port.write_to(0x00, [0b10100001])
         finally:
             self.device.lock_ftdi.release()
 
@@ -177,7 +233,7 @@ class PwmController:
         Check if the PWM controller is sleeping.
         :return:
         """
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pwm")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire i2c port lock for is_sleeping at time %s" % time.ctime())
         try:
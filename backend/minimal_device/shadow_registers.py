@@ -0,0 +1,165 @@
+import threading
+
+
+class ShadowPort:
+    """
+    Shadow-register layer around a pyftdi I2C port of a register based chip (PCA9555, PCA9685).
+
+    Remembers the last value written to (or read from) every register, suppresses writes that would
+    not change the register and serves reads from the cache unless the register is volatile
+    (e.g. PCA9555 input ports). Registers in write_through are always written because writing them
+    triggers an action on the chip. The cache is cleared with resync(), which happens automatically
+    when the port is bound again after a reconnect.
+
+    With cache=False the port only counts transactions (ADC, thermometers).
+    """
+
+    def __init__(self, name, address, cache=True, volatile_registers=(), write_through_registers=()):
+        self.name = name
+        self.address = address
+        self.cache = cache
+        self.volatile_registers = set(volatile_registers)
+        self.write_through_registers = set(write_through_registers)
+        self.port = None
+        self.registers = {}
+        self.lock = threading.Lock()
+        self.counters = self._new_counters()
+
+    @staticmethod
+    def _new_counters():
+        return {
+            "bus_writes": 0,
+            "bus_reads": 0,
+            "bytes_written": 0,
+            "bytes_read": 0,
+            "suppressed_writes": 0,
+            "cached_reads": 0,
+            "resyncs": 0,
+        }
+
+    def bind(self, port):
+        """use a new pyftdi port (after connecting) and forget all cached register values"""
+        self.port = port
+        self.resync()
+
+    def resync(self):
+        with self.lock:
+            self.registers = {}
+            self.counters["resyncs"] += 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.counters = self._new_counters()
+
+    def _is_cached(self, regaddr, out):
+        if not self.cache or regaddr in self.write_through_registers:
+            return False
+        for i, value in enumerate(out):
+            if self.registers.get(regaddr + i) != value:
+                return False
+        return True
+
+    def _update_shadow(self, regaddr, data):
+        # multi byte transfers assume register auto-increment
+        for i, value in enumerate(data):
+            self.registers[regaddr + i] = value
+
+    def write_to(self, regaddr, out, relax=True, start=True):
+        out = [int(b) for b in out]
+        with self.lock:
+            if self._is_cached(regaddr, out):
+                self.counters["suppressed_writes"] += 1
+                return
+        self.port.write_to(regaddr, out, relax=relax, start=start)
+        with self.lock:
+            self.counters["bus_writes"] += 1
+            self.counters["bytes_written"] += len(out)
+            if self.cache:
+                self._update_shadow(regaddr, out)
+
+    def read_from(self, regaddr, readlen=0, relax=True, start=True):
+        if self.cache and readlen > 0:
+            with self.lock:
+                volatile = any(regaddr + i in self.volatile_registers for i in range(readlen))
+                cached = [self.registers.get(regaddr + i) for i in range(readlen)]
+                if not volatile and None not in cached:
+                    self.counters["cached_reads"] += 1
+                    return bytearray(cached)
+        data = self.port.read_from(regaddr, readlen, relax=relax, start=start)
+        with self.lock:
+            self.counters["bus_reads"] += 1
+            self.counters["bytes_read"] += len(data)
+            if self.cache:
+                volatile = [regaddr + i for i in range(len(data)) if regaddr + i in self.volatile_registers]
+                if len(volatile) == 0:
+                    self._update_shadow(regaddr, data)
+        return data
+
+    def write(self, out, relax=True, start=True):
+        """raw write without register address, bypasses the cache"""
+        self.port.write(out, relax=relax, start=start)
+        with self.lock:
+            self.counters["bus_writes"] += 1
+            self.counters["bytes_written"] += len(out)
+
+    def read(self, readlen=0, relax=True, start=True):
+        """raw read without register address, bypasses the cache"""
+        data = self.port.read(readlen, relax=relax, start=start)
+        with self.lock:
+            self.counters["bus_reads"] += 1
+            self.counters["bytes_read"] += len(data)
+        return data
+
+    def get_counters(self):
+        with self.lock:
+            counters = dict(self.counters)
+        counters["address"] = hex(self.address)
+        counters["transactions"] = counters["bus_writes"] + counters["bus_reads"]
+        return counters
+
+
+class Pca9555ShadowPort(ShadowPort):
+    """PCA9555 GPIO expander: input port registers 0 and 1 follow the pins and are never cached"""
+
+    def __init__(self, name, address):
+        super().__init__(name, address, volatile_registers=(0, 1))
+
+
+class Pca9685ShadowPort(ShadowPort):
+    """
+    PCA9685 PWM controller. MODE1 is always written (its RESTART bit is an action) and always read from the
+    chip, so that a reset, brownout or sleep is seen. If a read finds the SLEEP bit set although it was last
+    written cleared, the chip lost its registers and the cache is cleared, so the next writes reach the chip.
+    Writes to the ALL_LED registers update the shadows of all 16 channels.
+    """
+    MODE1 = 0x00
+    MODE1_SLEEP = 0x10
+    ALL_LED_ON_L = 250
+
+    def __init__(self, name, address):
+        super().__init__(name, address, volatile_registers=(self.MODE1,),
+                         write_through_registers=(self.MODE1, 250, 251, 252, 253))
+
+    def write_to(self, regaddr, out, relax=True, start=True):
+        super().write_to(regaddr, out, relax=relax, start=start)
+        if self.cache and regaddr == self.MODE1 and len(out) > 0:
+            with self.lock:
+                self.mode1_written = int(out[0])
+
+    def read_from(self, regaddr, readlen=0, relax=True, start=True):
+        data = super().read_from(regaddr, readlen, relax=relax, start=start)
+        if self.cache and regaddr == self.MODE1 and len(data) > 0:
+            mode1_written = getattr(self, "mode1_written", None)
+            if mode1_written is not None and data[0] & self.MODE1_SLEEP and not mode1_written & self.MODE1_SLEEP:
+                self.resync()
+                self.mode1_written = None
+        return data
+
+    def _update_shadow(self, regaddr, data):
+        super()._update_shadow(regaddr, data)
+        for i, value in enumerate(data):
+            register = regaddr + i
+            if self.ALL_LED_ON_L <= register <= self.ALL_LED_ON_L + 3:
+                offset = register - self.ALL_LED_ON_L  # ON_L, ON_H, OFF_L, OFF_H
+                for channel in range(16):
+                    self.registers[6 + channel * 4 + offset] = value
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from logger.logger import logger
+
+
+class SignalLog:
+    """
+    Raw photodiode sample log in a preallocated, memory-mapped ring file.
+
+    Fixed-width records (time, vial, transmitted, background, lsb) are buffered in memory and written to the
+    ring in batches, after flush_records samples or flush_interval seconds, whichever comes first. When the
+    ring is full the oldest records are overwritten, so disk use is bounded by capacity.
+    The header (capacity, head, count) is updated after the records of a batch, so a crash loses at most
+    the unflushed batch.
+    Samples are only logged while enabled, the experiment worker enables the log while an experiment runs.
+    """
+    MAGIC = b"RFSIGLOG"
+    VERSION = 1
+    HEADER_SIZE = 64
+    header_dtype = np.dtype([("magic", "S8"), ("version", "<u4"), ("record_size", "<u4"),
+                             ("capacity", "<u8"), ("head", "<u8"), ("count", "<u8")])
+    record_dtype = np.dtype([("time", "<f8"), ("vial", "u1"), ("transmitted", "<f4"),
+                             ("background", "<f4"), ("lsb", "<f4")])
+    flush_records = 64
+    flush_interval = 60  # seconds
+
+    def __init__(self, filename, capacity=1 << 20):
+        self.filename = filename
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.time()
+        self.header = None
+        self.records = None
+        self.enabled = False
+
+    def _open(self):
+        """map the ring file, creating (or recreating, if incompatible) it on first use"""
+        if self.records is not None:
+            return
+        if os.path.exists(self.filename):
+            header = np.fromfile(self.filename, dtype=self.header_dtype, count=1)
+            compatible = (len(header) == 1 and header["magic"][0] == self.MAGIC
+                          and header["version"][0] == self.VERSION
+                          and header["record_size"][0] == self.record_dtype.itemsize
+                          and os.path.getsize(self.filename)
+                          == self.HEADER_SIZE + int(header["capacity"][0]) * self.record_dtype.itemsize)
+            if not compatible:
+                logger.warning(f"Signal log {self.filename} has an incompatible format, starting a new one")
+                os.replace(self.filename, self.filename + ".old")
+        if not os.path.exists(self.filename):
+            self._create()
+        self.header = np.memmap(self.filename, dtype=self.header_dtype, mode="r+", shape=(1,))
+        self.capacity = int(self.header["capacity"][0])
+        self.records = np.memmap(self.filename, dtype=self.record_dtype, mode="r+",
+                                 offset=self.HEADER_SIZE, shape=(self.capacity,))
+
+    def _create(self):
+        size = self.HEADER_SIZE + self.capacity * self.record_dtype.itemsize
+        with open(self.filename, "wb") as f:
+            header = np.zeros(1, dtype=self.header_dtype)
+            header["magic"] = self.MAGIC
+            header["version"] = self.VERSION
+            header["record_size"] = self.record_dtype.itemsize
+            header["capacity"] = self.capacity
+            f.write(header.tobytes().ljust(self.HEADER_SIZE, b"\0"))
+            f.truncate(size)
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)  # reserve the space now, not while logging
+        logger.info(f"Created signal log {self.filename} for {self.capacity} records ({size / 1e6:.1f} MB)")
+
+    def append(self, vial, transmitted, background, lsb=np.nan, timestamp=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.buffer.append((time.time() if timestamp is None else timestamp, vial, transmitted, background, lsb))
+            if len(self.buffer) >= self.flush_records or time.time() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.time()
+        if len(self.buffer) == 0:
+            return
+        self._open()
+        batch = np.array(self.buffer, dtype=self.record_dtype)[-self.capacity:]
+        self.buffer = []
+        head = int(self.header["head"][0])
+        first = min(len(batch), self.capacity - head)
+        self.records[head:head + first] = batch[:first]
+        self.records[:len(batch) - first] = batch[first:]
+        self.records.flush()
+        self.header["head"] = (head + len(batch)) % self.capacity
+        self.header["count"] = min(int(self.header["count"][0]) + len(batch), self.capacity)
+        self.header.flush()
+
+    def read(self, start_time=None, end_time=None, vial=None):
+        """
+        :return: structured numpy array of the records in [start_time, end_time], oldest first,
+            with fields time, vial, transmitted, background, lsb
+        Records are in time order within the two parts of the ring, so the time range is found by binary
+        search and only the records in it are copied out of the mapped file.
+        """
+        with self.lock:
+            self._flush()
+            if self.records is None and not os.path.exists(self.filename):
+                return np.zeros(0, dtype=self.record_dtype)
+            self._open()
+            head = int(self.header["head"][0])
+            count = int(self.header["count"][0])
+            if count < self.capacity:
+                parts = [self.records[:count]]
+            else:
+                parts = [self.records[head:], self.records[:head]]
+            selected = []
+            for part in parts:
+                times = part["time"]
+                first = 0 if start_time is None else int(np.searchsorted(times, start_time, side="left"))
+                last = len(part) if end_time is None else int(np.searchsorted(times, end_time, side="right"))
+                part = part[first:last]
+                if vial is not None:
+                    part = part[part["vial"] == vial]
+                selected.append(np.array(part))
+        return np.concatenate(selected)
+
+    def get_stats(self):
+        with self.lock:
+            count = int(self.header["count"][0]) if self.header is not None else None
+            return {"filename": self.filename, "capacity": self.capacity, "records": count,
+                    "buffered": len(self.buffer), "record_size": self.record_dtype.itemsize}
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.records = None
+            self.header = None
@@ -66,6 +66,7 @@ class Stepper:
         self.cs = cs
         self.port = None
         self.step_mode = None
+        self.motion = None  # last move, followed by device.motion_monitor
 
     def reset_device(self):
         self.port.write([self.COMMAND_RESET_DEVICE])
@@ -267,7 +268,7 @@ class Stepper:
         self.write_register(self.REGISTER_MAX_SPEED, value=MAX_SPEED_REGISTER, n_bits=10, n_bytes=2)
 
     def write_register(self, reg, value, n_bits, n_bytes):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for writing stepper %d register %s" % (self.cs, reg))
         try:
@@ -285,7 +286,7 @@ class Stepper:
             print("WARNING: register %s not set correctly" % reg)
 
     def read_register(self, reg, n_bytes=3):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for reading stepper %d register %s" % (self.cs, reg))
         try:
@@ -338,7 +339,7 @@ class Stepper:
             n_microsteps = abs(n_rotations) * steps_per_rotation * microsteps_per_step
 
         write_bytes = split_bytes(n_microsteps / max_n_microsteps, 22, 3)
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for moving stepper %d at time %s" % (self.cs, time.ctime()))
         try:
@@ -347,6 +348,7 @@ class Stepper:
                 self.port.write([b])
         finally:
             self.device.lock_ftdi.release()
+        self.motion = self.device.motion_monitor.watch(self, n_rotations, rot_per_sec)
 
     def get_abs_position(self):
         microsteps = int.from_bytes(self.read_register(self.REGISTER_ABS_POS), "big")
@@ -372,7 +374,7 @@ class Stepper:
 
         run_header_byte = 0b01010000 | direction_bit
         write_bytes = split_bytes(SPEED_REGISTER, 20, 3)
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for running stepper %d at time %s" % (self.cs, time.ctime()))
         try:
@@ -383,7 +385,7 @@ class Stepper:
             self.device.lock_ftdi.release()
 
     def is_busy(self):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for checking busy status of stepper %d at time %s" % (self.cs, time.ctime()))
         try:
@@ -397,7 +399,7 @@ class Stepper:
     def driver_is_responsive(self):
         if self.port is None:
             return False
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for checking driver responsiveness of stepper %d" % self.cs)
         try:
@@ -411,7 +413,7 @@ class Stepper:
         return not (msb == 255 and lsb == 255)
 
     def write_to_port(self, data):
-        lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="pumps")
         if not lock_acquired:
             raise Exception("Could not acquire lock for writing to stepper %d" % self.cs)
         try:
@@ -439,6 +441,8 @@ class Stepper:
         """
         # self.port.write([0b10110000])
         self.write_to_port([0b10110000])
+        if self.motion is not None:
+            self.motion.wake()
 
     def stop_hard(self):
         """
@@ -446,6 +450,8 @@ class Stepper:
         """
         self.write_to_port([0b10111000])
         # self.port.write([0b10111000])
+        if self.motion is not None:
+            self.motion.wake()
 
     def reset(self):
         # self.port.write([0b11000000])
@@ -1,11 +1,42 @@
 import os
-import re
 import time
 import numpy as np
 
+
+def run_lengths(bits):
+    """values and lengths of the runs of equal bits in a 1D array of 0/1"""
+    if len(bits) == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(bits[1:] != bits[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [len(bits)])))
+    return bits[starts], lengths
+
+
+def tachometer_periods(data):
+    """
+    lengths (in bits) of the high and low periods of a fan tachometer SPI capture.
+    Dips of one or two zero bits between runs of at least three ones are glitches and are filled.
+    The incomplete first and last periods are cut.
+    """
+    bits = np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8))
+    values, lengths = run_lengths(bits)
+    if len(values) >= 3:
+        glitch = np.zeros(len(values), dtype=bool)
+        glitch[1:-1] = (values[1:-1] == 0) & (lengths[1:-1] <= 2) & (lengths[:-2] >= 3) & (lengths[2:] >= 3)
+        if glitch.any():
+            values = np.where(glitch, 1, values)
+            # merge neighbouring runs that now have the same value
+            group_starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+            lengths = np.add.reduceat(lengths, group_starts)
+    return lengths[1:-1]
+
+
 class Stirrers:
     led_numbers = {stirrer: 7 - stirrer for stirrer in [1, 2, 3, 4, 5, 6, 7]}
     cooling_fan_led_number = 7
+    min_measurable_rpm = 80
+    rpm_retry_delay = 4  # seconds to wait before retrying failed rpm measurements
+    capture_overhead_seconds = 0.005  # multiplexer switching per capture
 
     def __init__(self, device):
         self.freq=1e5
@@ -13,6 +44,7 @@ class Stirrers:
         self.pwm_controller = None
         self.multiplexer_port = None
         self.rpms = {vial: None for vial in range(1, 8)}
+        self.last_sweep_budget = {}
 
         if self.device.is_connected():
             self.connect()
@@ -21,8 +53,8 @@ class Stirrers:
         self.pwm_controller = self.device.pwm_controller
         if self.pwm_controller.port is not None:
             # for 3-pin fan speed feedback
-            self.multiplexer_port = self.device.i2c.get_port(
-                self.device.PORT_GPIO_MULTIPLEXER_STIRRERS
+            self.multiplexer_port = self.device.get_i2c_port(
+                "stirrers_multiplexer", self.device.PORT_GPIO_MULTIPLEXER_STIRRERS, chip="pca9555"
             )
 
 
@@ -82,16 +114,22 @@ class Stirrers:
 
     def set_speed_all(self, speed, accelerate=False):
         assert speed in ["stopped", "low", "high"]
+        duty_cycles = {}
         for vial in range(1, 8):
             if speed == "stopped":
-                duty_cycle = 0
+                duty_cycles[vial] = 0
             else:
-                duty_cycle = self.device.device_data["stirrers"]["calibration"][vial][speed]
-            if 0 < duty_cycle < 0.2 and accelerate:
-                self._set_duty_cycle(vial=vial, duty_cycle=duty_cycle*2)
-                time.sleep(0.05)
-            self._set_duty_cycle(vial, duty_cycle=duty_cycle)
-            
+                duty_cycles[vial] = self.device.device_data["stirrers"]["calibration"][vial][speed]
+            assert 0 <= duty_cycles[vial] <= 1
+
+        if accelerate and any(0 < d < 0.2 for d in duty_cycles.values()):
+            # kick slow stirrers at double duty cycle, all in one burst
+            self.pwm_controller.set_duty_cycles({self.led_numbers[vial]: d * 2 if 0 < d < 0.2 else d
+                                                 for vial, d in duty_cycles.items()})
+            time.sleep(0.05)
+        self.pwm_controller.set_duty_cycles({self.led_numbers[vial]: d for vial, d in duty_cycles.items()})
+
+        for vial in range(1, 8):
             # Update the device_data state to reflect the actual stirrer state
             self.device.device_data["stirrers"]["states"][vial] = speed
 
@@ -106,66 +144,86 @@ class Stirrers:
             assert 0 <= duty_cycle_slow <= 1
             assert 0 <= duty_cycle_fast <= 1
 
+    def capture_nbytes(self, estimated_rpm):
+        """number of SPI bytes to read for about 0.8 rotations at the estimated rpm"""
+        ms_per_rotation = 60 / estimated_rpm * 1000
+        ms_per_bit = 1 / self.freq * 1000
+        bits_per_rotation = ms_per_rotation / ms_per_bit
+        nbytes_per_rotation = bits_per_rotation / 8
+        nbytes = int(nbytes_per_rotation * 0.8) + 16  # Safety factor to avoid overflow
+        return nbytes
+
+    def capture_seconds(self, nbytes):
+        return nbytes * 8 / self.freq + self.capture_overhead_seconds
+
+    def expected_rpm(self, vial_number, duty_cycle=None):
+        """
+        rpm expected at the current duty cycle, interpolated from the calibrated speed profile if available,
+        otherwise the last measured rpm or a rough linear estimate
+        """
+        if duty_cycle is None:
+            duty_cycle = self.get_stirrer_duty_cycle(vial_number)  # ftdi lock is checked here
+        profile = self.device.device_data["stirrers"].get("speed_profiles", {}).get(vial_number, {})
+        if len(profile) >= 2:
+            duties = sorted(float(d) for d in profile.keys())
+            rpms = [float(np.mean(profile[d])) for d in sorted(profile.keys(), key=float)]
+            return float(np.interp(duty_cycle, duties, rpms))
+        if self.rpms[vial_number] is not None:
+            return self.rpms[vial_number]
+        return 8000 * duty_cycle
+
+    def _rpm_from_capture(self, res):
+        """rpm from a tachometer capture, None if no complete period was captured"""
+        periods = tachometer_periods(res)
+
+        # Check if any periods were found
+        if len(periods) < 1:
+            return None
+
+        if len(periods) > 5:
+            # remove outliers
+            periods = periods[abs(periods - np.median(periods)) < 2 * np.std(periods)]
+
+        if periods[0] > 1000:
+            rpm = 60 * self.freq / periods[0] / 4
+        else:
+            rpm = 60 * self.freq / np.median(periods) / 4
+        return rpm
+
+    def _capture(self, vial_number, nbytes):
+        """read the tachometer of one stirrer, ftdi lock must be held by the caller"""
+        self.multiplexer_port.write_to(7, [0x00])  # Output pin
+        self.multiplexer_port.write_to(2, [vial_number - 1])
+        return self.fans_spi_port.read(nbytes)
+
     def _measure_rpm_no_lock(self, vial_number=7, estimated_rpm=None):
         if estimated_rpm is None:
             estimated_rpm = self.rpms[vial_number]
         if estimated_rpm is None:
             duty_cycle = self.get_stirrer_duty_cycle(vial_number)  # ftdi lock is checked here
             estimated_rpm = 8000 * duty_cycle
-        if estimated_rpm < 80:
+        if estimated_rpm < self.min_measurable_rpm:
             return 0
-        ms_per_rotation = 60 / estimated_rpm * 1000
-        bits_per_minute = self.freq * 60
-        ms_per_bit = 1 / self.freq * 1000
-        bits_per_rotation = ms_per_rotation / ms_per_bit
-        nbytes_per_rotation = bits_per_rotation / 8
-        nbytes = int(nbytes_per_rotation * 0.8) + 16  # Safety factor to avoid overflow
+        nbytes = self.capture_nbytes(estimated_rpm)
 
         # Set up the multiplexer for the given vial
         # Read data from SPI port
         # get self.device.lock_ftdi lock
-        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="stirrers")
         if not ftdi_lock_acquired:
             raise Exception("Could not acquire lock for reading stirrer speed at time %s" % time.ctime())
         try:
-            self.multiplexer_port.write_to(7, [0x00])  # Output pin
-            self.multiplexer_port.write_to(2, [vial_number - 1])
-            t0 = time.time()
-
-            res = self.fans_spi_port.read(nbytes)
+            res = self._capture(vial_number, nbytes)
         finally:
             self.device.lock_ftdi.release()
-        dt = time.time() - t0
-        binstr = "".join([bin(r)[2:].rjust(8, "0") for r in res])
 
-        # Clean up the binary string
-        binstr = binstr.replace("1110111", "1111111").replace("11100111", "11111111")
-
-        # Calculate the ratio of '1's in the binary data
-        ones_ratio = sum(1 for i in binstr if i == "1") / (8 * nbytes)
-
-        # Find repeated sequences in the binary string
-        periods = [len(match.group()) for match in re.finditer(r'(0+|1+)', binstr)]
-        periods = periods[1:-1]  # cut first and last incomplete sequences
-
-        # Check if any periods were found
-        if len(periods) < 1:
+        rpm = self._rpm_from_capture(res)
+        if rpm is None:
             if estimated_rpm > 400:
-                time.sleep(4)
+                time.sleep(self.rpm_retry_delay)
                 return self._measure_rpm_no_lock(vial_number, estimated_rpm / 2)
             else:
                 return 0
-
-        periods = np.array(periods)
-
-        if len(periods) > 5:
-            # remove outliers
-            periods = periods[abs(periods - np.median(periods)) < 2 * np.std(periods)]
-
-        if periods[0] > 1000:
-            rpm = 60 * self.freq / periods[0] / 4
-        else:
-            rpm = 60 * self.freq / np.median(periods) / 4
         return rpm
 
     def measure_rpm(self, vial_number=7, estimated_rpm=None):
@@ -178,13 +236,79 @@ class Stirrers:
         rpm = self._measure_rpm_no_lock(vial_number, estimated_rpm=estimated_rpm)
         return rpm
 
+    def _capture_sweep(self, estimated_rpms):
+        """
+        captures the tachometers of several stirrers back to back under one ftdi lock acquisition
+        :param estimated_rpms: dictionary vial -> estimated rpm
+        :return: dictionary vial -> rpm, None for vials without a complete period in the capture
+        """
+        plan = {vial: self.capture_nbytes(rpm) for vial, rpm in estimated_rpms.items()}
+        captures = {}
+        ftdi_lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="stirrers")
+        if not ftdi_lock_acquired:
+            raise Exception("Could not acquire lock for reading stirrer speeds at time %s" % time.ctime())
+        try:
+            for vial, nbytes in plan.items():
+                captures[vial] = self._capture(vial, nbytes)
+        finally:
+            self.device.lock_ftdi.release()
+        self.last_sweep_budget["bytes"] += sum(plan.values())
+        self.last_sweep_budget["planned_seconds"] += sum(self.capture_seconds(n) for n in plan.values())
+        return {vial: self._rpm_from_capture(res) for vial, res in captures.items()}
+
+    def estimate_sweep_seconds(self, vials_to_measure=(1, 2, 3, 4, 5, 6, 7)):
+        """expected duration of measure_all_rpms without retries, from the expected rpms of the vials"""
+        seconds = 0
+        for vial in vials_to_measure:
+            rpm = self.expected_rpm(vial)
+            if rpm >= self.min_measurable_rpm:
+                seconds += self.capture_seconds(self.capture_nbytes(rpm))
+        return seconds
+
     def measure_all_rpms(self, vials_to_measure=(1, 2, 3, 4, 5, 6, 7)):
+        """
+        Measure the rpm of several stirrers in one sweep. Capture lengths are planned from the expected rpms,
+        all captures run under one ftdi lock acquisition and only failed vials are retried at half the rpm.
+        """
         results = {vial_number: None for vial_number in range(1, 8)}
+        t0 = time.time()
+        self.last_sweep_budget = {"vials": list(vials_to_measure), "bytes": 0, "planned_seconds": 0,
+                                  "measured_seconds": None, "retries": 0}
+        if len(vials_to_measure) == 0:
+            return results
+        # if file db/skip_stirrer_speed_measurement exists, return 0
+        if os.path.exists("db/skip_stirrer_speed_measurement"):
+            for vial_number in vials_to_measure:
+                results[vial_number] = 0
+            return results
+
+        estimated_rpms = {}
         for vial_number in vials_to_measure:
-            results[vial_number] = self.measure_rpm(vial_number)
-        for k,v in results.items():
+            estimated_rpm = self.expected_rpm(vial_number)
+            if estimated_rpm < self.min_measurable_rpm:
+                results[vial_number] = 0
+            else:
+                estimated_rpms[vial_number] = estimated_rpm
+
+        while len(estimated_rpms) > 0:
+            rpms = self._capture_sweep(estimated_rpms)
+            retry_rpms = {}
+            for vial_number, rpm in rpms.items():
+                if rpm is not None:
+                    results[vial_number] = rpm
+                elif estimated_rpms[vial_number] > 400:
+                    retry_rpms[vial_number] = estimated_rpms[vial_number] / 2
+                else:
+                    results[vial_number] = 0
+            if len(retry_rpms) > 0:
+                self.last_sweep_budget["retries"] += 1
+                time.sleep(self.rpm_retry_delay)
+            estimated_rpms = retry_rpms
+
+        for k, v in results.items():
             if v is not None:
                 self.rpms[k] = v
+        self.last_sweep_budget["measured_seconds"] = time.time() - t0
         return results
 
     def get_calibration_curve(self, vial, n_points=10, time_sleep=2):
@@ -15,11 +15,11 @@ class Thermometers:
 
     def connect(self):
         try:
-            self.thermometer_vials = self.device.i2c.get_port(
-                self.device.PORT_THERMOMETER_VIALS
+            self.thermometer_vials = self.device.get_i2c_port(
+                "thermometer_vials", self.device.PORT_THERMOMETER_VIALS
             )
-            self.thermometer_board = self.device.i2c.get_port(
-                self.device.PORT_THERMOMETER_BOARD
+            self.thermometer_board = self.device.get_i2c_port(
+                "thermometer_board", self.device.PORT_THERMOMETER_BOARD
             )
         except pyftdi.i2c.I2cNackError:
             print("PCA9685 PWM controller connection ERROR.")
@@ -28,8 +28,8 @@ class Thermometers:
             time.sleep(0.06)
             self.thermometer_vials.read_from(0x04, 2)
         except pyftdi.i2c.I2cNackError:
-            self.thermometer_vials = self.device.i2c.get_port(
-                self.device.PORT_THERMOMETER_VIALS_v4
+            self.thermometer_vials = self.device.get_i2c_port(
+                "thermometer_vials", self.device.PORT_THERMOMETER_VIALS_v4
             )
 
     # near DC-DC converters which get warm
@@ -43,7 +43,7 @@ class Thermometers:
     def measure_temperature(self):
         temps = []
         for thermometer_port in [self.thermometer_vials, self.thermometer_board]:
-            lock_acquired = self.device.lock_ftdi.acquire(timeout=15)
+            lock_acquired = self.device.lock_ftdi.acquire(timeout=15, client="thermometers")
             if not lock_acquired:
                 raise Exception("Could not acquire lock to measure temperature at time %s" % time.ctime())
             try:
@@ -132,7 +132,7 @@ class Valves:
         time.sleep(self.VALVE_OPEN_TIME)
         self.is_open[valve] = True
         self.device.device_data["valves"]['states'][valve] = "open"
-        self.device.eeprom.save_config_to_eeprom()
+        self.device.eeprom.save_config_to_eeprom(states_only=True)
 
     def get_percent_open_pwm(self, valve):
         if self.pwm_controller.is_sleeping():
@@ -160,7 +160,7 @@ class Valves:
         time.sleep(self.VALVE_CLOSE_TIME)
         self.is_open[valve] = False
         self.device.device_data["valves"]['states'][valve] = "closed"
-        self.device.eeprom.save_config_to_eeprom()
+        self.device.eeprom.save_config_to_eeprom(states_only=True)
 
     def open_all(self):
         open_valves = self.get_fully_open_valves()
@@ -401,4 +401,64 @@ def toggle_pump_continuous_run(pump_id: int, payload: dict, device: BaseDevice =
         
     except Exception as e:
         logger.error(f"Error toggling continuous run for pump {pump_id}: {str(e)}")
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        return {"success": False, "error": str(e)}
+
+@router.get("/measurement-budget")
+def get_measurement_budget(device: BaseDevice = Depends(get_device)):
+    """Time spent on the last stirrer rpm sweep and OD sweep, and the expected duration of the next ones"""
+    try:
+        return {"success": True,
+                "stirrers": device.stirrers.last_sweep_budget,
+                "stirrers_estimated_seconds": device.stirrers.estimate_sweep_seconds(),
+                "ods": device.od_sweep.get_stats(),
+                "ods_estimated_seconds": device.od_sweep.estimate_sweep_time(7)}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+@router.get("/bus-stats")
+def get_bus_stats(device: BaseDevice = Depends(get_device)):
+    """Per-client FTDI bus wait time histograms"""
+    return {"success": True, "bus_stats": device.lock_ftdi.get_wait_stats()}
+
+@router.post("/bus-stats/reset")
+def reset_bus_stats(device: BaseDevice = Depends(get_device)):
+    device.lock_ftdi.reset_wait_stats()
+    return {"success": True}
+
+@router.get("/i2c-traffic")
+def get_i2c_traffic(device: BaseDevice = Depends(get_device)):
+    """Per-chip I2C transaction counters, including writes suppressed and reads served by the shadow registers"""
+    return {"success": True, "i2c_traffic": device.get_i2c_traffic()}
+
+@router.post("/i2c-traffic/reset")
+def reset_i2c_traffic(device: BaseDevice = Depends(get_device)):
+    device.reset_i2c_traffic()
+    return {"success": True}
+
+@router.get("/eeprom-stats")
+def get_eeprom_stats(device: BaseDevice = Depends(get_device)):
+    """EEPROM bytes written and write counts per page since startup, and writes coalesced by the writer"""
+    return {"success": True, "eeprom": device.eeprom.get_wear_stats(), "writer": device.eeprom.writer.get_stats()}
+
+@router.get("/connect-timings")
+def get_connect_timings(device: BaseDevice = Depends(get_device)):
+    """Seconds spent in each step of the last device connect, 'total' is the connect-to-ready time"""
+    return {"success": True, "connect_timings": device.connect_timings}
+
+@router.get("/photodiode-signals")
+def get_photodiode_signals(vial: int = None, start_time: float = None, end_time: float = None, limit: int = 10000,
+                           device: BaseDevice = Depends(get_device)):
+    """Raw photodiode samples from the signal log, times in unix seconds, most recent `limit` records"""
+    records = device.signal_log.read(start_time=start_time, end_time=end_time, vial=vial)[-limit:]
+    return {"success": True,
+            "signals": {name: records[name].tolist() for name in records.dtype.names},
+            "log": device.signal_log.get_stats()}
+
+@router.get("/dilution-timings")
+def get_dilution_timings(device: BaseDevice = Depends(get_device)):
+    """Phase durations of the last dilutions, makespans of the last dilution cycles
+    and predicted vs. measured pump move times"""
+    return {"success": True,
+            "dilutions": list(device.dilution_timings),
+            "cycles": list(device.dilution_cycles),
+            "motion": device.motion_monitor.get_stats()}
@@ -1,13 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from experiment.experiment_manager import experiment_manager
 from experiment.exceptions import ExperimentNotFound
+from experiment.database_models import OdSeriesVersion, GrowthParameterFit
+from experiment.od_recompute import OdRecomputeJob, running_jobs, get_series
+from experiment.growth_parameter_fit import GrowthParameterFitJob, running_fits
+from experiment.backtest import backtest_vial
+from experiment.ModelBasedCulture.simulation_cache import simulation_cache
+from experiment.ModelBasedCulture.simulation_pool import run_simulations, simulation_summary
 from routers.experiment_schemas import ExperimentCreate, ExperimentOut, SelectExperimentIn, ParametersUpdate
 from logger.logger import logger
 import traceback
 import os
+import json
 from fastapi import WebSocket, WebSocketDisconnect
 import numpy as np
 from datetime import datetime
@@ -21,6 +28,8 @@ from alternative_growth_rate import (
 router = APIRouter()
 get_db = experiment_manager.get_db
 
+SIMULATION_METHODS = ["minute", "ode"]
+
 @router.get("/experiments", response_model=List[ExperimentOut])
 def get_experiments(db_session: Session = Depends(get_db)):
     """Get all experiments"""
@@ -111,10 +120,69 @@ def update_current_experiment_growth_parameters(growth_parameters: dict = Body(.
     except ExperimentNotFound as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+@router.post("/cultures/run-simulation")
+def run_simulations_all_vials(payload: dict = Body(default={})):
+    """
+    Simulate the selected vials (default all) in the simulation process pool, outside the API process.
+    Streams newline-delimited JSON: one line per vial as its simulation finishes, with summary_data or error,
+    and a last line with the combined results. Cached simulations are returned without rerunning.
+    Payload: {"vials": [1, 2, ...], "simulation_hours": 48, "method": "minute" or "ode"}
+    """
+    simulation_hours = payload.get('simulation_hours', 48)
+    method = payload.get('method', 'minute')
+    if method not in SIMULATION_METHODS:
+        raise HTTPException(status_code=400, detail=f"Simulation method must be one of {SIMULATION_METHODS}")
+    if simulation_hours < 1:
+        raise HTTPException(status_code=400, detail="Simulation hours must be at least 1")
+    if simulation_hours > 240:
+        raise HTTPException(status_code=400, detail="Simulation hours cannot exceed 240 (10 days)")
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    vials = [int(v) for v in payload.get('vials') or list(range(1, 8))]
+    if not all(vial in experiment.cultures for vial in vials):
+        raise HTTPException(status_code=400, detail=f"Unknown vials in {vials}")
+
+    def generate():
+        t0 = datetime.now()
+        results = {}
+        jobs = {}
+        for vial in vials:
+            culture = experiment.cultures[vial]
+            growth_parameters, updater_parameters = culture.simulation_parameters()
+            model = simulation_cache.get(vial, growth_parameters, updater_parameters, simulation_hours, method=method)
+            if model is None:
+                jobs[vial] = (growth_parameters, updater_parameters)
+                continue
+            culture.set_simulated_model(model)
+            results[vial] = {"vial": vial, "cached": True, "summary_data": simulation_summary(model)}
+            yield json.dumps(results[vial]) + "\n"
+        try:
+            for vial, model, error in run_simulations(jobs, simulation_hours, method=method):
+                if error is not None:
+                    logger.error(f"Error running simulation for culture {vial}: {error}")
+                    results[vial] = {"vial": vial, "error": f"Simulation Error ({type(error).__name__})\n\n{error}"}
+                else:
+                    simulation_cache.put(vial, *jobs[vial], simulation_hours, model, method=method)
+                    experiment.cultures[vial].set_simulated_model(model)
+                    results[vial] = {"vial": vial, "cached": False, "summary_data": simulation_summary(model)}
+                yield json.dumps(results[vial]) + "\n"
+        except Exception as e:
+            logger.error(f"Error running simulations: {e}")
+            logger.error(traceback.format_exc())
+            yield json.dumps({"error": str(e)}) + "\n"
+        elapsed = (datetime.now() - t0).total_seconds()
+        yield json.dumps({"done": True, "elapsed_seconds": elapsed,
+                          "results": [results[vial] for vial in vials if vial in results]}) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 @router.put("/cultures/{vial}/run-simulation")
-def run_simulation(vial: int, simulation_hours: int = 48, db_session: Session = Depends(get_db)):
-    """Run a simulation of the current experiment"""
+def run_simulation(vial: int, simulation_hours: int = 48, method: str = "minute", db_session: Session = Depends(get_db)):
+    """Run a simulation of the current experiment, method "minute" (fixed steps) or "ode" (adaptive steps)"""
     # Validate simulation hours
+    if method not in SIMULATION_METHODS:
+        raise HTTPException(status_code=400, detail=f"Simulation method must be one of {SIMULATION_METHODS}")
     if simulation_hours < 1:
         raise HTTPException(status_code=400, detail="Simulation hours must be at least 1")
     if simulation_hours > 240:
@@ -125,23 +193,8 @@ def run_simulation(vial: int, simulation_hours: int = 48, db_session: Session =
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     try:
-        experiment.cultures[vial].run_and_save_simulation(simulation_hours=simulation_hours)
-        culture = experiment.cultures[vial]
-        pump1_volume_used = sum(culture.culture_growth_model.pump1_volumes)
-        pump2_volume_used = sum(culture.culture_growth_model.pump2_volumes)
-        waste_medium_volume_created = sum(culture.culture_growth_model.waste_medium_created)
-        summary_data = {
-            "initial_population": culture.culture_growth_model.initial_population,
-            "final_population": culture.culture_growth_model.population[-1] if culture.culture_growth_model.population else None,
-            "final_effective_growth_rate": culture.culture_growth_model.effective_growth_rates[-1][0] if culture.culture_growth_model.effective_growth_rates else None,
-            "final_dose": culture.culture_growth_model.doses[-1][0] if culture.culture_growth_model.doses else None,
-            "final_generation": culture.culture_growth_model.generations[-1][0] if culture.culture_growth_model.generations else None,
-            "initial_ic50": culture.culture_growth_model.ic50_initial,
-            "final_ic50": culture.culture_growth_model.ic50s[-1][0] if culture.culture_growth_model.ic50s else None,
-            "pump1_volume_used": pump1_volume_used,
-            "pump2_volume_used": pump2_volume_used,
-            "waste_medium_volume_created": waste_medium_volume_created,
-        }
+        experiment.cultures[vial].run_and_save_simulation(simulation_hours=simulation_hours, method=method)
+        summary_data = simulation_summary(experiment.cultures[vial].culture_growth_model)
         return {"message": "Simulation run", "summary_data": summary_data}
     except Exception as e:
         # Format error message nicely with full traceback
@@ -168,9 +221,85 @@ def run_simulation(vial: int, simulation_hours: int = 48, db_session: Session =
         logger.error(f"Error running simulation for culture {vial}: {e}")
         logger.error(full_traceback)
         raise HTTPException(status_code=500, detail=error_msg)
+@router.post("/cultures/{vial}/simulation-sweep")
+def run_simulation_sweep(vial: int, payload: dict = Body(...)):
+    """
+    Simulate the culture for every combination of the given parameter values, on top of its current parameters,
+    and return the simulation efficiency (volume and time per IC50 doubling) of each candidate.
+    Payload: {"parameters": {name: [values]}, "simulation_hours": 48}
+    """
+    grid = payload.get('parameters') or {}
+    simulation_hours = payload.get('simulation_hours', 48)
+    if simulation_hours < 1:
+        raise HTTPException(status_code=400, detail="Simulation hours must be at least 1")
+    if simulation_hours > 240:
+        raise HTTPException(status_code=400, detail="Simulation hours cannot exceed 240 (10 days)")
+    if not all(isinstance(values, list) and len(values) > 0 for values in grid.values()):
+        raise HTTPException(status_code=400, detail="Each sweep parameter needs a non-empty list of values")
+    n_candidates = int(np.prod([len(values) for values in grid.values()]))
+    if n_candidates > 20000:
+        raise HTTPException(status_code=400, detail=f"{n_candidates} candidates, the sweep is limited to 20000")
+
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    try:
+        t0 = datetime.now()
+        results = experiment.cultures[vial].run_simulation_sweep(grid, simulation_hours=simulation_hours)
+        elapsed = (datetime.now() - t0).total_seconds()
+        logger.info(f"Simulation sweep of vial {vial}: {len(results)} candidates in {elapsed:.1f} s")
+        return {"success": True, "simulation_hours": simulation_hours, "elapsed_seconds": elapsed,
+                "candidates": results}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error running simulation sweep for culture {vial}: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/cultures/{vial}/simulation-ensemble")
+def run_simulation_ensemble(vial: int, payload: dict = Body(default={})):
+    """
+    Simulate replicates of the culture with noisy OD and growth rate measurements and uncertain parameters,
+    and return percentile bands of OD, dose and IC50 over time and the probability that the culture washes out.
+    Payload: {"n_replicates": 200, "simulation_hours": 48, "od_noise": 0.005, "growth_rate_noise": 0.05,
+              "parameter_uncertainty": {name: relative sd}, "washout_od": 0.01, "record_every_minutes": 10,
+              "seed": null}
+    """
+    options = {name: payload[name] for name in ["n_replicates", "simulation_hours", "od_noise", "growth_rate_noise",
+                                                "parameter_uncertainty", "washout_od", "record_every_minutes",
+                                                "percentiles", "seed"] if payload.get(name) is not None}
+    simulation_hours = options.get('simulation_hours', 48)
+    if simulation_hours < 1:
+        raise HTTPException(status_code=400, detail="Simulation hours must be at least 1")
+    if simulation_hours > 240:
+        raise HTTPException(status_code=400, detail="Simulation hours cannot exceed 240 (10 days)")
+    if not 1 <= options.get('n_replicates', 200) <= 5000:
+        raise HTTPException(status_code=400, detail="Number of replicates must be between 1 and 5000")
+    if options.get('record_every_minutes', 10) < 1:
+        raise HTTPException(status_code=400, detail="Record interval must be at least 1 minute")
+
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    try:
+        t0 = datetime.now()
+        result = experiment.cultures[vial].run_simulation_ensemble(**options)
+        elapsed = (datetime.now() - t0).total_seconds()
+        logger.info(f"Simulation ensemble of vial {vial}: {result['n_replicates']} replicates in {elapsed:.1f} s")
+        return {"success": True, "elapsed_seconds": elapsed, **result}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error running simulation ensemble for culture {vial}: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/plot/{vial}/simulation")
-def get_culture_predicted_plot(vial: int, simulation_hours: int = 48, db_session: Session = Depends(get_db)):
+def get_culture_predicted_plot(vial: int, simulation_hours: int = 48, method: str = "minute", db_session: Session = Depends(get_db)):
     # Validate simulation hours
+    if method not in SIMULATION_METHODS:
+        raise HTTPException(status_code=400, detail=f"Simulation method must be one of {SIMULATION_METHODS}")
     if simulation_hours < 1:
         raise HTTPException(status_code=400, detail="Simulation hours must be at least 1")
     if simulation_hours > 240:
@@ -179,7 +308,7 @@ def get_culture_predicted_plot(vial: int, simulation_hours: int = 48, db_session
     try:
         experiment = experiment_manager.experiment
         logger.info(f"Plotting predicted plot for culture {vial}")
-        fig = experiment.cultures[vial].plot_predicted(rerun=True, simulation_hours=simulation_hours)
+        fig = experiment.cultures[vial].plot_predicted(rerun=True, simulation_hours=simulation_hours, method=method)
         return fig.to_plotly_json()
     except ExperimentNotFound as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -209,6 +338,11 @@ def get_culture_predicted_plot(vial: int, simulation_hours: int = 48, db_session
         logger.error(full_traceback)
         raise HTTPException(status_code=500, detail=error_msg)
 
+@router.get("/simulation-cache")
+def get_simulation_cache_stats():
+    """Hit and miss counters of the cache of simulated cultures"""
+    return {"success": True, **simulation_cache.get_stats()}
+
 @router.get("/plot/{vial}")
 def get_culture_plot(vial: int, db_session: Session = Depends(get_db)):
     try:
@@ -1153,6 +1287,172 @@ def get_data_time_range(vials: str, db_session: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Failed to get time range: {str(e)}")
 
 
+@router.post("/experiments/current/od-series/recompute")
+def recompute_od_series(payload: dict = Body(default={})):
+    """
+    Recompute the OD and growth rate history of the current experiment from the stored raw photodiode signals
+    as a new versioned series, in the background. Without 'calibration' ({vial: [blank, scaling]}) the current
+    device calibration is used.
+    """
+    try:
+        experiment = experiment_manager.experiment
+        if experiment is None:
+            raise HTTPException(status_code=404, detail="No current experiment selected")
+        vials = payload.get('vials') or list(range(1, 8))
+        calibration = payload.get('calibration')
+        if calibration is None:
+            calibration = {}
+            for vial in vials:
+                transform = experiment_manager.device.od_sensors[int(vial)].calibration_transform()
+                calibration[int(vial)] = [transform.blank, transform.scaling]
+        calibration = {int(vial): coefs for vial, coefs in calibration.items() if int(vial) in [int(v) for v in vials]}
+        job = OdRecomputeJob(experiment_manager.get_session, experiment.model.id, calibration,
+                             recompute_growth_rate=payload.get('growth_rate', True),
+                             description=payload.get('description'))
+        version_id = job.start()
+        return {"success": True, "version_id": version_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error starting OD recompute: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/experiments/current/od-series")
+def get_od_series_versions(db_session: Session = Depends(get_db)):
+    """List the recomputed OD series of the current experiment with their progress"""
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    versions = db_session.query(OdSeriesVersion).filter(
+        OdSeriesVersion.experiment_id == experiment.model.id).order_by(OdSeriesVersion.id).all()
+    return {"success": True, "versions": [version.to_dict() for version in versions]}
+
+@router.get("/od-series/{version_id}")
+def get_od_series(version_id: int, vial: int = None, limit: int = None):
+    """Points of a recomputed OD series, optionally for a single vial"""
+    return {"success": True, "points": get_series(experiment_manager.get_session, version_id, vial=vial, limit=limit)}
+
+@router.post("/od-series/{version_id}/cancel")
+def cancel_od_series(version_id: int):
+    job = running_jobs.get(version_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No running OD recompute job {version_id}")
+    job.cancel()
+    return {"success": True}
+
+@router.post("/cultures/{vial}/growth-parameters/fit")
+def fit_growth_parameters(vial: int, payload: dict = Body(default={})):
+    """
+    Fit the growth parameters of a vial to its recorded OD and dilution history in the background. The result is
+    stored as a proposed parameter set with diagnostics, it replaces the current growth parameters only when applied.
+    Payload: {"parameters": [names to fit] (default all fittable), "n_starts": 8, "step_minutes": 5, "seed": null}
+    """
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    if not 1 <= payload.get('n_starts', 8) <= 64:
+        raise HTTPException(status_code=400, detail="Number of starts must be between 1 and 64")
+    if not 1 <= payload.get('step_minutes', 5) <= 60:
+        raise HTTPException(status_code=400, detail="Step must be between 1 and 60 minutes")
+    try:
+        growth_parameters, updater_parameters = experiment.cultures[vial].simulation_parameters()
+        job = GrowthParameterFitJob(experiment_manager.get_session, experiment.model.id, vial, growth_parameters,
+                                    updater_parameters, fit_parameters=payload.get('parameters'),
+                                    n_starts=payload.get('n_starts', 8), step_minutes=payload.get('step_minutes', 5),
+                                    seed=payload.get('seed'))
+        fit_id = job.start()
+        return {"success": True, "fit_id": fit_id}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error starting growth parameter fit of vial {vial}: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/experiments/current/growth-parameter-fits")
+def get_growth_parameter_fits(vial: int = None, db_session: Session = Depends(get_db)):
+    """List the growth parameter fits of the current experiment, optionally of a single vial"""
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    query = db_session.query(GrowthParameterFit).filter(GrowthParameterFit.experiment_id == experiment.model.id)
+    if vial is not None:
+        query = query.filter(GrowthParameterFit.vial_number == vial)
+    return {"success": True, "fits": [fit.to_dict() for fit in query.order_by(GrowthParameterFit.id).all()]}
+
+@router.get("/growth-parameter-fits/{fit_id}")
+def get_growth_parameter_fit(fit_id: int, db_session: Session = Depends(get_db)):
+    fit = db_session.query(GrowthParameterFit).filter(GrowthParameterFit.id == fit_id).first()
+    if fit is None:
+        raise HTTPException(status_code=404, detail=f"Growth parameter fit {fit_id} not found")
+    return {"success": True, "fit": fit.to_dict()}
+
+@router.post("/growth-parameter-fits/{fit_id}/cancel")
+def cancel_growth_parameter_fit(fit_id: int):
+    job = running_fits.get(fit_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No running growth parameter fit {fit_id}")
+    job.cancel()
+    return {"success": True}
+
+@router.post("/growth-parameter-fits/{fit_id}/apply")
+def apply_growth_parameter_fit(fit_id: int, db_session: Session = Depends(get_db)):
+    """Replace the fitted growth parameters of the vial with the fitted values, the others are kept"""
+    experiment = experiment_manager.experiment
+    if experiment is None:
+        raise HTTPException(status_code=404, detail="No current experiment selected")
+    fit = db_session.query(GrowthParameterFit).filter(GrowthParameterFit.id == fit_id).first()
+    if fit is None:
+        raise HTTPException(status_code=404, detail=f"Growth parameter fit {fit_id} not found")
+    if fit.experiment_id != experiment.model.id:
+        raise HTTPException(status_code=400, detail=f"Growth parameter fit {fit_id} is not of the current experiment")
+    if fit.status != "done":
+        raise HTTPException(status_code=400, detail=f"Growth parameter fit {fit_id} is {fit.status}, not done")
+    try:
+        growth_parameters = dict(experiment.model.parameters["growth_parameters"])
+        fitted_values = {name: fit.fitted_parameters[name] for name in fit.diagnostics["fitted_names"]}
+        growth_parameters[str(fit.vial_number)] = {**growth_parameters[str(fit.vial_number)], **fitted_values}
+        params = experiment_manager.update_current_experiment_growth_parameters(growth_parameters,
+                                                                                db_session=db_session)
+        fit = db_session.query(GrowthParameterFit).filter(GrowthParameterFit.id == fit_id).first()
+        fit.applied_at = datetime.now()
+        db_session.commit()
+        return {"success": True, "growth_parameters": params}
+    except ExperimentNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error applying growth parameter fit {fit_id}: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/experiments/{experiment_id}/vials/{vial}/backtest")
+def backtest_updater(experiment_id: int, vial: int, payload: dict = Body(default={})):
+    """
+    Replay the recorded OD and growth rate data of a vial through the morbidostat updater with other settings,
+    and compare the dilutions and dose changes it would have made with the recorded ones. No device is used.
+    Payload: {"updater_parameters": {name: value} (overrides of the stored culture parameters),
+              "start": ISO time, "end": ISO time, "od_mode": "rescaled" | "recorded"}
+    """
+    try:
+        start = datetime.fromisoformat(payload['start']) if payload.get('start') else None
+        end = datetime.fromisoformat(payload['end']) if payload.get('end') else None
+        result = backtest_vial(experiment_manager.get_session, experiment_id, vial,
+                               updater_parameters=payload.get('updater_parameters'), start=start, end=end,
+                               od_mode=payload.get('od_mode', "rescaled"))
+        summary = result["summary"]
+        logger.info(f"Backtest of experiment {experiment_id} vial {vial}: {summary['hours_replayed']:.1f} h "
+                    f"replayed in {summary['elapsed_seconds']:.2f} s")
+        return {"success": True, **result}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error in backtest of vial {vial}: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()